@@ -21,22 +21,32 @@
 # SOFTWARE.
 
 """ Module contains main loop and configuration of pyBinSim """
+import gc
 import logging
 import time
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import sounddevice as sd
 
-from pybinsim.convolver import ConvolverTorch
+from pybinsim.convolver import ConvolverTorch, ConvolverFused, ConvolverNonUniform, nonuniform_partitioning, \
+    multirate_partitioning
 from pybinsim.filterstorage import FilterStorage
+from pybinsim.filter_updater import FilterUpdater, DirectivityComposer, update_filters
 from pybinsim.pose import Pose, SourcePose
+from pybinsim.pose_index import parse_pose_weights
 from pybinsim.parsing import parse_boolean, parse_soundfile_list
 from pybinsim.soundhandler import SoundHandler, LoopState
 from pybinsim.input_buffer import InputBufferMulti
+from pybinsim.numpy_convolver import ConvolverNumpy, InputBufferNumpy
 from pybinsim.pkg_receiver import CONFIG_SOUNDFILE_PLAYER_NAME, PkgReceiver
 from pybinsim.zmq_receiver import ZmqReceiver
 from pybinsim.osc_receiver import OscReceiver
+from pybinsim.deferred_logging import start_deferred_logging, stop_deferred_logging
+from pybinsim.render_thread import OutputRingBuffer, RenderThread
+from pybinsim.realtime import parse_cpu_list, configure_thread, configure_torch_threads, flush_denormals
 
 import torch
 
@@ -55,7 +65,17 @@ class BinSimConfig(object):
                                   'filterSource[mat/wav]': 'mat',
                                   'filterList': 'brirs/filter_list_kemar5.txt',
                                   'filterDatabase': 'brirs/database.mat',
+                                  'filterCache': '',
+                                  'lazyFilterStorage': False,
+                                  'filterMemoryBudget': 1024,
+                                  'loadingThreads': 0,
+                                  'nearestNeighbourLookup': False,
+                                  'nearestNeighbourWeights': '1,1,1,1,1',
+                                  'nearestNeighbourMaxDistance': float(0),
                                   'enableCrossfading': False,
+                                  'ds_enableCrossfading': True,
+                                  'early_enableCrossfading': True,
+                                  'late_enableCrossfading': True,
                                   'useHeadphoneFilter': False,
                                   'headphone_filterSize': 1024,
                                   'loudnessFactor': float(1),
@@ -64,12 +84,49 @@ class BinSimConfig(object):
                                   'loopSound': True,
                                   'pauseConvolution': False,
                                   'pauseAudioPlayback': False,
+                                  'convolutionEngine[torch/numpy]': 'torch',
                                   'torchConvolution[cpu/cuda]': 'cuda',
                                   'torchStorage[cpu/cuda]': 'cuda',
+                                  'multiplyAccumulate[elementwise/matmul]': 'elementwise',
+                                  'compileConvolution[none/script/compile]': 'none',
+                                  'leanMemory': False,
                                   'ds_convolverActive': True,
                                   'early_convolverActive': True,
                                   'late_convolverActive': True,
                                   'sd_convolverActive': False,
+                                  'precomposeFilters': False,
+                                  'composedFilterMemoryBudget': 256,
+                                  'fusedConvolution': False,
+                                  'filterUpdateThread': False,
+                                  'parallelStages': False,
+                                  'ds_partitioning[uniform/nonuniform]': 'uniform',
+                                  'early_partitioning[uniform/nonuniform]': 'uniform',
+                                  'late_partitioning[uniform/nonuniform]': 'uniform',
+                                  'maxPartitionSize': 8192,
+                                  'ds_blockSize': 0,
+                                  'early_blockSize': 0,
+                                  'late_blockSize': 0,
+                                  'ds_lookahead': False,
+                                  'early_lookahead': False,
+                                  'late_lookahead': False,
+                                  'partitionSilenceThreshold': float(-200),
+                                  'strictRealtime': False,
+                                  'audioThreadPriority': 0,
+                                  'audioThreadNice': 0,
+                                  'audioThreadCpus': '',
+                                  'audioWorkerThreadCpus': '',
+                                  'receiverThreadPriority': 0,
+                                  'receiverThreadNice': 0,
+                                  'receiverThreadCpus': '',
+                                  'workerThreadCpus': '',
+                                  'torchThreads': 0,
+                                  'torchInteropThreads': 0,
+                                  'disableAutomaticGc': False,
+                                  'flushDenormals': False,
+                                  'deferredLogging': True,
+                                  'logRateLimitInterval': float(1),
+                                  'renderThread': False,
+                                  'renderAheadBlocks': 2,
                                   'audio_callback_benchmark': False, # only set for bench_audio_callback.py!
                                   'recv_type': 'osc',
                                   'recv_protocol': 'tcp',
@@ -132,6 +189,12 @@ class BinSim(object):
         self.config = BinSimConfig()
         self.config.read_from_file(config_file)
 
+        # console output of the pybinsim loggers is written by a background thread, not by the audio thread
+        self.log_listener = None
+        if self.config.get('deferredLogging'):
+            self.log_listener = start_deferred_logging(logging.getLogger("pybinsim"),
+                                                       self.config.get('logRateLimitInterval'))
+
         self.nChannels = self.config.get('maxChannels')
         self.sampleRate = self.config.get('samplingRate')
         self.blockSize = self.config.get('blockSize')
@@ -139,10 +202,69 @@ class BinSim(object):
         self.result = None
         self.block = None
         self.stream = None
+        self.render_thread = None
+
+        # before any thread is started, threads inherit the CPU affinity of the thread creating them
+        self.configure_threads()
 
         self.convolverHP, self.ds_convolver, self.early_convolver, self.late_convolver, self.sd_convolver,\
-            self.input_Buffer, self.input_BufferHP, self.input_BufferSD, self.filterStorage, self.pkgReceiver,\
-            self.soundHandler = self.initialize_pybinsim()
+            self.fused_convolver, self.input_Buffer, self.input_BufferHP, self.input_BufferSD, self.filterStorage,\
+            self.pkgReceiver, self.soundHandler = self.initialize_pybinsim()
+
+        # shares the memory of the buffer the SoundHandler mixes the players into
+        self.sound_block = torch.from_numpy(self.soundHandler.get_output_buffer())
+
+        # output while pauseConvolution is set
+        self.pause_result = torch.zeros(2, self.blockSize, dtype=torch.float32)
+
+        # Output block on the CPU, which the result is copied to (from the device) and which is copied to the
+        # output buffer of the callback. The views are created once, so the callback does not create them per block.
+        self.output_block = torch.zeros(2, 1, self.blockSize, dtype=torch.float32)
+        self.output_view = self.output_block[:, 0, :]
+        # [blockSize, 2] like the output buffer of sounddevice
+        self.output_numpy = self.output_view.numpy().T
+        self.result = self.output_view
+
+        # In strict real-time mode the callback does not log or compute statistics, which allocate.
+        # Clipping and underruns are only counted and reported on close.
+        self.strict_realtime = self.config.get('strictRealtime')
+        self.clipped_blocks = 0
+        self.underruns = 0
+
+        for thread in self.pkgReceiver.threads:
+            configure_thread(thread.native_id, self.config.get('receiverThreadPriority'),
+                             self.config.get('receiverThreadNice'),
+                             parse_cpu_list(self.config.get('receiverThreadCpus')), thread.name)
+
+        # Receives the directivity filters and provides the ds filters, composed with them if precomposeFilters is set
+        self.directivity_target = self.sd_convolver
+        self.get_ds_filter = self.filterStorage.get_ds_filter
+        if self.config.get('sd_convolverActive') and not self.directivity_stage:
+            self.directivity_target = DirectivityComposer(self.filterStorage, self.pkgReceiver.ds_dirty_channels,
+                                                          self.nChannels)
+            self.get_ds_filter = self.directivity_target.get_ds_filter
+
+        # composing the ds and directivity filters takes several FFTs, which must not run in the audio callback
+        use_filter_updater = self.config.get('filterUpdateThread')
+        if isinstance(self.directivity_target, DirectivityComposer) and not use_filter_updater:
+            self.log.info("precomposeFilters with sd_convolverActive: updating filters on the filter update thread")
+            use_filter_updater = True
+
+        self.filterUpdater = None
+        if use_filter_updater:
+            self.filterUpdater = self.create_filter_updater()
+
+        # Stages processing the input spectra of the sources, their outputs are summed up
+        self.source_stages = self.get_source_stages()
+        self.stage_mix = torch.zeros(2, 1, self.blockSize, dtype=torch.float32,
+                                     device=self.config.get('torchConvolution[cpu/cuda]'))
+
+        # The first stage is processed by the audio callback, the others run on the stage executor in parallel
+        self.stage_executor = None
+        if self.config.get('parallelStages') and len(self.source_stages) > 1:
+            self.stage_executor = ThreadPoolExecutor(max_workers=len(self.source_stages) - 1,
+                                                     thread_name_prefix="pybinsim-stage",
+                                                     initializer=self.configure_audio_worker_thread)
 
     def __enter__(self):
         return self
@@ -152,13 +274,37 @@ class BinSim(object):
 
     def stream_start(self):
         self.log.info("BinSim: stream_start")
+
+        disable_gc = self.config.get('disableAutomaticGc')
+        if self.strict_realtime or disable_gc:
+            # objects created during startup are never collected, so garbage collections in the callback are shorter
+            gc.collect()
+            gc.freeze()
+        if disable_gc:
+            # no collection is triggered by allocations in the callback, the main thread collects instead
+            gc.disable()
+
         try:
+            if self.config.get('renderThread'):
+                # blocks are rendered ahead on the render thread, the device may call back with any number of frames
+                # up to renderAheadBlocks * blockSize, one more block is needed since the ring is refilled in blocks
+                ring = OutputRingBuffer(self.blockSize * (self.config.get('renderAheadBlocks') + 1))
+                self.render_thread = RenderThread(audio_callback(self), self.blockSize, ring, self.sampleRate)
+                callback = ring_callback(self, self.render_thread)
+                device_block_size = 0
+            else:
+                callback = audio_callback(self)
+                device_block_size = self.blockSize
+
             self.stream = sd.OutputStream(samplerate=self.sampleRate,
                                           dtype='float32',
                                           channels=2,
                                           latency="low",
-                                          blocksize=self.blockSize,
-                                          callback=audio_callback(self))
+                                          blocksize=device_block_size,
+                                          callback=callback)
+
+            if self.render_thread:
+                self.render_thread.start()
 
            #pydevd.settrace(suspend=False, trace_only_current_thread=True)
 
@@ -166,6 +312,8 @@ class BinSim(object):
                 self.log.info(f"latency: {s.latency} seconds")
                 while True:
                     sd.sleep(1000)
+                    if disable_gc:
+                        gc.collect()
 
 
         except KeyboardInterrupt:
@@ -173,10 +321,46 @@ class BinSim(object):
         except Exception as e:
             print(e)
 
+    def configure_threads(self):
+        """ Apply the thread settings of the config to the calling thread and torch """
+        configure_thread(cpus=parse_cpu_list(self.config.get('workerThreadCpus')), name="main thread")
+        configure_torch_threads(self.config.get('torchThreads'), self.config.get('torchInteropThreads'))
+
+        if self.config.get('flushDenormals'):
+            flush_denormals()
+
+    def configure_audio_thread(self):
+        """ Apply the audio thread settings of the config, called from the audio thread """
+        configure_thread(priority=self.config.get('audioThreadPriority'), nice=self.config.get('audioThreadNice'),
+                         cpus=parse_cpu_list(self.config.get('audioThreadCpus')), name="audio thread")
+
+        if self.config.get('flushDenormals'):
+            flush_denormals()
+
+    def configure_audio_worker_thread(self):
+        """
+        Apply the audio thread settings to the calling thread, which processes audio the callback waits for
+        (parallel stages, look-ahead and tail segments). Only its CPUs can be set separately.
+        """
+        cpus = self.config.get('audioWorkerThreadCpus') or self.config.get('audioThreadCpus')
+        configure_thread(priority=self.config.get('audioThreadPriority'), nice=self.config.get('audioThreadNice'),
+                         cpus=parse_cpu_list(cpus), name=threading.current_thread().name)
+
+        if self.config.get('flushDenormals'):
+            flush_denormals()
+
     def initialize_pybinsim(self):
         #self.result = np.empty([self.blockSize, 2], dtype=np.float32)
         self.result = torch.zeros(2, self.blockSize, dtype=torch.float32)
 
+        # The numpy engine convolves uniformly partitioned on the CPU, torchConvolution[cpu/cuda] is not used then
+        engine = self.config.get('convolutionEngine[torch/numpy]')
+        if engine not in ('torch', 'numpy'):
+            self.log.warning("Unknown convolutionEngine '{}': using torch".format(engine))
+        self.numpy_engine = engine == 'numpy'
+        if self.numpy_engine:
+            self.config.set('torchConvolution[cpu/cuda]', 'cpu')
+
         #self.block = np.zeros([self.nChannels, self.blockSize], dtype=np.float32)
         self.block = torch.zeros([self.nChannels, self.blockSize], dtype=torch.float32)
 
@@ -198,7 +382,34 @@ class BinSim(object):
             sd_size = self.blockSize
             self.log.info('Block size smaller than directivty filter size: Zero Padding sd filter')
 
+        # Pre-composition convolves the headphone filter into all filters and the directivity filters into the
+        # ds filters, which are extended accordingly. The separate convolvers are then not processed.
+        precompose = self.config.get('precomposeFilters')
+        headphone_composition = precompose and self.config.get('useHeadphoneFilter')
+        directivity_composition = precompose and self.config.get('sd_convolverActive')
+        self.headphone_stage = self.config.get('useHeadphoneFilter') and not precompose
+        self.directivity_stage = self.config.get('sd_convolverActive') and not precompose
+
+        headphone_extension = self.config.get('headphone_filterSize') if headphone_composition else 0
+        ds_convolver_size = ds_size + headphone_extension + (sd_size if directivity_composition else 0)
+        early_convolver_size = early_size + headphone_extension
+        late_convolver_size = late_size + headphone_extension
+
+        ds_partitioning = self.get_partitioning('ds', ds_convolver_size)
+        early_partitioning = self.get_partitioning('early', early_convolver_size)
+        late_partitioning = self.get_partitioning('late', late_convolver_size)
+
         # Create FilterStorage
+        # bytes of filters kept by the lazy filter storage, None keeps all filters in memory
+        lazy_memory_budget = None
+        if self.config.get('lazyFilterStorage'):
+            lazy_memory_budget = self.config.get('filterMemoryBudget') * 2**20
+
+        # weights of the pose values for the nearest neighbour lookup, None returns silence for unknown poses
+        nearest_neighbour_weights = None
+        if self.config.get('nearestNeighbourLookup'):
+            nearest_neighbour_weights = parse_pose_weights(self.config.get('nearestNeighbourWeights'))
+
         filterStorage = FilterStorage(self.blockSize,
                                       self.config.get('filterSource[mat/wav]'),
                                       self.config.get('filterList'),
@@ -209,7 +420,19 @@ class BinSim(object):
                                       ds_size,
                                       early_size,
                                       late_size,
-                                      sd_size)
+                                      sd_size,
+                                      ds_partitioning,
+                                      early_partitioning,
+                                      late_partitioning,
+                                      self.config.get('partitionSilenceThreshold'),
+                                      headphone_composition,
+                                      directivity_composition,
+                                      self.config.get('filterCache') or None,
+                                      lazy_memory_budget,
+                                      self.config.get('loadingThreads'),
+                                      nearest_neighbour_weights,
+                                      self.config.get('nearestNeighbourMaxDistance'),
+                                      self.config.get('composedFilterMemoryBudget') * 2**20)
 
         # Create SoundHandler
         soundHandler = SoundHandler(self.blockSize, self.nChannels,
@@ -227,47 +450,246 @@ class BinSim(object):
         time.sleep(1)
 
         # Create input buffers
-        input_Buffer = InputBufferMulti(self.blockSize,  self.nChannels, self.config.get('torchConvolution[cpu/cuda]'))
-        input_BufferHP = InputBufferMulti(self.blockSize,  2, self.config.get('torchConvolution[cpu/cuda]'))
-        input_BufferSD = InputBufferMulti(self.blockSize,  2, self.config.get('torchConvolution[cpu/cuda]'))
+        input_Buffer = self.create_input_buffer(self.nChannels)
+        input_BufferHP = self.create_input_buffer(2)
+        input_BufferSD = self.create_input_buffer(2)
 
 
         # Create N convolvers depending on the number of wav channels
         self.log.info('Number of Channels: ' + str(self.nChannels))
 
-        ds_convolver = ConvolverTorch(ds_size, self.blockSize, False, self.nChannels,
-                                          self.config.get('enableCrossfading'),
-                                          self.config.get('torchConvolution[cpu/cuda]'))
-        early_convolver = ConvolverTorch(early_size, self.blockSize, False, self.nChannels,
-                                          self.config.get('enableCrossfading'),
-                                          self.config.get('torchConvolution[cpu/cuda]'))
-        late_convolver = ConvolverTorch(late_size, self.blockSize, False, self.nChannels,
-                                          self.config.get('enableCrossfading'),
-                                          self.config.get('torchConvolution[cpu/cuda]'))
-        sd_convolver = ConvolverTorch(sd_size, self.blockSize, True, self.nChannels,
-                                          self.config.get('enableCrossfading'),
-                                          self.config.get('torchConvolution[cpu/cuda]'))
+        multiply_accumulate = self.config.get('multiplyAccumulate[elementwise/matmul]')
+        if multiply_accumulate not in ('elementwise', 'matmul'):
+            self.log.warning("Unknown multiplyAccumulate '{}': using elementwise".format(multiply_accumulate))
+        self.matmul = multiply_accumulate == 'matmul'
+
+        # The direct sound can only be fused with the other stages, when no source directivity is applied to it
+        fused = self.config.get('fusedConvolution')
+        if fused and self.numpy_engine:
+            self.log.warning("fusedConvolution is not supported by the numpy engine")
+            fused = False
+        ds_convolver = self.create_convolver('ds', ds_convolver_size, ds_partitioning,
+                                             fused and not self.directivity_stage)
+        early_convolver = self.create_convolver('early', early_convolver_size, early_partitioning, fused)
+        late_convolver = self.create_convolver('late', late_convolver_size, late_partitioning, fused)
+        sd_convolver = self.create_stereo_convolver(sd_size, self.config.get('enableCrossfading'))
 
         ds_convolver.active = self.config.get('ds_convolverActive')
         early_convolver.active = self.config.get('early_convolverActive')
         late_convolver.active = self.config.get('late_convolverActive')
-        sd_convolver.active = self.config.get('sd_convolverActive')
+        sd_convolver.active = self.directivity_stage
+
+        # Combined convolver for ds, early and late stages
+        fused_convolver = None
+        if fused:
+            stages = [early_convolver, late_convolver]
+            if not self.directivity_stage:
+                stages.insert(0, ds_convolver)
+            fused_convolver = ConvolverFused(stages, self.blockSize, self.nChannels,
+                                             self.config.get('torchConvolution[cpu/cuda]'))
 
         # HP Equalization convolver
         convolverHP = None
-        if self.config.get('useHeadphoneFilter'):
-            convolverHP = ConvolverTorch(self.config.get('headphone_filterSize'), self.blockSize, True, 1,
-                                         False,
-                                         self.config.get('torchConvolution[cpu/cuda]'))
+        if self.headphone_stage:
+            convolverHP = self.create_stereo_convolver(self.config.get('headphone_filterSize'), False)
             hpfilter = filterStorage.get_headphone_filter()
             convolverHP.setAllFilters([hpfilter])
 
-        return convolverHP, ds_convolver, early_convolver, late_convolver, sd_convolver, input_Buffer, \
+        self.log_memory_footprint([('ds', ds_convolver), ('early', early_convolver), ('late', late_convolver),
+                                   ('sd', sd_convolver), ('fused', fused_convolver), ('headphone', convolverHP)])
+
+        return convolverHP, ds_convolver, early_convolver, late_convolver, sd_convolver, fused_convolver, input_Buffer, \
                input_BufferHP, input_BufferSD, filterStorage, pkgReceiver, soundHandler
 
+    def get_source_stages(self):
+        """ Returns the process functions of the stages, which can be processed independently """
+        if self.directivity_stage:
+            ds_stage = self.process_direct_sound
+        else:
+            ds_stage = self.ds_convolver.process
+
+        if self.fused_convolver is None:
+            return [ds_stage, self.early_convolver.process, self.late_convolver.process]
+
+        # the fused convolver processes ds itself, unless source directivity is applied
+        if self.directivity_stage:
+            return [ds_stage, self.fused_convolver.process]
+
+        return [self.fused_convolver.process]
+
+    def process_direct_sound(self, input_buffers, block):
+        """ Direct sound convolver followed by the source directivity convolver """
+        ds = self.ds_convolver.process(input_buffers, block)
+
+        sd_buffer = self.input_BufferSD.process(ds[:, 0, :])
+        return self.sd_convolver.process(sd_buffer)
+
+    def process_source_stages(self, input_buffers, block):
+        """ Process all source stages and return the sum of their outputs """
+        if self.stage_executor is None:
+            outputs = [stage(input_buffers, block) for stage in self.source_stages]
+        else:
+            futures = [self.stage_executor.submit(stage, input_buffers, block) for stage in self.source_stages[1:]]
+            outputs = [self.source_stages[0](input_buffers, block)]
+            outputs += [future.result() for future in futures]
+
+        if len(outputs) == 1:
+            return outputs[0]
+
+        # the outputs can be buffers of the convolvers, which must not be changed
+        torch.add(outputs[0], outputs[1], out=self.stage_mix)
+        for output in outputs[2:]:
+            self.stage_mix.add_(output)
+
+        return self.stage_mix
+
+    def log_memory_footprint(self, convolvers):
+        """ Log the memory used by the buffers of the convolvers (without the filter storage) """
+        total = 0
+        for name, convolver in convolvers:
+            if convolver is None:
+                continue
+            footprint = convolver.get_memory_footprint()
+            total += footprint
+            self.log.info("Memory footprint of {} convolver: {:.2f} MB".format(name, footprint / 1e6))
+
+        self.log.info("Memory footprint of all convolvers: {:.2f} MB".format(total / 1e6))
+
+    def create_filter_updater(self):
+        """ Start a thread preparing the filters of all convolvers outside of the audio callback """
+        pkgReceiver = self.pkgReceiver
+        filterStorage = self.filterStorage
+
+        filterUpdater = FilterUpdater(pkgReceiver, self.blockSize / self.sampleRate)
+        # directivity filters first, composing them can mark ds channels as dirty
+        filterUpdater.add_stage(pkgReceiver.sd_dirty_channels, 1,
+                                pkgReceiver.get_current_sd_filter_values, filterStorage.get_sd_filter,
+                                SourcePose, self.directivity_target)
+        filterUpdater.add_stage(pkgReceiver.ds_dirty_channels, self.nChannels,
+                                pkgReceiver.get_current_ds_filter_values, self.get_ds_filter,
+                                Pose, self.ds_convolver)
+        filterUpdater.add_stage(pkgReceiver.early_dirty_channels, self.nChannels,
+                                pkgReceiver.get_current_early_filter_values, filterStorage.get_early_filter,
+                                Pose, self.early_convolver)
+        filterUpdater.add_stage(pkgReceiver.late_dirty_channels, self.nChannels,
+                                pkgReceiver.get_current_late_filter_values, filterStorage.get_late_filter,
+                                Pose, self.late_convolver)
+        filterUpdater.start()
+
+        return filterUpdater
+
+    def get_stage_block_size(self, stage):
+        """ Returns the block size a convolver stage runs at, 0 in the config means blockSize """
+        stage_block_size = self.config.get(stage + '_blockSize')
+        if stage_block_size == 0:
+            return self.blockSize
+
+        if stage_block_size < self.blockSize or stage_block_size % self.blockSize != 0:
+            self.log.warning("{}_blockSize must be a multiple of blockSize: using {}".format(stage, self.blockSize))
+            return self.blockSize
+
+        return stage_block_size
+
+    def get_partitioning(self, stage, ir_size):
+        """ Returns the non-uniform partitioning for a convolver stage or None for uniform partitioning """
+        partitioning = self.config.get(stage + '_partitioning[uniform/nonuniform]')
+
+        stage_block_size = self.get_stage_block_size(stage)
+        if self.numpy_engine:
+            if partitioning != 'uniform' or stage_block_size > self.blockSize:
+                self.log.warning("The numpy engine only supports uniform partitioning: ignored for {}".format(stage))
+            return None
+
+        if stage_block_size > self.blockSize:
+            if partitioning != 'uniform':
+                self.log.warning("{}_partitioning is ignored, since {}_blockSize is set".format(stage, stage))
+
+            if ir_size <= 2 * stage_block_size:
+                self.log.info("{} filter shorter than two blocks of {}: using blockSize".format(stage, stage_block_size))
+                return None
+
+            return multirate_partitioning(ir_size, self.blockSize, stage_block_size)
+
+        if partitioning == 'nonuniform':
+            return nonuniform_partitioning(ir_size, self.blockSize, self.config.get('maxPartitionSize'), threaded=True)
+
+        if partitioning != 'uniform':
+            self.log.warning("Unknown partitioning '{}' for {} convolver: using uniform".format(partitioning, stage))
+
+        return None
+
+    def create_input_buffer(self, inputs):
+        if self.numpy_engine:
+            return InputBufferNumpy(self.blockSize, inputs)
+
+        return InputBufferMulti(self.blockSize, inputs, self.config.get('torchConvolution[cpu/cuda]'))
+
+    def create_stereo_convolver(self, ir_size, interpolate):
+        """ Convolver with stereo input for source directivity or headphone filters """
+        if self.numpy_engine:
+            return ConvolverNumpy(ir_size, self.blockSize, True, 1, interpolate)
+
+        return ConvolverTorch(ir_size, self.blockSize, True, 1, interpolate,
+                              self.config.get('torchConvolution[cpu/cuda]'),
+                              matmul=self.matmul, lean_memory=self.config.get('leanMemory'),
+                              compile_mode=self.config.get('compileConvolution[none/script/compile]'))
+
+    def create_convolver(self, stage, ir_size, partitioning, fused=False):
+        # crossfading can be disabled for single stages
+        interpolate = self.config.get('enableCrossfading') and self.config.get(stage + '_enableCrossfading')
+
+        if self.numpy_engine:
+            if self.matmul or self.config.get(stage + '_lookahead'):
+                self.log.warning("matmul and look-ahead are not supported by the numpy engine")
+            return ConvolverNumpy(ir_size, self.blockSize, False, self.nChannels, interpolate)
+
+        # look-ahead is only supported by uniformly partitioned stages with their own FDL
+        lookahead = self.config.get(stage + '_lookahead')
+        if lookahead and (fused or partitioning is not None):
+            self.log.warning("{}_lookahead is ignored for fused or non-uniform partitioned stages".format(stage))
+            lookahead = False
+
+        if partitioning is None:
+            # fused stages use the FDL of the ConvolverFused
+            return ConvolverTorch(ir_size, self.blockSize, False, self.nChannels,
+                                  interpolate,
+                                  self.config.get('torchConvolution[cpu/cuda]'),
+                                  shared_fdl=fused, matmul=self.matmul,
+                                  lean_memory=self.config.get('leanMemory'),
+                                  lookahead=lookahead,
+                                  compile_mode=self.config.get('compileConvolution[none/script/compile]'),
+                                  thread_initializer=self.configure_audio_worker_thread)
+
+        # the tail segments are convolved on worker threads, otherwise the partitions of all segments ending in
+        # the same block would be convolved in that audio block. The callback waits at most half a block for a
+        # worker, which did not finish its partition in time, and uses silence instead.
+        return ConvolverNonUniform(ir_size, self.blockSize, False, self.nChannels,
+                                   interpolate,
+                                   self.config.get('torchConvolution[cpu/cuda]'),
+                                   partitioning, self.matmul, self.config.get('leanMemory'),
+                                   threaded_segments=True,
+                                   segment_timeout=0.5 * self.blockSize / self.sampleRate,
+                                   thread_initializer=self.configure_audio_worker_thread)
+
     def __cleanup(self):
         # Close everything when BinSim is finished
         #self.oscReceiver.close()
+        if self.render_thread:
+            self.render_thread.stop()
+        if self.strict_realtime or self.render_thread:
+            self.log.info("Blocks with clipping: {}, output buffer underruns: {}".format(self.clipped_blocks,
+                                                                                       self.underruns))
+        missed_partitions = sum(convolver.get_missed_partitions()
+                                for convolver in (self.ds_convolver, self.early_convolver, self.late_convolver)
+                                if isinstance(convolver, ConvolverNonUniform))
+        if missed_partitions:
+            self.log.warning("Tail partitions not convolved in time: {}".format(missed_partitions))
+        if self.config.get('disableAutomaticGc'):
+            gc.enable()
+        if self.filterUpdater:
+            self.filterUpdater.close()
+        if self.stage_executor:
+            self.stage_executor.shutdown()
         self.pkgReceiver.close()
         self.stream.close()
         self.filterStorage.close()
@@ -276,8 +698,13 @@ class BinSim(object):
         self.ds_convolver.close()
         self.early_convolver.close()
         self.late_convolver.close()
+        if self.fused_convolver:
+            self.fused_convolver.close()
+        if self.log_listener:
+            stop_deferred_logging(self.log_listener)
+            self.log_listener = None
 
-        if self.config.get('useHeadphoneFilter'):
+        if self.headphone_stage:
             if self.convolverHP:
                 self.convolverHP.close()
         
@@ -293,6 +720,11 @@ def audio_callback(binsim):
             import pydevd
             pydevd.settrace(suspend=False, trace_only_current_thread=True)
 
+        # the audio thread is created by the audio backend, so it is configured in its first callback
+        if callback.configure_audio_thread:
+            callback.configure_audio_thread = False
+            binsim.configure_audio_thread()
+
         # Update config
         #binsim.current_config = binsim.oscReceiver.get_current_config()
         binsim.current_config = binsim.pkgReceiver.get_current_config()
@@ -301,99 +733,105 @@ def audio_callback(binsim):
         if amount_channels == 0:
             return
 
+        # the SoundHandler fills the buffer shared with binsim.sound_block
         if binsim.current_config.get('pauseAudioPlayback'):
-            binsim.block = torch.as_tensor(binsim.soundHandler.get_zeros(), dtype=torch.float32)
+            binsim.soundHandler.get_zeros()
         else:
             loudness = callback.config.get('loudnessFactor')
-            binsim.block = torch.as_tensor(binsim.soundHandler.get_block(loudness), dtype=torch.float32)
+            binsim.soundHandler.get_block(loudness)
+        binsim.block = binsim.sound_block
 
         if binsim.current_config.get('pauseConvolution'):
             if amount_channels == 2:
-                binsim.result = binsim.block
+                binsim.output_view.copy_(binsim.block)
             else:
-                mix = torch.mean(binsim.block[:amount_channels, :], dim=0)
-                binsim.result[0, :] = mix
-                binsim.result[1, :] = mix
+                torch.mean(binsim.block[:amount_channels, :], dim=0, out=binsim.pause_result[0])
+                binsim.pause_result[1] = binsim.pause_result[0]
+                binsim.output_view.copy_(binsim.pause_result)
         else:
             input_buffers = binsim.input_Buffer.process(binsim.block)
 
-            for n in range(amount_channels):
-                if binsim.pkgReceiver.is_ds_filter_update_necessary(n):
-                    filterList = list()
-                    for sourceId in range(amount_channels):
-                        filterValueList = binsim.pkgReceiver.get_current_ds_filter_values(sourceId)
-                        filter = binsim.filterStorage.get_ds_filter(Pose.from_filterValueList(filterValueList))
-                        filterList.append(filter)
-                    binsim.ds_convolver.setAllFilters(filterList)
-                    break
-                    
-            for n in range(amount_channels):
-                if binsim.pkgReceiver.is_early_filter_update_necessary(n):
-                    filterList = list()
-                    for sourceId in range(amount_channels):
-                        filterValueList = binsim.pkgReceiver.get_current_early_filter_values(sourceId)
-                        filter = binsim.filterStorage.get_early_filter(Pose.from_filterValueList(filterValueList))
-                        filterList.append(filter)
-                    binsim.early_convolver.setAllFilters(filterList)
-                    break
-
-            for n in range(amount_channels):
-                if binsim.pkgReceiver.is_late_filter_update_necessary(n):
-                    filterList = list()
-                    for sourceId in range(amount_channels):
-                        filterValueList = binsim.pkgReceiver.get_current_late_filter_values(sourceId)
-                        filter = binsim.filterStorage.get_late_filter(Pose.from_filterValueList(filterValueList))
-                        filterList.append(filter)
-                    binsim.late_convolver.setAllFilters(filterList)
-                    break 
-           
-            ds = binsim.ds_convolver.process(input_buffers)
-            
-            for n in range(amount_channels):
-                if binsim.pkgReceiver.is_sd_filter_update_necessary(n):
-                    sd_filterList = list()
-                    for sourceId in range(amount_channels):
-                        filterValueList = binsim.pkgReceiver.get_current_sd_filter_values(sourceId)
-                        sd_filter = binsim.filterStorage.get_sd_filter(SourcePose.from_filterValueList(filterValueList))
-                        sd_filterList.append(sd_filter)
-                    binsim.sd_convolver.setAllFilters(sd_filterList)
-                    break
-            
-            # apply source directivity to ds block if needed
-            if callback.config.get('sd_convolverActive'):
-                sd_buffer = binsim.input_BufferSD.process(ds[:,0,:])
-                ds = binsim.sd_convolver.process(sd_buffer) # let's keep the name "ds" for now
-                 
-            early = binsim.early_convolver.process(input_buffers)
-            late = binsim.late_convolver.process(input_buffers)
-
-            # combine early and late into ds
-            ds.add_(early).add_(late)
-            binsim.result = ds[:,0,:]
+            # only update the filters of channels with new filter values, unless the FilterUpdater does it
+            if binsim.filterUpdater is None:
+                # the source directivity convolver has one stereo source, which uses the filter of channel 0
+                update_filters(binsim.pkgReceiver.sd_dirty_channels, 1,
+                               binsim.pkgReceiver.get_current_sd_filter_values, binsim.filterStorage.get_sd_filter,
+                               SourcePose, binsim.directivity_target.setFilter)
+                update_filters(binsim.pkgReceiver.ds_dirty_channels, amount_channels,
+                               binsim.pkgReceiver.get_current_ds_filter_values, binsim.get_ds_filter,
+                               Pose, binsim.ds_convolver.setFilter)
+                update_filters(binsim.pkgReceiver.early_dirty_channels, amount_channels,
+                               binsim.pkgReceiver.get_current_early_filter_values, binsim.filterStorage.get_early_filter,
+                               Pose, binsim.early_convolver.setFilter)
+                update_filters(binsim.pkgReceiver.late_dirty_channels, amount_channels,
+                               binsim.pkgReceiver.get_current_late_filter_values, binsim.filterStorage.get_late_filter,
+                               Pose, binsim.late_convolver.setFilter)
+
+            ds = binsim.process_source_stages(input_buffers, binsim.block)
+
+            # copy the result (from the device) to the preallocated output block
+            binsim.output_block.copy_(ds)
 
             # Finally apply Headphone Filter
-            if callback.config.get('useHeadphoneFilter'):
-                result_buffer = binsim.input_BufferHP.process(binsim.result)
-                binsim.result = binsim.convolverHP.process(result_buffer)[:,0,:]
+            if binsim.headphone_stage:
+                result_buffer = binsim.input_BufferHP.process(binsim.output_view)
+                binsim.output_block.copy_(binsim.convolverHP.process(result_buffer))
 
-        outdata[:] = np.transpose(binsim.result.detach().cpu().numpy())
+        binsim.result = binsim.output_view
+        np.copyto(outdata, binsim.output_numpy)
 
         # Report buffer underrun - Still working with sounddevice package?
+        if binsim.strict_realtime:
+            # only count, logging allocates
+            if status == 4:
+                binsim.underruns += 1
+            if outdata.max() > 1 or outdata.min() < -1:
+                binsim.clipped_blocks += 1
+            return
+
         if status == 4:
             binsim.log.warn('Output buffer underrun occurred')
 
         # Report clipping
-        if np.max(np.abs(outdata)) > 1:
+        if outdata.max() > 1 or outdata.min() < -1:
             binsim.log.warn('Clipping occurred: Adjust loudnessFactor!')
 
         binsim.time_usage[binsim.time_usage_index] = binsim.stream.cpu_load
         binsim.time_usage_index = (binsim.time_usage_index + 1) % len(binsim.time_usage)
 
         if binsim.ds_convolver.get_counter() % binsim.cpu_usage_update_rate == 0:
-            percentiles = np.percentile(binsim.time_usage, (0, 50, 100))
-            mean = np.mean(binsim.time_usage)
-            binsim.log.info(f'audio callback utilization: mean {mean:>6.2%} | min {percentiles[0]:>6.2%} | median {percentiles[1]:>6.2%} | max {percentiles[2]:>6.2%}')
+            # the statistics are computed when the record is formatted, with deferredLogging on the logging thread
+            binsim.log.info('audio callback utilization: %s', CallbackUtilization(binsim.time_usage.copy()))
 
     callback.config = binsim.config
+    callback.configure_audio_thread = True
+
+    return callback
+
+
+def ring_callback(binsim, render_thread):
+    """ Callback for the audio device, which only copies the frames rendered by the RenderThread """
+    assert isinstance(binsim, BinSim)
+    ring = render_thread.ring
+
+    def callback(outdata, frame_count, time_info, status):
+        if render_thread.failed:
+            raise sd.CallbackAbort
+
+        if ring.read(outdata) < frame_count:
+            # only count, reported on close
+            binsim.underruns += 1
 
     return callback
+
+
+class CallbackUtilization(object):
+    """ Statistics of the audio callback utilization, computed when converted to str """
+
+    def __init__(self, time_usage):
+        self.time_usage = time_usage
+
+    def __str__(self):
+        percentiles = np.percentile(self.time_usage, (0, 50, 100))
+        mean = np.mean(self.time_usage)
+        return f'mean {mean:>6.2%} | min {percentiles[0]:>6.2%} | median {percentiles[1]:>6.2%} | max {percentiles[2]:>6.2%}'
@@ -21,12 +21,45 @@
 # SOFTWARE.
 
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from timeit import default_timer
 from typing import List
 import math
 import torch
 
 from pybinsim.filterstorage import Filter
+from pybinsim.input_buffer import InputBufferMulti
+
+
+def spectra_zeros(channels: int, rows: int, bins: int, device, bins_first: bool = False):
+    """
+    Returns complex zeros of shape [channels, rows, bins]
+
+    :param bins_first: the returned tensor is a view of memory in the format [bins, channels, rows],
+                       which is needed by the batched matrix products of ConvolverTorch with matmul=True
+    """
+    if bins_first:
+        return torch.zeros(bins, channels, rows, dtype=torch.complex64, device=device).permute(1, 2, 0)
+
+    return torch.zeros(channels, rows, bins, dtype=torch.complex64, device=device)
+
+
+def convolve_block(filters_blocked, fdl, first: int, end: int, start: int, split: int, wrapped: int,
+                   block_size: int):
+    """
+    Multiply and accumulate filters_blocked[:, first:end] with the FDL ring from slot start on and return the
+    output block. Used by ConvolverTorch for compiled processing, see ConvolverTorch.multiply_accumulate.
+    """
+    result = torch.sum(filters_blocked[:, first:first + split] * fdl[:, start:start + split], dim=1, keepdim=True)
+    result += torch.sum(filters_blocked[:, first + split:end] * fdl[:, :wrapped], dim=1, keepdim=True)
+    return torch.fft.irfft(result, n=2 * block_size, dim=2)[:, :, block_size:]
+
+
+def tensor_bytes(tensors):
+    """ Returns the memory used by the storages of tensors in bytes, None entries are skipped """
+    return sum(tensor.untyped_storage().nbytes() for tensor in tensors if tensor is not None)
+
 
 class ConvolverTorch(object):
     """
@@ -34,7 +67,9 @@ class ConvolverTorch(object):
     with a BRIRsor HRTF
     """
 
-    def __init__(self, ir_size: int, block_size: int, stereoInput: bool, sources: int, interpolate: bool, torch_settings: str):
+    def __init__(self, ir_size: int, block_size: int, stereoInput: bool, sources: int, interpolate: bool, torch_settings: str,
+                 shared_fdl: bool = False, matmul: bool = False, lean_memory: bool = False, lookahead: bool = False,
+                 compile_mode: str = 'none', thread_initializer=None):
         start = default_timer()
 
         self.log = logging.getLogger("pybinsim.ConvolverTorch")
@@ -62,41 +97,143 @@ class ConvolverTorch(object):
         self.crossFadeIn = torch.as_tensor(crossFadeIn, dtype=torch.float32, device=self.torch_device)
         self.crossFadeOut = torch.as_tensor(crossFadeOut, dtype=torch.float32, device=self.torch_device)
 
+        # Multiply and accumulate with batched matrix products instead of elementwise products and a sum.
+        # The filters, the FDL and the results are then stored with the frequency bins first.
+        self.matmul = matmul
+
         # Filter format: [2, nBlocks*sources, blockSize+1] (2 for left, right)
-        self.filters_blocked = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1, dtype=torch.complex64,
-                                           device=self.torch_device)
-        
-        self.filters_cpu = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1, dtype=torch.complex64,
-                                           device="cpu")
+        self.filters_blocked = spectra_zeros(2, self.IR_blocks*self.sources, self.block_size + 1, self.torch_device,
+                                             self.matmul)
+
+        # Pinned memory for the asynchronous transfer of filters stored on the CPU to the GPU.
+        # Not needed when convolving on the CPU, the filters are then copied directly.
+        # The copies are asynchronous, filters_cpu_event is recorded after them and waited for before
+        # filters_cpu is written again.
+        self.filters_cpu = None
+        self.filters_cpu_event = None
         if self.torch_device.type == "cuda":
-            self.filters_cpu = self.filters_cpu.pin_memory()
+            self.filters_cpu = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1, dtype=torch.complex64,
+                                           device="cpu").pin_memory()
+            self.filters_cpu_event = torch.cuda.Event()
+
+        # Elementwise products of filters and FDL, not needed with matmul
+        self.complex_buffer = None
+        if not self.matmul:
+            self.complex_buffer = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1, dtype=torch.complex64,
+                                              device=self.torch_device)
+
+        self.interpolate = interpolate
+
+        # Filter objects currently set for each source and sources whose filter changed since the last block
+        self.current_filters = [None] * self.sources
+        self.changed_sources = []
 
-        self.complex_buffer = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1, dtype=torch.complex64,
-                                           device=self.torch_device)
+        # Filter objects and spectra of the last processed block; only valid for the sources in changed_sources.
+        # With lean_memory, the spectra for crossfading are taken from the previous Filter objects instead of a copy.
+        self.lean_memory = lean_memory
+        self.previous_filters = [None] * self.sources
+        self.previous_filters_blocked = None
+        if self.interpolate and not self.lean_memory:
+            self.previous_filters_blocked = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1,
+                                                        dtype=torch.complex64, device=self.torch_device)
 
-        self.previous_filters_blocked = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1, dtype=torch.complex64,
-                                           device=self.torch_device)
+        # filter segment passed to setFilter (only != 0 for the tail of non-uniform partitioned filters)
+        self.filter_segment = 0
 
-        self.temp = self.previous_filters_blocked
+        # Filters of a FilterBank are not copied by _applyFilter, but copied from their banks for all changed
+        # sources before the next block (see gatherFilters).
+        # format: {source index: (bank segment, bank row)} and sources whose previous filter is still to be kept
+        self.bank_filters = {}
+        self.bank_previous_sources = []
 
-        self.frequency_domain_input = torch.zeros(2, self.IR_blocks*self.sources, self.block_size + 1, dtype=torch.complex64,
-                               device=self.torch_device)
+        # Range (first, end) of the filter partitions, which are not silent (see Filter.getActivePartitions),
+        # for each source and for all sources. Partitions outside of active_partitions are skipped.
+        self.partition_ranges = [(0, 0)] * self.sources
+        self.active_partitions = (0, 0)
+
+        # Double buffered staging of filters prepared on another thread (see stageFilter). The buffers are only
+        # created, when filters stored on the CPU have to be transferred to the GPU.
+        # Only the preparing thread writes staging_buffers and staged_filters. A published update is handed over
+        # by assigning pending_filters, which is only reset by the audio thread after the update was applied.
+        # The audio thread copies from a staging buffer asynchronously and records staging_events[i] after the
+        # copies from buffer i, which stageFilter waits for before writing the buffer again.
+        self.staging_buffers = None
+        self.staging_events = None
+        self.staging_index = 0
+        self.staged_filters = {}
+        self.pending_filters = None
+        self.pending_staging_index = 0
+
+        # Frequency domain delay line (FDL) as ring buffer: [1 or 2, nBlocks*sources, blockSize+1]
+        # Mono input is stored once and used for both ears
+        # With shared_fdl, the FDL is owned by ConvolverFused and process() must not be used
+        self.fdl_channels = 2 if self.stereoInput else 1
+        self.frequency_domain_input = None
+        if not shared_fdl:
+            self.frequency_domain_input = spectra_zeros(self.fdl_channels, self.IR_blocks*self.sources,
+                                                        self.block_size + 1, self.torch_device, self.matmul)
+
+        # Slot of the most recent input block. The position moves backwards, so filter partition p meets
+        # the input of p blocks ago at slot (fdl_position + p) % nBlocks
+        self.fdl_position = 0
 
         # Arrays for the result of the complex multiply and add
-        self.resultFreq = torch.zeros(2, 1, self.block_size + 1, dtype=torch.complex64, device=self.torch_device)
+        self.resultFreq = spectra_zeros(2, 1, self.block_size + 1, self.torch_device, self.matmul)
+        self.differenceFreq = None
+        if self.interpolate:
+            self.differenceFreq = torch.zeros(2, 1, self.block_size + 1, dtype=torch.complex64, device=self.torch_device)
+
+        # Crossfade buffers for one changed source: filter difference and its products with the FDL
+        # [2, nBlocks, blockSize+1] and their sum [2, 1, blockSize+1] (see accumulate_crossfade_difference)
+        self.crossfade_difference = None
+        self.crossfade_products = None
+        self.crossfade_sum = None
+        if self.interpolate:
+            self.crossfade_difference = torch.zeros(2, self.IR_blocks, self.block_size + 1, dtype=torch.complex64,
+                                                    device=self.torch_device)
+            self.crossfade_products = torch.zeros_like(self.crossfade_difference)
+            self.crossfade_sum = torch.zeros(2, 1, self.block_size + 1, dtype=torch.complex64, device=self.torch_device)
 
         # Result of the ifft is stored here
         self.outputEmpty = torch.zeros(2, 1, self.block_size, dtype=torch.float32, device=self.torch_device)
 
         self.irfft_buffer1 = torch.zeros(2, 1, self.block_size*2, dtype=torch.float32, device=self.torch_device)
-        self.irfft_buffer2 = torch.zeros(2, 1, self.block_size*2, dtype=torch.float32, device=self.torch_device)
+        self.irfft_buffer2 = None
+        if self.interpolate:
+            self.irfft_buffer2 = torch.zeros(2, 1, self.block_size*2, dtype=torch.float32, device=self.torch_device)
 
         # Counts how often process() is called
         self.processCounter = 0
 
         self.active = True
 
-        self.interpolate = interpolate
+        # Look-ahead: the partitions 1.. of the next block only depend on past input. They are accumulated on a
+        # helper thread after each block, so process() only computes partition 0 unless the filters changed.
+        self.lookahead = lookahead and not shared_fdl
+        self.lookahead_freq = None
+        self.partition0_buffer = None
+        if self.lookahead:
+            self.lookahead_freq = spectra_zeros(2, 1, self.block_size + 1, self.torch_device, self.matmul)
+            # FDL position the look-ahead was computed for, -1 if not available
+            self.lookahead_position = -1
+            # products of partition 0, complex_buffer is used by the helper thread
+            if not self.matmul:
+                self.partition0_buffer = torch.zeros(2, self.sources, self.block_size + 1, dtype=torch.complex64,
+                                                     device=self.torch_device)
+            self.lookahead_request = threading.Event()
+            self.lookahead_done = threading.Event()
+            self.lookahead_done.set()
+            self.lookahead_running = True
+            # called first on the helper thread, e.g. to give it the scheduling of the audio thread
+            self.thread_initializer = thread_initializer
+            self.lookahead_thread = threading.Thread(target=self.run_lookahead, name="pybinsim-lookahead")
+            self.lookahead_thread.daemon = True
+            self.lookahead_thread.start()
+
+        # Compiled multiply, accumulate and irfft of a block (see convolve_block), None for op by op processing
+        self.compiled_block = None
+        if compile_mode != 'none' and not shared_fdl:
+            self.compiled_block = self.compile_block(compile_mode)
 
         end = default_timer()
         delta = end - start
@@ -109,64 +246,880 @@ class ConvolverTorch(object):
         """
         return self.processCounter
 
-    def setAllFilters(self, filters: List[Filter]):
-        self.saveOldFilters()
-        # start copy on GPU
-        # ready temp with current values and make current, previous will just keep the current values
-        self.temp.copy_(self.filters_blocked, non_blocking=True)
+    def compile_block(self, compile_mode):
+        """
+        Compile convolve_block with TorchScript ('script') or torch.compile ('compile')
+
+        :return: compiled function or None, if the compilation failed
+        """
+        if self.matmul:
+            self.log.warning("Compiled convolution is not supported with matmul: processing op by op")
+            return None
+
+        try:
+            if compile_mode == 'script':
+                compiled_block = torch.jit.script(convolve_block)
+            elif compile_mode == 'compile':
+                compiled_block = torch.compile(convolve_block, dynamic=True)
+            else:
+                self.log.warning("Unknown compile mode '{}': processing op by op".format(compile_mode))
+                return None
+
+            # compile now instead of in the first audio block, with and without wrapping around the FDL
+            rows = self.IR_blocks * self.sources
+            compiled_block(self.filters_blocked, self.frequency_domain_input, 0, rows, 0, rows, 0, self.block_size)
+            compiled_block(self.filters_blocked, self.frequency_domain_input, 0, rows, self.sources,
+                           rows - self.sources, self.sources, self.block_size)
+        except Exception as e:
+            self.log.warning("Compiling the convolution failed, processing op by op: {}".format(e))
+            return None
+
+        return compiled_block
+
+    def get_memory_footprint(self):
+        """
+        Returns the memory used by the buffers of the convolver in bytes.
+        Filters referenced from the FilterStorage and a shared FDL are not included.
+        """
+        tensors = [self.filters_blocked, self.filters_cpu, self.complex_buffer, self.previous_filters_blocked,
+                   self.frequency_domain_input, self.resultFreq, self.differenceFreq, self.outputEmpty,
+                   self.irfft_buffer1, self.irfft_buffer2, self.lookahead_freq, self.partition0_buffer,
+                   self.crossfade_difference, self.crossfade_products, self.crossfade_sum]
+        if self.staging_buffers is not None:
+            tensors += self.staging_buffers
+
+        return tensor_bytes(tensors)
+
+    def setAllFilters(self, filters: List[Filter], segment: int = 0):
+        """
+        Set filters for all sources
 
-        # swap previous and current
-        self.filters_blocked = self.temp
-        # make sure previous is still kept in temp, so we can later reassign previous
-        self.temp = self.previous_filters_blocked
+        :param filters: one filter per source
+        :param segment: filter segment to use (only != 0 for the tail of non-uniform partitioned filters)
+        """
+        # crossfade from the filters set before this call
+        self.gatherFilters()
+        self.changed_sources.clear()
 
-        # assemble new filter Tensors on CPU in pinned memory
         for i in range(self.sources):
-            self.filters_cpu[:, i::self.sources, :] = filters[i].getFilterFD()
+            self.setFilter(i, filters[i], segment)
+
+    def setFilter(self, source_index: int, filter: Filter, segment: int = 0):
+        """
+        Set filter for a single source
+
+        :param source_index: index of the source
+        :param filter: new filter
+        :param segment: filter segment to use (only != 0 for the tail of non-uniform partitioned filters)
+        """
+        # only copy filters which actually changed
+        if filter is self.current_filters[source_index]:
+            return
+
+        filter_fd = filter.getFilterFD(segment)
+
+        if self.filters_cpu is not None and filter_fd.device.type == "cpu":
+            # assemble new filter Tensors on CPU in pinned memory, once the last transfer from it is finished
+            self.filters_cpu_event.synchronize()
+            source = slice(source_index, None, self.sources)
+            self.filters_cpu[:, source, :] = filter_fd
+            filter_fd = self.filters_cpu[:, source, :]
+
+            self.filter_segment = segment
+            self._applyFilter(source_index, filter, filter_fd)
+            self.filters_cpu_event.record()
+            return
+
+        self.filter_segment = segment
+        self._applyFilter(source_index, filter, filter_fd)
+
+    def stageFilter(self, source_index: int, filter: Filter, segment: int = 0):
+        """
+        Prepare filter for a single source without changing the filters in use.
+        Staged filters are used after publishFilters() from the next processed block on.
+        Must only be called from one thread, which is not the audio thread.
+
+        :param source_index: index of the source
+        :param filter: new filter
+        :param segment: filter segment to use (only != 0 for the tail of non-uniform partitioned filters)
+        """
+        filter_fd = filter.getFilterFD(segment)
+
+        if self.filters_cpu is not None and filter_fd.device.type == "cpu":
+            if self.staging_buffers is None:
+                self.staging_buffers = [torch.zeros_like(self.filters_cpu).pin_memory() for _ in range(2)]
+                self.staging_events = [torch.cuda.Event() for _ in range(2)]
+
+            # assemble new filter Tensors in the staging buffer, which is not read by the audio thread.
+            # The transfer of the last update staged in this buffer may still be running.
+            self.staging_events[self.staging_index].synchronize()
+            source = slice(source_index, None, self.sources)
+            self.staging_buffers[self.staging_index][:, source, :] = filter_fd
+            filter_fd = self.staging_buffers[self.staging_index][:, source, :]
+
+        # otherwise the spectrum of the filter object itself is handed over without a copy
+        self.filter_segment = segment
+        self.staged_filters[source_index] = (filter, filter_fd)
+
+    def publishFilters(self):
+        """
+        Hand the staged filters over to the audio thread.
+        Must only be called from the thread calling stageFilter().
+
+        :return: False if the last published filters were not picked up yet and the staged filters are kept
+        """
+        if not self.staged_filters:
+            return True
+
+        if self.pending_filters is not None:
+            return False
+
+        self.pending_staging_index = self.staging_index
+        self.pending_filters = self.staged_filters
+
+        # stage the next filters in the other buffer, while this one is read by the audio thread
+        self.staging_index = 1 - self.staging_index
+        self.staged_filters = {}
+
+        return True
+
+    def applyPendingFilters(self):
+        """ Use the filters published by publishFilters(). Called by the audio thread before processing a block """
+        pending = self.pending_filters
+        if pending is not None:
+            for source_index, (filter, filter_fd) in pending.items():
+                self._applyFilter(source_index, filter, filter_fd)
+
+            # the staging buffer may only be written again after the copies from it (see stageFilter)
+            if self.staging_events is not None:
+                self.staging_events[self.pending_staging_index].record()
+
+            self.pending_filters = None
+
+        self.gatherFilters()
+
+    def _applyFilter(self, source_index: int, filter: Filter, filter_fd):
+        if filter is self.current_filters[source_index]:
+            return
+
+        bank_segment = None
+        if filter.bank is not None and not self.matmul:
+            bank_segment = filter.bank.segments[self.filter_segment]
+            if (bank_segment.device != self.filters_blocked.device
+                    or bank_segment.shape[1:] != (2, self.IR_blocks, self.block_size + 1)):
+                bank_segment = None
+
+        if bank_segment is None and self.bank_filters:
+            # deferred filters must not overwrite this filter
+            self.gatherFilters()
+
+        source = slice(source_index, None, self.sources)
+
+        if source_index not in self.changed_sources:
+            # keep the filter of the last processed block for crossfading in the next block
+            if self.previous_filters_blocked is not None:
+                if bank_segment is None:
+                    self.previous_filters_blocked[:, source, :] = self.filters_blocked[:, source, :]
+                else:
+                    self.bank_previous_sources.append(source_index)
+            self.previous_filters[source_index] = self.current_filters[source_index]
+            self.changed_sources.append(source_index)
 
-        # write new filters to GPU
-        self.filters_blocked.copy_(self.filters_cpu, non_blocking=True)
+        if bank_segment is None:
+            # write new filters to GPU
+            self.filters_blocked[:, source, :].copy_(filter_fd, non_blocking=True)
+        else:
+            self.bank_filters[source_index] = (bank_segment, filter.bank_index)
+
+        self.current_filters[source_index] = filter
+
+        self.partition_ranges[source_index] = filter.getActivePartitions(self.filter_segment)
+        ranges = [partition_range for partition_range in self.partition_ranges if partition_range[0] < partition_range[1]]
+        if ranges:
+            self.active_partitions = (min(first for first, _ in ranges),
+                                      min(max(end for _, end in ranges), self.IR_blocks))
+        else:
+            self.active_partitions = (0, 0)
+
+    def gatherFilters(self):
+        """
+        Write the filters deferred by _applyFilter from their filter banks. Only the last filter set for a source
+        before a block is copied. The rows are copied one by one, a batched index_select would allocate.
+        """
+        if not self.bank_filters:
+            return
+
+        # view with partitions and sources as separate dimensions: [2, nBlocks, sources, blockSize+1]
+        filters = self.filters_blocked.view(2, self.IR_blocks, self.sources, self.block_size + 1)
+
+        if self.bank_previous_sources:
+            previous = self.previous_filters_blocked.view(2, self.IR_blocks, self.sources, self.block_size + 1)
+            for source_index in self.bank_previous_sources:
+                previous[:, :, source_index].copy_(filters[:, :, source_index])
+            self.bank_previous_sources.clear()
+
+        for source_index, (bank_segment, row) in self.bank_filters.items():
+            filters[:, :, source_index].copy_(bank_segment[row], non_blocking=True)
 
-    def saveOldFilters(self):
-        self.previous_filters_blocked = self.filters_blocked
+        self.bank_filters.clear()
+
+    def process(self, input_buffer, block=None):
+        # block (time domain input) is only needed by ConvolverNonUniform and ignored here
+        self.applyPendingFilters()
 
-    def process(self, input_buffer):
         if not self.active:
             return self.outputEmpty
 
-        # shift frequency_domain_inputs
-        self.frequency_domain_input = torch.roll(self.frequency_domain_input, self.sources, dims=1)
+        # advance the write position instead of shifting the whole FDL
+        self.fdl_position = (self.fdl_position - 1) % self.IR_blocks
+        start = self.fdl_position * self.sources
 
         # copy input buffers to frequency_domain_inputs
         if self.stereoInput:
-            self.frequency_domain_input[0, :self.sources, :] = input_buffer[0,:]
-            self.frequency_domain_input[1, :self.sources, :] = input_buffer[1,:]
+            self.frequency_domain_input[:, start, :] = input_buffer
         else:
-            self.frequency_domain_input[0, :self.sources, :] = input_buffer
-            self.frequency_domain_input[1, :self.sources, :] = input_buffer
+            self.frequency_domain_input[0, start:start + self.sources, :] = input_buffer
 
-        output = self.multiply_accumulate_ifft(self.filters_blocked, self.irfft_buffer1)
+        if self.compiled_block is not None and not self.lookahead:
+            output = self.convolve_compiled()
+        else:
+            if self.lookahead:
+                self.multiply_accumulate_lookahead()
+            else:
+                self.multiply_accumulate(self.filters_blocked, self.frequency_domain_input, self.fdl_position,
+                                         self.resultFreq)
+            output = torch.fft.irfft(self.resultFreq, out=self.irfft_buffer1, dim=2)[:, :, self.block_size:]
 
-        if self.interpolate:
-            output_previous = self.multiply_accumulate_ifft(self.previous_filters_blocked, self.irfft_buffer2)
-            output.mul_(self.crossFadeIn)
-            output_previous.mul_(self.crossFadeOut)
-            output.add_(output_previous)
+        # crossfade only in the block after a filter change
+        if self.interpolate and self.changed_sources:
+            self.accumulate_crossfade_difference(self.frequency_domain_input, self.fdl_position, self.differenceFreq)
+            output_difference = torch.fft.irfft(self.differenceFreq, out=self.irfft_buffer2, dim=2)[:, :, self.block_size:]
+            output.addcmul_(output_difference, self.crossFadeOut)
 
-        # Save previous filters
-        self.saveOldFilters()
+        self.changed_sources.clear()
 
         self.processCounter += 1
 
+        if self.lookahead:
+            # start accumulating the next block while the audio callback finishes
+            self.lookahead_done.clear()
+            self.lookahead_request.set()
+
         return output
 
-    def multiply_accumulate_ifft(self, filters_blocked, irfft_buffer):
-            torch.multiply(filters_blocked, self.frequency_domain_input, out=self.complex_buffer)
-            
-            # accumulate over blocks and channels for each time and left/right
-            torch.sum(self.complex_buffer, keepdim=True, dim=1, out=self.resultFreq)
+    def convolve_compiled(self):
+        """ Output block of the current filters with compiled_block """
+        first = self.active_partitions[0] * self.sources
+        end = self.active_partitions[1] * self.sources
+        if first >= end:
+            return self.irfft_buffer1[:, :, self.block_size:].zero_()
+
+        start, split, wrapped = self.ring_slices(self.frequency_domain_input, self.fdl_position, first, end)
+        return self.compiled_block(self.filters_blocked, self.frequency_domain_input, first, end, start, split,
+                                   wrapped, self.block_size)
+
+    def multiply_accumulate_lookahead(self):
+        """ multiply_accumulate for the current block using the partitions accumulated by the helper thread """
+        if self.changed_sources:
+            # the look-ahead was computed with the previous filters
+            self.lookahead_done.wait()
+            self.multiply_accumulate(self.filters_blocked, self.frequency_domain_input, self.fdl_position,
+                                     self.resultFreq)
+            return
+
+        first, end = self.active_partitions
+        partition0 = (0, 1) if first == 0 < end else (0, 0)
+        self.multiply_accumulate(self.filters_blocked, self.frequency_domain_input, self.fdl_position,
+                                 self.resultFreq, partition0, self.partition0_buffer)
+
+        self.lookahead_done.wait()
+        if self.lookahead_position == self.fdl_position:
+            self.resultFreq.add_(self.lookahead_freq)
+        else:
+            # no look-ahead for this block, e.g. the first block
+            self.multiply_accumulate(self.filters_blocked, self.frequency_domain_input, self.fdl_position,
+                                     self.resultFreq)
+
+    def run_lookahead(self):
+        """ Helper thread accumulating the partitions 1.. for the next block """
+        if self.thread_initializer is not None:
+            self.thread_initializer()
+
+        while True:
+            self.lookahead_request.wait()
+            self.lookahead_request.clear()
+            if not self.lookahead_running:
+                break
+
+            # the next input block is written to the slot before the current one, which only meets partition 0
+            position = (self.fdl_position - 1) % self.IR_blocks
+            first, end = self.active_partitions
+            self.multiply_accumulate(self.filters_blocked, self.frequency_domain_input, position,
+                                     self.lookahead_freq, (max(first, 1), end))
+            self.lookahead_position = position
+
+            self.lookahead_done.set()
+
+    def multiply_accumulate(self, filters_blocked, fdl, fdl_position, result, partitions=None, buffer=None):
+        """
+        Multiply the filters with the FDL and accumulate over blocks and sources
+
+        :param filters_blocked: filters in the format of filters_blocked
+        :param fdl: FDL ring buffer with at least IR_blocks slots
+        :param fdl_position: slot of the most recent input block in the FDL
+        :param result: spectrum [2, 1, blockSize+1] for the result
+        :param partitions: range (first, end) of the partitions to accumulate, defaults to active_partitions
+        :param buffer: buffer for the elementwise products, defaults to complex_buffer
+        """
+        # only partitions which are not silent for all sources are processed
+        if partitions is None:
+            partitions = self.active_partitions
+        if buffer is None:
+            buffer = self.complex_buffer
+
+        first = partitions[0] * self.sources
+        end = partitions[1] * self.sources
+        if first >= end:
+            result.zero_()
+            return
+
+        start, split, wrapped = self.ring_slices(fdl, fdl_position, first, end)
+
+        if self.matmul:
+            self.matmul_accumulate(filters_blocked[:, first:end, :], fdl, start, split, wrapped, result)
+            return
+
+        torch.multiply(filters_blocked[:, first:first + split, :], fdl[:, start:start + split, :],
+                       out=buffer[:, :split, :])
+        torch.multiply(filters_blocked[:, first + split:end, :], fdl[:, :wrapped, :],
+                       out=buffer[:, split:end - first, :])
+
+        # accumulate over blocks and channels for each time and left/right
+        torch.sum(buffer[:, :end - first, :], keepdim=True, dim=1, out=result)
+
+    def ring_slices(self, fdl, fdl_position, first, end):
+        """
+        The first filter partitions meet the FDL from the write position on,
+        the remaining partitions wrap around to the start of the FDL
+
+        :return: FDL row meeting filter row first, number of rows up to the end of the FDL, number of wrapped rows
+        """
+        start = (fdl_position * self.sources + first) % fdl.shape[1]
+        split = min(end - first, fdl.shape[1] - start)
+        wrapped = end - first - split
+
+        return start, split, wrapped
+
+    def matmul_accumulate(self, filters_blocked, fdl, start, split, wrapped, result):
+        """
+        multiply_accumulate as one matrix product [2, nBlocks*sources] x [nBlocks*sources, 1] per frequency bin,
+        so the elementwise products are never stored. The tensors should be created with bins_first=True.
+        """
+        bins = result.shape[2]
+        filters_blocked = filters_blocked.permute(2, 0, 1)
+        fdl = fdl.permute(2, 0, 1)
+        result = result.permute(2, 0, 1)
+
+        if fdl.shape[1] == 2:
+            # stereo input: one product [1, nBlocks] x [nBlocks, 1] per bin and ear
+            filters_blocked = filters_blocked.reshape(bins * 2, 1, -1)
+            fdl = fdl.reshape(bins * 2, 1, -1)
+            result = result.reshape(bins * 2, 1, 1)
+
+        fdl = fdl.transpose(1, 2)
+
+        torch.bmm(filters_blocked[:, :, :split], fdl[:, start:start + split, :], out=result)
+        if wrapped:
+            result.baddbmm_(filters_blocked[:, :, split:], fdl[:, :wrapped, :])
+
+    def accumulate_crossfade_difference(self, fdl, fdl_position, result):
+        """
+        Spectrum of the difference between previous and current filters for the sources in changed_sources.
+
+        Since crossFadeIn + crossFadeOut == 1 and unchanged sources have identical previous and current filters,
+        output * crossFadeIn + output_previous * crossFadeOut == output + crossFadeOut * output_difference,
+        where only the changed sources contribute to output_difference.
+        The sources are accumulated one by one into preallocated buffers, so no tensors are allocated.
+        """
+        fdl = fdl.view(fdl.shape[0], -1, self.sources, self.block_size + 1)
+
+        # align filter partitions with the FDL ring (see multiply_accumulate)
+        split = min(self.IR_blocks, fdl.shape[1] - fdl_position)
+        wrapped = self.IR_blocks - split
+
+        result.zero_()
+        for source_index in self.changed_sources:
+            difference = self.filter_difference(source_index)
+            torch.mul(difference[:, :split], fdl[:, fdl_position:fdl_position + split, source_index],
+                      out=self.crossfade_products[:, :split])
+            torch.mul(difference[:, split:], fdl[:, :wrapped, source_index], out=self.crossfade_products[:, split:])
+            torch.sum(self.crossfade_products, dim=1, keepdim=True, out=self.crossfade_sum)
+            result.add_(self.crossfade_sum)
+
+    def filter_difference(self, source_index):
+        """ Spectrum [2, nBlocks, blockSize+1] of the previous minus the current filter of a source """
+        if self.previous_filters_blocked is not None:
+            previous = self.previous_filters_blocked.view(2, self.IR_blocks, self.sources, -1)[:, :, source_index]
+            current = self.filters_blocked.view(2, self.IR_blocks, self.sources, -1)[:, :, source_index]
+            return torch.sub(previous, current, out=self.crossfade_difference)
+
+        # lean_memory: the spectra are taken from the Filter objects
+        current = self.current_filters[source_index].getFilterFD(self.filter_segment).to(self.torch_device)
+        previous = self.previous_filters[source_index]
+
+        # the first filter fades in from silence
+        if previous is None:
+            return torch.neg(current, out=self.crossfade_difference)
+
+        return torch.sub(previous.getFilterFD(self.filter_segment).to(self.torch_device), current,
+                         out=self.crossfade_difference)
+
+    def close(self):
+        self.log.info("Convolver: close")
+        if self.lookahead:
+            self.lookahead_running = False
+            self.lookahead_request.set()
+            self.lookahead_thread.join()
+
+
+class ConvolverFused(object):
+    """
+    Class for convolving several stages (e.g. direct sound, early and late filters) of mono sources at once.
+
+    Stages created with shared_fdl=True share one FDL, are accumulated in the frequency domain and
+    need only one inverse FFT. Other stages (e.g. ConvolverNonUniform) are processed on their own
+    and added in the time domain.
+    """
+
+    def __init__(self, stages, block_size: int, sources: int, torch_settings: str):
+        start = default_timer()
+
+        self.log = logging.getLogger("pybinsim.ConvolverFused")
+        self.log.info("Convolver: Start Init")
+
+        # Torch options
+        self.torch_device = torch.device(torch_settings)
+
+        self.block_size = block_size
+        self.sources = sources
+
+        self.fused_stages = [stage for stage in stages if isinstance(stage, ConvolverTorch) and stage.frequency_domain_input is None]
+        self.other_stages = [stage for stage in stages if stage not in self.fused_stages]
+
+        # one FDL long enough for the longest fused stage
+        self.fdl_blocks = max([stage.IR_blocks for stage in self.fused_stages], default=1)
+        matmul = any(stage.matmul for stage in self.fused_stages)
+        self.frequency_domain_input = spectra_zeros(1, self.fdl_blocks*self.sources, self.block_size + 1,
+                                                    self.torch_device, matmul)
+        self.fdl_position = 0
+
+        self.resultFreq = torch.zeros(2, 1, self.block_size + 1, dtype=torch.complex64, device=self.torch_device)
+        self.differenceFreq = torch.zeros(2, 1, self.block_size + 1, dtype=torch.complex64, device=self.torch_device)
+
+        self.irfft_buffer1 = torch.zeros(2, 1, self.block_size*2, dtype=torch.float32, device=self.torch_device)
+        self.irfft_buffer2 = torch.zeros(2, 1, self.block_size*2, dtype=torch.float32, device=self.torch_device)
+
+        # all stages use the same block size and therefore the same crossfade
+        self.crossFadeOut = self.fused_stages[0].crossFadeOut if self.fused_stages else None
+
+        # Counts how often process() is called
+        self.processCounter = 0
+
+        end = default_timer()
+        delta = end - start
+        self.log.info("Convolver: Finished Init (took {}s)".format(delta))
+
+    def get_counter(self):
+        """
+        Returns processing counter
+        :return: processing counter
+        """
+        return self.processCounter
+
+    def get_memory_footprint(self):
+        """
+        Returns the memory used by the shared FDL and the buffers of the fused convolver in bytes.
+        The memory of the stages is reported by the stages.
+        """
+        return tensor_bytes([self.frequency_domain_input, self.resultFreq, self.differenceFreq,
+                             self.irfft_buffer1, self.irfft_buffer2])
+
+    def process(self, input_buffer, block=None):
+        """
+        Main function
+
+        :param input_buffer: input spectra from InputBufferMulti
+        :param block: time domain input block (needed by stages which are not fused)
+        :return: sum of all active stages
+        """
+        # advance the write position of the shared FDL
+        self.fdl_position = (self.fdl_position - 1) % self.fdl_blocks
+        start = self.fdl_position * self.sources
+        self.frequency_domain_input[0, start:start + self.sources, :] = input_buffer
+
+        self.resultFreq.zero_()
+        crossfade = False
+
+        for stage in self.fused_stages:
+            stage.applyPendingFilters()
+
+            if stage.active:
+                stage.multiply_accumulate(stage.filters_blocked, self.frequency_domain_input, self.fdl_position,
+                                          stage.resultFreq)
+                self.resultFreq.add_(stage.resultFreq)
+
+                if stage.interpolate and stage.changed_sources:
+                    if not crossfade:
+                        self.differenceFreq.zero_()
+                        crossfade = True
+                    stage.accumulate_crossfade_difference(self.frequency_domain_input, self.fdl_position,
+                                                          stage.differenceFreq)
+                    self.differenceFreq.add_(stage.differenceFreq)
+
+                stage.processCounter += 1
+
+            stage.changed_sources.clear()
+
+        output = torch.fft.irfft(self.resultFreq, out=self.irfft_buffer1, dim=2)[:, :, self.block_size:]
+
+        if crossfade:
+            output_difference = torch.fft.irfft(self.differenceFreq, out=self.irfft_buffer2, dim=2)[:, :, self.block_size:]
+            output.addcmul_(output_difference, self.crossFadeOut)
+
+        for stage in self.other_stages:
+            output.add_(stage.process(input_buffer, block))
+
+        self.processCounter += 1
+
+        return output
+
+    def close(self):
+        self.log.info("Convolver: close")
+
+
+def nonuniform_partitioning(ir_size: int, block_size: int, max_partition_size: int, threaded: bool = False):
+    """
+    Creates a non-uniform partitioning of a filter with ir_size samples.
+
+    Starting with block_size, two partitions of each size are used and the partition size
+    is doubled until max_partition_size is reached. The remaining filter is covered with
+    partitions of the largest size. Every segment starts at least one partition size into
+    the filter, so its output is ready in time without additional latency.
+
+    :param threaded: the tail segments are convolved on worker threads, which return their output one partition
+                     later (see TailSegment). Four partitions of block_size are used, so every segment starts at
+                     least two partition sizes into the filter.
+    :return: list of (partition size, partition count) tuples
+    """
+    partitioning = []
+    covered = 0
+    partition_size = block_size
+
+    while covered < ir_size:
+        can_grow = partition_size * 2 <= max_partition_size
+        partition_count = -(-(ir_size - covered) // partition_size)
+        if can_grow:
+            partition_count = min(partition_count, 4 if threaded and not partitioning else 2)
+
+        partitioning.append((partition_size, partition_count))
+        covered += partition_size * partition_count
+
+        if can_grow:
+            partition_size *= 2
+
+    return partitioning
+
+
+def multirate_partitioning(ir_size: int, block_size: int, stage_block_size: int):
+    """
+    Creates the partitioning of a filter convolved with stage_block_size on a worker thread.
+
+    The worker convolves each stage block while the next one is collected, so its output is two stage
+    blocks late. The first two stage blocks of the filter are therefore convolved with block_size.
+
+    :return: list of (partition size, partition count) tuples
+    """
+    head_count = min(-(-ir_size // block_size), 2 * stage_block_size // block_size)
+    partitioning = [(block_size, head_count)]
+
+    tail_size = ir_size - block_size * head_count
+    if tail_size > 0:
+        partitioning.append((stage_block_size, -(-tail_size // stage_block_size)))
+
+    return partitioning
+
+
+class ConvolverNonUniform(object):
+    """
+    Class for non-uniformly partitioned convolution of long filters
+
+    The head of the filter is convolved with partitions of block_size in every block. Later segments use
+    larger partitions, are buffered internally and only processed once their partition size worth of input
+    has been collected. Their output is delayed by the segment offset, so the result is identical to
+    uniformly partitioned convolution. Filter changes reach a tail segment at its next partition boundary.
+
+    With threaded_segments, the tail segments are convolved on worker threads while their next partition is
+    collected (see multirate_partitioning and nonuniform_partitioning), so a single audio block never has to wait
+    for a large partition. Otherwise all segments, whose partitions end in the same block, are convolved in it.
+    A worker, which is not finished within segment_timeout seconds when its output is due, misses its partition:
+    silence is used instead and the miss is counted (see get_missed_partitions). thread_initializer is called first
+    on each worker thread.
+    """
+
+    def __init__(self, ir_size: int, block_size: int, stereoInput: bool, sources: int, interpolate: bool, torch_settings: str,
+                 partitioning, matmul: bool = False, lean_memory: bool = False, threaded_segments: bool = False,
+                 segment_timeout: float = None, thread_initializer=None):
+        start = default_timer()
+
+        self.log = logging.getLogger("pybinsim.ConvolverNonUniform")
+        self.log.info("Convolver: Start Init")
+        self.log.info("Partitioning (size, count): {}".format(partitioning))
+
+        # Torch options
+        self.torch_device = torch.device(torch_settings)
+
+        self.IR_size = ir_size
+        self.block_size = block_size
+        self.stereoInput = stereoInput
+        self.partitioning = partitioning
+
+        head_size, head_count = partitioning[0]
+        if head_size != block_size:
+            raise ValueError("First partition size must match block size")
+
+        self.head = ConvolverTorch(head_size * head_count, block_size, stereoInput, sources, interpolate, torch_settings,
+                                   matmul=matmul, lean_memory=lean_memory)
+
+        inputs = 2 if stereoInput else sources
+
+        self.segments = []
+        offset = head_size * head_count
+        for segment, (partition_size, partition_count) in enumerate(partitioning[1:], start=1):
+            if partition_size % block_size != 0:
+                raise ValueError("Partition sizes must be multiples of the block size")
+            latency = partition_size if threaded_segments else 0
+            if offset < partition_size + latency:
+                raise ValueError("Segment with partition size {} starts too early ({})".format(partition_size, offset))
+
+            self.segments.append(TailSegment(segment, offset, partition_size, partition_count, block_size, inputs,
+                                             stereoInput, sources, interpolate, torch_settings, matmul, lean_memory,
+                                             threaded_segments, segment_timeout, thread_initializer))
+            offset += partition_size * partition_count
+
+        # Output of the tail segments, indexed by time modulo the ring size
+        self.ring_size = max([segment.offset for segment in self.segments], default=block_size)
+        self.tail_output = torch.zeros(2, 1, self.ring_size, dtype=torch.float32, device=self.torch_device)
+
+        self.output = torch.zeros(2, 1, self.block_size, dtype=torch.float32, device=self.torch_device)
+        self.outputEmpty = torch.zeros(2, 1, self.block_size, dtype=torch.float32, device=self.torch_device)
+
+        # Counts how often process() is called
+        self.processCounter = 0
+
+        self.active = True
+
+        end = default_timer()
+        delta = end - start
+        self.log.info("Convolver: Finished Init (took {}s)".format(delta))
+
+    def get_counter(self):
+        """
+        Returns processing counter
+        :return: processing counter
+        """
+        return self.processCounter
+
+    def get_missed_partitions(self):
+        """
+        Returns how often a threaded tail segment was not finished in time and silence was used instead
+        """
+        return sum(segment.missed_partitions for segment in self.segments)
+
+    def get_memory_footprint(self):
+        """
+        Returns the memory used by the buffers of the head, the tail segments and the tail output in bytes
+        """
+        footprint = self.head.get_memory_footprint()
+        footprint += sum(segment.get_memory_footprint() for segment in self.segments)
+        footprint += tensor_bytes([self.tail_output, self.output, self.outputEmpty])
+
+        return footprint
+
+    def setAllFilters(self, filters: List[Filter]):
+        self.head.setAllFilters(filters)
+        for segment in self.segments:
+            segment.setAllFilters(filters)
+
+    def setFilter(self, source_index: int, filter: Filter):
+        self.head.setFilter(source_index, filter)
+        for segment in self.segments:
+            segment.setFilter(source_index, filter)
+
+    def stageFilter(self, source_index: int, filter: Filter):
+        self.head.stageFilter(source_index, filter)
+        for segment in self.segments:
+            segment.convolver.stageFilter(source_index, filter, segment.index)
+
+    def publishFilters(self):
+        # tail segments pick up new filters only at their partition boundaries
+        published = [self.head.publishFilters()]
+        published += [segment.convolver.publishFilters() for segment in self.segments]
+        return all(published)
+
+    def process(self, input_buffer, block):
+        """
+        Main function
+
+        :param input_buffer: input spectra of block_size from InputBufferMulti
+        :param block: time domain input block
+        :return: output
+        """
+        if not self.active:
+            return self.outputEmpty
+
+        time = self.processCounter * self.block_size
+
+        # head and everything the tail segments have computed for this block
+        read_position = time % self.ring_size
+        tail = self.tail_output[:, :, read_position:read_position + self.block_size]
+        torch.add(self.head.process(input_buffer), tail, out=self.output)
+        tail.zero_()
+
+        for segment in self.segments:
+            segment_output = segment.process(block, self.processCounter)
+            if segment_output is not None:
+                # output of the segment starts offset samples after its first input sample
+                self.add_to_tail_output(segment_output, time + self.block_size + segment.offset
+                                        - segment.partition_size - segment.latency)
+
+        self.processCounter += 1
+
+        return self.output
+
+    def add_to_tail_output(self, segment_output, time):
+        position = time % self.ring_size
+        length = min(segment_output.shape[2], self.ring_size - position)
+        self.tail_output[:, :, position:position + length].add_(segment_output[:, :, :length])
+        if length < segment_output.shape[2]:
+            self.tail_output[:, :, :segment_output.shape[2] - length].add_(segment_output[:, :, length:])
+
+    def close(self):
+        self.log.info("Convolver: close")
+        self.head.close()
+        for segment in self.segments:
+            segment.close()
+
+
+class TailSegment(object):
+    """
+    Segment of a non-uniform partitioned filter with partitions larger than the block size
+
+    A threaded segment convolves each partition on a worker thread while the next one is collected.
+    Its output is returned one partition later (latency) and its filters are handed over to the worker
+    with stageFilter() and publishFilters(). The audio thread waits at most timeout seconds (None: no limit)
+    for the output of the worker and returns silence for a missed partition.
+    """
+
+    def __init__(self, index, offset, partition_size, partition_count, block_size, inputs, stereoInput, sources,
+                 interpolate, torch_settings, matmul=False, lean_memory=False, threaded=False, timeout=None,
+                 thread_initializer=None):
+        self.index = index
+        self.offset = offset
+        self.partition_size = partition_size
+        self.blocks_per_partition = partition_size // block_size
+        self.block_size = block_size
+        torch_device = torch.device(torch_settings)
+
+        # collects time domain input until a full partition is available
+        # threaded: the worker reads one input block while another one is collected. After a missed partition,
+        # the late partition and the next one are read by the worker, so a third block is needed.
+        self.input_blocks = [torch.zeros(inputs, partition_size, dtype=torch.float32, device=torch_device)
+                             for _ in range(3 if threaded else 1)]
+        self.input_index = 0
+        self.input_buffer = InputBufferMulti(partition_size, inputs, torch_settings)
+        self.convolver = ConvolverTorch(partition_size * partition_count, partition_size, stereoInput, sources,
+                                        interpolate, torch_settings, matmul=matmul, lean_memory=lean_memory)
+
+        self.threaded = threaded
+        self.latency = partition_size if threaded else 0
+        self.timeout = timeout
+        self.missed_partitions = 0
+        self.executor = None
+        self.future = None
+        self.output = None
+        # filters staged by setFilter, which are published by process()
+        self.filters_staged = False
+        if self.threaded:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pybinsim-segment",
+                                               initializer=thread_initializer)
+            self.output = torch.zeros(2, 1, partition_size, dtype=torch.float32, device=torch_device)
+
+    def setAllFilters(self, filters: List[Filter]):
+        if not self.threaded:
+            self.convolver.setAllFilters(filters, self.index)
+            return
+
+        for source_index, filter in enumerate(filters):
+            self.setFilter(source_index, filter)
+
+    def setFilter(self, source_index: int, filter: Filter):
+        if not self.threaded:
+            self.convolver.setFilter(source_index, filter, self.index)
+            return
+
+        # the worker might be using the filters, they are handed over before its next partition
+        self.convolver.stageFilter(source_index, filter, self.index)
+        self.filters_staged = True
+
+    def process(self, block, counter):
+        """
+        Collect block and convolve once a full partition is available
+
+        :return: output of partition_size samples or None
+        """
+        position = (counter % self.blocks_per_partition) * self.block_size
+        input_block = self.input_blocks[self.input_index]
+        input_block[:, position:position + self.block_size] = block
+
+        if position + self.block_size < self.partition_size:
+            return None
+
+        if not self.threaded:
+            return self.convolve(input_block)
+
+        # output of the previous partition, the worker had a whole partition of time for it
+        output = None
+        if self.future is not None:
+            try:
+                self.output.copy_(self.future.result(timeout=self.timeout))
+            except TimeoutError:
+                # the late partition still updates the FDL of the worker before the next one, only its output is lost
+                self.output.zero_()
+                self.missed_partitions += 1
+            output = self.output
+
+        if self.filters_staged:
+            self.convolver.publishFilters()
+            self.filters_staged = False
+
+        self.future = self.executor.submit(self.convolve, input_block)
+        self.input_index = (self.input_index + 1) % len(self.input_blocks)
+
+        return output
+
+    def convolve(self, input_block):
+        input_buffer = self.input_buffer.process(input_block)
+        return self.convolver.process(input_buffer)
+
+    def get_memory_footprint(self):
+        footprint = self.convolver.get_memory_footprint()
+        footprint += tensor_bytes(self.input_blocks + [self.input_buffer.buffer, self.input_buffer.fft_buffer,
+                                                       self.output])
 
-            return torch.fft.irfft(self.resultFreq, out=irfft_buffer, dim=2)[:, :, self.block_size:self.block_size * 2]
+        return footprint
 
     def close(self):
-        self.log.info("Convolver: close")
\ No newline at end of file
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.input_buffer.close()
+        self.convolver.close()
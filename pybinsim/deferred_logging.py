@@ -0,0 +1,163 @@
+# This file is part of the pyBinSim project.
+#
+# Copyright (c) 2017 A. Neidhardt, F. Klein, N. Knoop, T. Köllmer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Logging without console I/O on the calling thread
+
+The DeferredLogHandler puts the log records of a logger into a queue without formatting them.
+A RateLimitedLogListener formats and emits them on a background thread. Records with the same message
+template, which follow each other within an interval, are counted and summarized in one record per interval.
+"""
+
+import logging
+import logging.handlers
+import threading
+from queue import Empty, SimpleQueue
+from timeit import default_timer
+
+# put into the queue to stop the listener
+_STOP = object()
+
+
+class DeferredLogHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, which leaves formatting the record to the listener.
+    Putting into the SimpleQueue never blocks.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitedLogListener(object):
+    """
+    Emits the records of a queue to handlers on a background thread.
+    The first record of a message template is emitted immediately, further records with the same template
+    are suppressed for the interval and summarized afterwards.
+    """
+
+    def __init__(self, handlers, interval: float = 1.):
+        self.queue = SimpleQueue()
+        self.handlers = handlers
+        self.interval = interval
+
+        # (logger name, level, message template) -> [start of the interval, suppressed records, last record]
+        self.windows = {}
+
+        self.thread = threading.Thread(target=self.run, name="pybinsim-logging", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """ Emit the remaining records and summaries and stop the thread """
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.interval)
+            except Empty:
+                record = None
+
+            if record is _STOP:
+                self.flush(None)
+                return
+
+            now = default_timer()
+            if record is not None:
+                self.handle(record, now)
+            self.flush(now)
+
+    def handle(self, record, now):
+        key = (record.name, record.levelno, record.msg)
+
+        window = self.windows.get(key)
+        if window is None:
+            self.windows[key] = [now, 0, None]
+            self.emit(record)
+        else:
+            window[1] += 1
+            window[2] = record
+
+    def flush(self, now):
+        """
+        Emit summaries of the intervals which ended
+
+        :param now: current time, None ends all intervals
+        """
+        for key, (start, suppressed, last_record) in list(self.windows.items()):
+            if now is not None and now - start < self.interval:
+                continue
+
+            if suppressed == 0:
+                del self.windows[key]
+                continue
+
+            last_record.msg = "{} ({} similar messages in {:.3g}s)".format(last_record.getMessage(), suppressed,
+                                                                          (now or default_timer()) - start)
+            last_record.args = None
+            self.emit(last_record)
+
+            # a new interval starts, messages keep being summarized as long as they are repeated
+            if now is None:
+                del self.windows[key]
+            else:
+                self.windows[key] = [now, 0, None]
+
+    def emit(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def start_deferred_logging(logger: logging.Logger, interval: float = 1.):
+    """
+    Move the handlers of a logger to a RateLimitedLogListener
+
+    :param logger: logger, whose records are emitted on the background thread
+    :param interval: interval in seconds, in which records with the same message are summarized
+    :return: the started listener, pass it to stop_deferred_logging
+    """
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    listener = RateLimitedLogListener(handlers, interval)
+    listener.logger = logger
+    listener.queue_handler = DeferredLogHandler(listener.queue)
+
+    logger.addHandler(listener.queue_handler)
+    listener.start()
+
+    return listener
+
+
+def stop_deferred_logging(listener: RateLimitedLogListener):
+    """ Stop the listener and give the handlers back to the logger """
+    listener.logger.removeHandler(listener.queue_handler)
+    listener.stop()
+
+    for handler in listener.handlers:
+        listener.logger.addHandler(handler)
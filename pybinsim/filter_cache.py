@@ -0,0 +1,254 @@
+# This file is part of the pyBinSim project.
+#
+# Copyright (c) 2017 A. Neidhardt, F. Klein, N. Knoop, T. Köllmer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+On-disk cache of the filters of the FilterStorage in the frequency domain
+
+A cache entry is a directory named after the hash of the source files and the settings, which change the
+stored spectra. For each filter type it contains:
+
+    <type>_keys.npy       filter keys [filters, key values] (see Pose.key_from_array)
+    <type>_segment<i>.npy spectra [filters, 2, partitions, partition_size+1] of segment i of the partitioning
+    <type>_active.npy     range (first, end) of the active partitions [filters, segments, 2]
+    <type>_filenames.npy  source file of each filter, '' if unknown
+
+The spectra are loaded with memory mapping, so only the pages of filters in use are read from disk.
+With LazyFilterDicts, the filters themselves are only created on first use and kept in a FilterLRU.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+log = logging.getLogger("pybinsim.filter_cache")
+
+# change when the format of the cache entries changes
+CACHE_VERSION = 1
+
+
+def filter_cache_key(source_files, settings: dict) -> str:
+    """
+    Hash of the source files and settings. Files are identified by path, size and modification time,
+    so large databases do not have to be read to find out that they did not change.
+
+    :param source_files: paths of all files the filters are loaded from
+    :param settings: settings, which change the stored filters, must be serializable as JSON
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': CACHE_VERSION, 'settings': settings}, sort_keys=True).encode())
+
+    for source_file in source_files:
+        stat = os.stat(source_file)
+        digest.update("{}|{}|{}\n".format(Path(source_file).resolve(), stat.st_size, stat.st_mtime_ns).encode())
+
+    return digest.hexdigest()[:32]
+
+
+class FilterBankWriter(object):
+    """
+    Writes the filters of one filter type into a cache entry, one filter after another
+
+    :param directory: directory of the cache entry
+    :param name: filter type, prefix of the files
+    :param count: number of filters
+    :param key_size: number of key values
+    :param segment_shapes: shape [2, partitions, partition_size+1] of each segment of the spectra
+    """
+
+    def __init__(self, directory: Path, name: str, count: int, key_size: int, segment_shapes):
+        self.keys = np.lib.format.open_memmap(directory / "{}_keys.npy".format(name), mode='w+',
+                                              dtype=np.float32, shape=(count, key_size))
+        self.segments = [np.lib.format.open_memmap(directory / "{}_segment{}.npy".format(name, i), mode='w+',
+                                                   dtype=np.complex64, shape=(count,) + tuple(shape))
+                         for i, shape in enumerate(segment_shapes)]
+        self.active = np.zeros((count, len(segment_shapes), 2), dtype=np.int64)
+        self.filenames = [''] * count
+
+        self.directory = directory
+        self.name = name
+
+    def write(self, index: int, key, filter):
+        """ Store key and spectra of a Filter in the frequency domain """
+        self.keys[index] = np.asarray(key, dtype=np.float32).reshape(-1)
+        for segment, spectrum in zip(self.segments, filter.TF_segments):
+            segment[index] = spectrum.cpu().numpy()
+        self.active[index] = [filter.getActivePartitions(i) for i in range(len(self.segments))]
+        self.filenames[index] = filter.filename or ''
+
+    def close(self):
+        for array in [self.keys] + self.segments:
+            array.flush()
+        np.save(self.directory / "{}_active.npy".format(self.name), self.active)
+        np.save(self.directory / "{}_filenames.npy".format(self.name), np.asarray(self.filenames, dtype=str))
+
+
+def save_filter_bank(directory, filter_dicts: dict):
+    """
+    Write filters into a new cache entry. The entry is written to a temporary directory and renamed,
+    so an interrupted write never leaves an incomplete entry.
+
+    :param directory: directory of the cache entry
+    :param filter_dicts: filter type -> {key: Filter in the frequency domain}
+    """
+    directory = Path(directory)
+    temporary = directory.with_name("{}.tmp{}".format(directory.name, os.getpid()))
+    temporary.mkdir(parents=True, exist_ok=True)
+
+    try:
+        for name, filter_dict in filter_dicts.items():
+            if not filter_dict:
+                continue
+
+            first_key, first_filter = next(iter(filter_dict.items()))
+            writer = FilterBankWriter(temporary, name, len(filter_dict),
+                                      np.asarray(first_key, dtype=np.float32).size,
+                                      [spectrum.shape for spectrum in first_filter.TF_segments])
+            for index, (key, filter) in enumerate(filter_dict.items()):
+                writer.write(index, key, filter)
+            writer.close()
+
+        os.replace(temporary, directory)
+    except OSError as e:
+        # e.g. another instance wrote the same entry in the meantime
+        log.warning("Cannot write filter cache {}: {}".format(directory, e))
+        shutil.rmtree(temporary, ignore_errors=True)
+
+
+def load_filter_bank(directory, name: str):
+    """
+    Open the filters of one filter type of a cache entry
+
+    :param directory: directory of the cache entry
+    :param name: filter type
+    :return: (keys, spectra segments, active partitions, filenames) or None if the entry has no such filters.
+             The spectra are copy-on-write memory maps, so they can be used by torch without copying them.
+    """
+    directory = Path(directory)
+    keys_path = directory / "{}_keys.npy".format(name)
+    if not keys_path.exists():
+        return None
+
+    keys = np.load(keys_path)
+    segments = []
+    while (directory / "{}_segment{}.npy".format(name, len(segments))).exists():
+        segments.append(np.load(directory / "{}_segment{}.npy".format(name, len(segments)), mmap_mode='c'))
+    active = np.load(directory / "{}_active.npy".format(name))
+    filenames = np.load(directory / "{}_filenames.npy".format(name))
+
+    return keys, segments, active, filenames
+
+
+def filter_bytes(filter):
+    """ Memory used by the spectra of a Filter """
+    return sum(segment.numel() * segment.element_size() for segment in filter.TF_segments)
+
+
+class FilterLRU(object):
+    """
+    Filters created on demand, the least recently used filters are dropped when the byte budget is exceeded.
+    Dropped filters stay in memory as long as they are referenced elsewhere, e.g. by a convolver.
+
+    :param budget: bytes of filter spectra kept at most, the last used filter is always kept
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.filters = OrderedDict()
+        self.resident_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # get() is called by the audio thread or the FilterUpdater and by the directivity composition
+        self.lock = threading.Lock()
+
+    def get(self, key, create_filter):
+        """
+        Return the filter for key, created with create_filter() if it is not kept
+
+        :param key: hashable identifier of the filter
+        :param create_filter: function without arguments returning the filter
+        """
+        with self.lock:
+            filter = self.filters.get(key)
+            if filter is not None:
+                self.hits += 1
+                self.filters.move_to_end(key)
+                return filter
+
+            self.misses += 1
+            filter = create_filter()
+            self.filters[key] = filter
+            self.resident_bytes += filter_bytes(filter)
+
+            while self.resident_bytes > self.budget and len(self.filters) > 1:
+                _, evicted_filter = self.filters.popitem(last=False)
+                self.resident_bytes -= filter_bytes(evicted_filter)
+                self.evictions += 1
+
+            return filter
+
+    def get_statistics(self):
+        """ Counters of the LRU: hits, misses, evictions and resident bytes """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'resident_bytes': self.resident_bytes}
+
+
+class LazyFilterDict(Mapping):
+    """
+    Read only dict of filters, which are created from a memory mapped cache entry on first use
+
+    :param name: filter type, part of the keys in the FilterLRU
+    :param indices: filter key -> index in the cache entry
+    :param create_filter: function creating the filter for an index
+    :param lru: FilterLRU keeping the created filters, may be shared by several LazyFilterDicts
+    """
+
+    def __init__(self, name: str, indices: dict, create_filter, lru: FilterLRU):
+        self.name = name
+        self.indices = indices
+        self.create_filter = create_filter
+        self.lru = lru
+
+    def __getitem__(self, key):
+        index = self.indices[key]
+        return self.lru.get((self.name, index), lambda: self.create_filter(index))
+
+    def __contains__(self, key):
+        return key in self.indices
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
@@ -0,0 +1,142 @@
+# This file is part of the pyBinSim project.
+#
+# Copyright (c) 2017 A. Neidhardt, F. Klein, N. Knoop, T. Köllmer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import threading
+
+
+def update_filters(dirty_channels, amount_channels, get_filter_values, get_filter, pose_type, set_filter):
+    """ Set new filters with set_filter for all channels in dirty_channels and empty the set """
+    while dirty_channels:
+        channel = dirty_channels.pop()
+        if channel >= amount_channels:
+            continue
+
+        filter_value_list = get_filter_values(channel)
+        set_filter(channel, get_filter(pose_type.from_filterValueList(filter_value_list)))
+
+
+class FilterUpdater(object):
+    """
+    Prepares new filters for the convolvers on a background thread
+
+    Filter lookups, pose construction and the assembly of the filter tensors are done with
+    stageFilter() on the worker thread. The prepared filters are handed over with publishFilters()
+    and picked up by the convolvers at the start of the next processed block, so the audio
+    callback never waits for the worker.
+    """
+
+    def __init__(self, pkg_receiver, retry_interval: float):
+        self.log = logging.getLogger("pybinsim.FilterUpdater")
+        self.log.info("FilterUpdater: init")
+
+        self.pkg_receiver = pkg_receiver
+
+        # Filters which could not be published are retried after this time (in seconds)
+        self.retry_interval = retry_interval
+
+        self.stages = []
+        self.convolvers = []
+
+        self.running = False
+        self.thread = None
+
+    def add_stage(self, dirty_channels, amount_channels, get_filter_values, get_filter, pose_type, convolver):
+        """
+        Add a convolver, whose filters are updated for the channels in dirty_channels
+
+        :param dirty_channels: set of channels with new filter values
+        :param amount_channels: number of channels used by the convolver
+        :param get_filter_values: returns the filter values of a channel
+        :param get_filter: returns the filter for a pose
+        :param pose_type: Pose or SourcePose
+        :param convolver: convolver providing stageFilter() and publishFilters()
+        """
+        self.stages.append((dirty_channels, amount_channels, get_filter_values, get_filter, pose_type,
+                            convolver.stageFilter))
+        self.convolvers.append(convolver)
+
+    def update(self):
+        """ Stage the filters of all dirty channels and publish them """
+        for stage in self.stages:
+            update_filters(*stage)
+
+        for convolver in self.convolvers:
+            convolver.publishFilters()
+
+    def start(self):
+        """ Prepare the initial filters and start the worker thread """
+        self.update()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        update_event = self.pkg_receiver.filter_update_event
+
+        while self.running:
+            # wake up on new filter values or retry publishing filters the audio thread has not picked up yet
+            update_event.wait(self.retry_interval)
+            update_event.clear()
+            self.update()
+
+    def close(self):
+        self.log.info("FilterUpdater: close()")
+        self.running = False
+        if self.thread is not None:
+            self.pkg_receiver.filter_update_event.set()
+            self.thread.join()
+
+
+class DirectivityComposer(object):
+    """
+    Replaces the source directivity convolver, when the directivity filters are composed into the ds filters
+
+    A new directivity filter marks all ds channels as dirty, so their filters are composed again with
+    get_ds_filter(). The directivity filters have to be updated before the ds filters.
+    """
+
+    def __init__(self, filter_storage, ds_dirty_channels, amount_channels: int):
+        self.filter_storage = filter_storage
+        self.ds_dirty_channels = ds_dirty_channels
+        self.amount_channels = amount_channels
+
+        self.sd_filter = filter_storage.default_sd_filter
+
+    def get_ds_filter(self, pose):
+        """ Returns the ds filter for pose composed with the current directivity filter """
+        return self.filter_storage.get_ds_sd_filter(self.filter_storage.get_ds_filter(pose), self.sd_filter)
+
+    def setFilter(self, source_index: int, filter):
+        if filter is self.sd_filter:
+            return
+
+        self.sd_filter = filter
+        self.ds_dirty_channels.update(range(self.amount_channels))
+
+    def stageFilter(self, source_index: int, filter):
+        self.setFilter(source_index, filter)
+
+    def publishFilters(self):
+        return True
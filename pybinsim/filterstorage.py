@@ -22,6 +22,9 @@
 
 import logging
 import enum
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import numpy as np
@@ -30,13 +33,76 @@ import soundfile as sf
 import torch
 import time
 
+from pybinsim.filter_cache import filter_cache_key, load_filter_bank, save_filter_bank, FilterLRU, LazyFilterDict
 from pybinsim.pose import Pose, SourcePose
+from pybinsim.pose_index import PoseIndex
 from pybinsim.utility import total_size
 import scipy.io as sio
 
+
+def compose_impulse_responses(first, second):
+    """
+    Convolve two stereo impulse responses ear by ear
+
+    :param first: impulse response [2, N]
+    :param second: impulse response [2, M]
+    :return: impulse response [2, N+M-1] of both filters applied in series
+    """
+    length = first.shape[1] + second.shape[1] - 1
+    spectrum = torch.fft.rfft(first, n=length, dim=1) * torch.fft.rfft(second, n=length, dim=1)
+    return torch.fft.irfft(spectrum, n=length, dim=1)
+
+
+# Filters transformed to the frequency domain with one FFT call when loading them
+FILTER_BATCH_SIZE = 256
+
+
+def transform_filters(irs, block_size, partitioning=None, silence_threshold=-200.):
+    """
+    Partition spectra and active partitions of a batch of filters, the batched form of Filter.storeInFDomain
+
+    :param irs: time domain filters [filters, 2, length], length is a multiple of block_size
+    :param block_size: partition size of uniformly partitioned filters
+    :param partitioning: list of (partition size, partition count) tuples, None for uniform partitions
+    :param silence_threshold: partitions with an energy below this threshold (in dB relative to the energy of the
+                              whole filter) are not active
+    :return: (spectra [filters, 2, partitions, partition_size+1] for each segment,
+              range (first, end) of the active partitions for each filter and segment, (0, 0) if all are silent)
+    """
+    filters = irs.shape[0]
+    if partitioning is None:
+        partitioning = [(block_size, irs.shape[2] // block_size)]
+
+    spectra = []
+    active = []
+    thresholds = torch.sum(torch.square(irs), dim=(1, 2)).double() * 10 ** (silence_threshold / 10)
+
+    offset = 0
+    for partition_size, partition_count in partitioning:
+        segment = irs[:, :, offset:offset + partition_size*partition_count]
+        # the last segment may reach beyond the filter length
+        segment = torch.nn.functional.pad(segment, (0, partition_size*partition_count - segment.shape[2]))
+        segment = segment.reshape(filters, 2, partition_count, partition_size)
+        spectra.append(torch.fft.rfft(segment, dim=3, n=partition_size*2))
+        offset += partition_size*partition_count
+
+        # energy of each partition for both ears
+        above = torch.sum(torch.square(segment), dim=(1, 3)).double() > thresholds[:, None]
+        first = torch.argmax(above.int(), dim=1)
+        end = partition_count - torch.argmax(torch.flip(above, dims=(1,)).int(), dim=1)
+        silent = ~torch.any(above, dim=1)
+        active.append(torch.stack([first, end], dim=1).masked_fill_(silent[:, None], 0))
+
+    active = [segment_active.tolist() for segment_active in active]
+    active_partitions = [[tuple(segment_active[i]) for segment_active in active] for i in range(filters)]
+
+    return spectra, active_partitions
+
+
 class Filter(object):
 
-    def __init__(self, inputfilter, irBlocks, block_size,torch_settings, filename=None):
+    def __init__(self, inputfilter, irBlocks, block_size,torch_settings, filename=None, partitioning=None,
+                 silence_threshold=-200.):
         self.log = logging.getLogger("pybinsim.Filter")
 
         # Torch options
@@ -48,24 +114,59 @@ class Filter(object):
         self.TF_blocks = irBlocks
         self.TF_block_size = block_size + 1
 
-        # input shape: (ir_length, 2)
-        ir_blocked = np.empty((2, irBlocks, block_size))
+        # input shape: (ir_length, 2), None for filters created from their spectra (see from_spectra)
+        self.IR_blocked = None
+        if inputfilter is not None:
+            ir_blocked = np.empty((2, irBlocks, block_size))
 
-        # if filter is mono - for whatever reason - use mono channel on both ir blocks
-        if inputfilter.shape[1] != 2:
-            ir_blocked[0,] = np.reshape(inputfilter[:,0], (irBlocks, block_size))
-            ir_blocked[1,] = np.reshape(inputfilter[:,0], (irBlocks, block_size))
-        else:
-            ir_blocked[0,] = np.reshape(inputfilter[:,0], (irBlocks, block_size))
-            ir_blocked[1,] = np.reshape(inputfilter[:,1], (irBlocks, block_size))
-        
-        self.IR_blocked = torch.as_tensor(ir_blocked, dtype=torch.float32, device=self.torch_device)
+            # if filter is mono - for whatever reason - use mono channel on both ir blocks
+            if inputfilter.shape[1] != 2:
+                ir_blocked[0,] = np.reshape(inputfilter[:,0], (irBlocks, block_size))
+                ir_blocked[1,] = np.reshape(inputfilter[:,0], (irBlocks, block_size))
+            else:
+                ir_blocked[0,] = np.reshape(inputfilter[:,0], (irBlocks, block_size))
+                ir_blocked[1,] = np.reshape(inputfilter[:,1], (irBlocks, block_size))
+
+            self.IR_blocked = torch.as_tensor(ir_blocked, dtype=torch.float32, device=self.torch_device)
 
         # not used
         self.filename = filename
         
+        # List of (partition size, partition count) tuples for non-uniform partitioned convolution.
+        # None means uniform partitions of block_size.
+        self.partitioning = partitioning
+
+        # Partitions with an energy below silence_threshold (in dB relative to the energy of the whole filter)
+        # are treated as silent. active_partitions holds the range (first, end) of the remaining partitions
+        # for each segment.
+        self.silence_threshold = silence_threshold
+        self.active_partitions = None
+
         self.fd_available = False
         self.TF_blocked = None
+        self.TF_segments = None
+
+        # FilterBank holding the spectra of this filter in row bank_index, None for filters with their own spectra
+        self.bank = None
+        self.bank_index = None
+
+    @classmethod
+    def from_spectra(cls, spectra, active_partitions, irBlocks, block_size, torch_settings, filename=None,
+                     partitioning=None, silence_threshold=-200.):
+        """
+        Create a filter in the frequency domain from the partition spectra of storeInFDomain
+
+        :param spectra: list with one tensor [2, partitions, partition_size+1] per segment of the partitioning
+        :param active_partitions: list with the range (first, end) of the active partitions of each segment
+        """
+        filter = cls(None, irBlocks, block_size, torch_settings, filename, partitioning, silence_threshold)
+
+        filter.TF_segments = [torch.as_tensor(segment, device=filter.torch_device) for segment in spectra]
+        filter.TF_blocked = filter.TF_segments[0]
+        filter.active_partitions = [(int(first), int(end)) for first, end in active_partitions]
+        filter.fd_available = True
+
+        return filter
 
     def getFilter(self):
         return self.IR_blocked
@@ -78,19 +179,87 @@ class Filter(object):
             return self.IR_blocked
 
     def storeInFDomain(self):
-        self.TF_blocked = torch.fft.rfft(self.IR_blocked, dim=2, n=self.block_size*2)
+        spectra, active_partitions = transform_filters(self.IR_blocked.reshape(1, 2, -1), self.block_size,
+                                                       self.partitioning, self.silence_threshold)
+        self.TF_segments = [spectrum[0] for spectrum in spectra]
+        self.TF_blocked = self.TF_segments[0]
+        self.active_partitions = active_partitions[0]
 
         self.fd_available = True
 
         # Discard time domain data
         self.IR_blocked = None
 
-    def getFilterFD(self):
+    def getActivePartitions(self, segment=0):
+        """ Range (first, end) of the partitions of segment, which are not silent """
+        if self.active_partitions is None:
+            if self.partitioning is None:
+                return 0, self.ir_blocks
+            return 0, self.partitioning[segment][1]
+
+        return self.active_partitions[segment]
+
+    def getImpulseResponse(self):
+        """ Time domain filter [2, irBlocks*block_size], reconstructed from the spectra if necessary """
+        if not self.fd_available:
+            return self.IR_blocked.reshape(2, -1)
+
+        # every partition spectrum holds one partition zero padded to twice its size
+        segments = []
+        for segment in self.TF_segments:
+            partition_size = segment.shape[2] - 1
+            segments.append(torch.fft.irfft(segment, n=partition_size*2, dim=2)[:, :, :partition_size].reshape(2, -1))
+
+        return torch.cat(segments, dim=1)[:, :self.ir_blocks*self.block_size]
+
+    def getFilterFD(self, segment=0):
         if not self.fd_available:
             self.log.warning("FilterStorage: No frequency domain filter available!")
-            return torch.zeros((2, self.ir_blocks, self.block_size+1), dtype=torch.complex64)
+            if self.partitioning is None:
+                return torch.zeros((2, self.ir_blocks, self.block_size+1), dtype=torch.complex64)
+            partition_size, partition_count = self.partitioning[segment]
+            return torch.zeros((2, partition_count, partition_size+1), dtype=torch.complex64)
         else:
-            return self.TF_blocked
+            return self.TF_segments[segment]
+
+class FilterBank(object):
+    """
+    Spectra of all filters of a stage in one contiguous tensor [filters, 2, partitions, partition_size+1] per
+    segment. The filters of the bank are views of its rows, which a convolver copies from the bank once
+    before the next block instead of on every setFilter (see ConvolverTorch.gatherFilters).
+    """
+
+    def __init__(self, segments, active_partitions, keys, irBlocks, block_size, torch_settings, filenames=None,
+                 partitioning=None, silence_threshold=-200.):
+        """
+        :param segments: list with one tensor or array [filters, 2, partitions, partition_size+1] per segment
+        :param active_partitions: range (first, end) of the active partitions for each filter and segment
+        :param keys: key of each filter, a later filter replaces an earlier one with the same key
+        :param filenames: file name of each filter or None
+        """
+        self.torch_device = torch.device(torch_settings)
+        self.segments = [torch.as_tensor(segment, device=self.torch_device) for segment in segments]
+
+        # row of each key
+        self.index = {key: row for row, key in enumerate(keys)}
+
+        self.filters = []
+        for row in range(len(keys)):
+            filter = Filter.from_spectra([segment[row] for segment in self.segments], active_partitions[row],
+                                         irBlocks, block_size, torch_settings,
+                                         filenames[row] if filenames is not None else None, partitioning,
+                                         silence_threshold)
+            filter.bank = self
+            filter.bank_index = row
+            self.filters.append(filter)
+
+    def __len__(self):
+        return len(self.filters)
+
+    def get_filter_dict(self):
+        """ Filters of the bank by key """
+        return {key: self.filters[row] for key, row in self.index.items()}
+
 
 class FilterType(enum.Enum):
     Undefined = 0
@@ -104,29 +273,55 @@ class FilterStorage(object):
     """ Class for storing all filters mentioned in the filter list """
 
     #def __init__(self, irSize, block_size, filter_list_name):
-    def __init__(self, block_size, filter_source, filter_list_name, filter_database, torch_settings, useHeadphoneFilter = False, headphoneFilterSize = 0, ds_filterSize = 0, early_filterSize = 0, late_filterSize = 0, sd_filterSize = 0):
+    def __init__(self, block_size, filter_source, filter_list_name, filter_database, torch_settings, useHeadphoneFilter = False, headphoneFilterSize = 0, ds_filterSize = 0, early_filterSize = 0, late_filterSize = 0, sd_filterSize = 0,
+                 ds_partitioning = None, early_partitioning = None, late_partitioning = None, silence_threshold = -200.,
+                 headphone_composition = False, directivity_composition = False, cache_directory = None,
+                 lazy_memory_budget = None, loading_threads = 0, nearest_neighbour_weights = None,
+                 nearest_neighbour_distance = 0., composition_memory_budget = 256 * 2**20):
 
         self.log = logging.getLogger("pybinsim.FilterStorage")
         self.log.info("FilterStorage: init")
         
+        # Pre-composition: the headphone filter is convolved into all ds, early and late filters when loading them
+        # and the directivity filters are combined with the ds filters on request (see get_ds_sd_filter).
+        # The stored filters are extended by the length of the composed filters.
+        self.headphone_composition = headphone_composition and useHeadphoneFilter
+        self.directivity_composition = directivity_composition
+        headphone_extension = headphoneFilterSize if self.headphone_composition else 0
+        directivity_extension = sd_filterSize if self.directivity_composition else 0
+
         self.ds_size = ds_filterSize
         self.block_size = block_size
-        self.ds_blocks = self.ds_size // self.block_size
+        self.ds_blocks = (self.ds_size + headphone_extension + directivity_extension) // self.block_size
 
         self.early_size = early_filterSize
-        self.early_blocks = self.early_size // self.block_size
+        self.early_blocks = (self.early_size + headphone_extension) // self.block_size
 
         self.late_size = late_filterSize
-        self.late_blocks = self.late_size // self.block_size
+        self.late_blocks = (self.late_size + headphone_extension) // self.block_size
 
         self.sd_size = sd_filterSize
         self.sd_blocks = self.sd_size // self.block_size
 
+        # Partitioning for non-uniform partitioned convolution (None: uniform)
+        self.ds_partitioning = ds_partitioning
+        self.early_partitioning = early_partitioning
+        self.late_partitioning = late_partitioning
+
+        # Threshold in dB relative to the filter energy, below which partitions are skipped by the convolvers
+        self.silence_threshold = silence_threshold
+
         self.torch_settings = torch_settings
 
-        self.default_ds_filter = Filter(np.zeros((self.ds_size, 2), dtype='float32'), self.ds_blocks, self.block_size, torch_settings)
-        self.default_early_filter = Filter(np.zeros((self.early_size, 2), dtype='float32'), self.early_blocks, self.block_size, torch_settings)
-        self.default_late_filter = Filter(np.zeros((self.late_size, 2), dtype='float32'), self.late_blocks, self.block_size, torch_settings)
+        # Threads reading and preprocessing the filter files, 0 for one per CPU
+        self.loading_threads = loading_threads or os.cpu_count()
+
+        self.default_ds_filter = Filter(np.zeros((self.ds_blocks*self.block_size, 2), dtype='float32'), self.ds_blocks, self.block_size, torch_settings, partitioning=self.ds_partitioning,
+                                        silence_threshold=self.silence_threshold)
+        self.default_early_filter = Filter(np.zeros((self.early_blocks*self.block_size, 2), dtype='float32'), self.early_blocks, self.block_size, torch_settings, partitioning=self.early_partitioning,
+                                           silence_threshold=self.silence_threshold)
+        self.default_late_filter = Filter(np.zeros((self.late_blocks*self.block_size, 2), dtype='float32'), self.late_blocks, self.block_size, torch_settings, partitioning=self.late_partitioning,
+                                          silence_threshold=self.silence_threshold)
         self.default_sd_filter = Filter(np.zeros((self.sd_size, 2), dtype='float32'), self.sd_blocks, self.block_size, torch_settings)
 
         self.default_ds_filter.storeInFDomain()
@@ -149,126 +344,288 @@ class FilterStorage(object):
         self.headphone_filter = None
         self.filter_list = None
 
+        # Composed filters for each pair of (ds filter, sd filter), at most composition_memory_budget bytes of the
+        # least recently used are kept
+        self.ds_sd_filter_lru = FilterLRU(composition_memory_budget)
+        # time domain headphone filter for the composition
+        self.headphone_ir = None
+
         # format: [key,{filter}]
         self.ds_filter_dict = {}
         self.early_filter_dict = {}
         self.late_filter_dict = {}
         self.sd_filter_dict = {}
 
-        if self.filter_source == 'wav':
-            self.filter_list = open(self.filter_list_path, 'r')
-            self.log.info("Loading wav format filters according to filter list")
-            # Start to load filters
-            self.load_wav_filters()
-        elif self.filter_source == 'mat':
-            self.log.info("Loading mat format filters")
-            self.matfile = sio.loadmat(filter_database)
-            self.mat_vars = sio.whosmat(filter_database)
-            self.parse_and_load_matfile()
+        # Spectra of all filters are cached on disk in an entry for the source files and settings (see filter_cache)
+        cache_entry = None
+        if cache_directory:
+            cache_entry = Path(cache_directory) / filter_cache_key(self.get_source_files(), self.get_cache_settings())
+
+        # Lazy storage: the ds, early and late filters are only created from the cache entry when they are requested
+        # and at most lazy_memory_budget bytes of them are kept
+        self.filter_lru = None
+        if lazy_memory_budget is not None:
+            if cache_entry is None:
+                self.log.warning("Lazy filter storage needs a filter cache: keeping all filters in memory")
+            else:
+                self.filter_lru = FilterLRU(lazy_memory_budget)
+
+        if cache_entry is not None and cache_entry.exists():
+            self.log.info("Loading filters from cache {}".format(cache_entry))
+            self.load_cached_filters(cache_entry)
+        else:
+            if self.filter_source == 'wav':
+                self.filter_list = open(self.filter_list_path, 'r')
+                self.log.info("Loading wav format filters according to filter list")
+                # Start to load filters
+                self.load_wav_filters()
+            elif self.filter_source == 'mat':
+                self.log.info("Loading mat format filters")
+                self.matfile = sio.loadmat(filter_database)
+                self.mat_vars = sio.whosmat(filter_database)
+                self.parse_and_load_matfile()
+
+            if cache_entry is not None:
+                self.log.info("Writing filters to cache {}".format(cache_entry))
+                save_filter_bank(cache_entry, self.get_filter_dicts())
+
+                if self.filter_lru is not None:
+                    self.load_cached_filters(cache_entry)
+
+        # Nearest neighbour lookup for keys without a stored filter, weights of the values of a Pose key
+        # (see pose_index.parse_pose_weights), None to return the default filters
+        self.ds_pose_index = None
+        self.early_pose_index = None
+        self.late_pose_index = None
+        self.sd_pose_index = None
+        if nearest_neighbour_weights is not None:
+            self.ds_pose_index = PoseIndex(self.ds_filter_dict.keys(), nearest_neighbour_weights,
+                                           nearest_neighbour_distance)
+            self.early_pose_index = PoseIndex(self.early_filter_dict.keys(), nearest_neighbour_weights,
+                                              nearest_neighbour_distance)
+            self.late_pose_index = PoseIndex(self.late_filter_dict.keys(), nearest_neighbour_weights,
+                                             nearest_neighbour_distance)
+            # SourcePose keys only have the source orientation, source position and custom values
+            self.sd_pose_index = PoseIndex(self.sd_filter_dict.keys(), nearest_neighbour_weights[6:],
+                                           nearest_neighbour_distance)
+
+    def get_source_files(self):
+        """ Files the filters are loaded from """
+        if self.filter_source == 'mat':
+            return [self.filter_database]
+
+        with open(self.filter_list_path, 'r') as filter_list:
+            filter_paths = [line.split()[-1] for line in filter_list if line.strip() and not line.startswith('#')]
+
+        return [self.filter_list_path] + filter_paths
+
+    def get_cache_settings(self):
+        """ Settings, which change the stored filters """
+        return {'filter_source': self.filter_source,
+                'block_size': self.block_size,
+                'sizes': [self.ds_size, self.early_size, self.late_size, self.sd_size],
+                'headphone_size': self.headPhoneFilterSize if self.useHeadphoneFilter else 0,
+                'partitioning': [self.ds_partitioning, self.early_partitioning, self.late_partitioning],
+                'silence_threshold': self.silence_threshold,
+                'composition': [self.headphone_composition, self.directivity_composition]}
+
+    def get_filter_dicts(self):
+        """ All stored filters by filter type, the headphone filter has an empty key """
+        filter_dicts = {'ds': self.ds_filter_dict, 'early': self.early_filter_dict, 'late': self.late_filter_dict,
+                        'sd': self.sd_filter_dict}
+        if self.headphone_filter is not None:
+            filter_dicts['headphone'] = {(): self.headphone_filter}
+
+        return filter_dicts
+
+    def load_cached_filters(self, cache_entry):
+        """
+        Create the filters from a cache entry, their spectra stay memory mapped.
+        With lazy storage, the ds, early and late filters are created on first use (see LazyFilterDict).
+        """
+        stages = [('ds', 'ds_filter_dict', Pose, self.ds_blocks, self.ds_partitioning),
+                  ('early', 'early_filter_dict', Pose, self.early_blocks, self.early_partitioning),
+                  ('late', 'late_filter_dict', Pose, self.late_blocks, self.late_partitioning),
+                  ('sd', 'sd_filter_dict', SourcePose, self.sd_blocks, None)]
+
+        for name, dict_name, pose_type, blocks, partitioning in stages:
+            bank = load_filter_bank(cache_entry, name)
+            if bank is None:
+                setattr(self, dict_name, {})
+                continue
+
+            keys, segments, active, filenames = bank
+            keys = [pose_type.key_from_array(key) for key in keys]
+
+            def create_filter(index, segments=segments, active=active, filenames=filenames, blocks=blocks,
+                              partitioning=partitioning, copy=False):
+                # lazily created filters are copied out of the memory map, so they count against the budget
+                spectra = [np.array(segment[index]) if copy else segment[index] for segment in segments]
+                return Filter.from_spectra(spectra, active[index], blocks, self.block_size, self.torch_settings,
+                                           str(filenames[index]) or None, partitioning, self.silence_threshold)
+
+            if self.filter_lru is not None and name != 'sd':
+                indices = {key: index for index, key in enumerate(keys)}
+                filter_dict = LazyFilterDict(name, indices, partial(create_filter, copy=True), self.filter_lru)
+            else:
+                filter_dict = FilterBank(segments, active, keys, blocks, self.block_size, self.torch_settings,
+                                         [str(filename) or None for filename in filenames], partitioning,
+                                         self.silence_threshold).get_filter_dict()
+
+            setattr(self, dict_name, filter_dict)
+
+        bank = load_filter_bank(cache_entry, 'headphone')
+        if bank is not None:
+            _, segments, active, _ = bank
+            self.headphone_filter = Filter.from_spectra([segment[0] for segment in segments], active[0],
+                                                        self.headphone_ir_blocks, self.block_size, self.torch_settings)
 
     def parse_and_load_matfile(self):
 
+        # the headphone filter is needed before loading the filters it is composed into
+        if self.headphone_composition:
+            self.load_mat_headphone_filter()
+
+        # filters of each type with their keys, checked and transformed by store_filters
+        entries = {filter_type: [] for filter_type in (FilterType.ds_Filter, FilterType.early_Filter,
+                                                       FilterType.late_Filter, FilterType.directivity_Filter)}
+
         for var in range(len(self.mat_vars)):
 
             self.matvarname = self.mat_vars[var][0]
             self.log.info("Loading mat variable : {}".format(self.matvarname))
 
-            rows = self.matfile[self.matvarname].shape[1]
+            matvar = self.matfile[self.matvarname]
+            rows = matvar.shape[1]
 
             for row in range(rows):
 
-                #print('Parse mat row')
-                #print(row)
                 # Parse headphone filter
-                if self.matfile[self.matvarname]['type'][0][row] == 'HP':
-                    if not self.useHeadphoneFilter:
+                if matvar['type'][0][row] == 'HP':
+                    if not self.useHeadphoneFilter or self.headphone_composition:
                         continue
 
                     filter_type = FilterType.headphone_Filter
 
-                    self.headphone_filter = Filter(self.check_filter(filter_type, self.matfile[self.matvarname]['filter'][0][row]),
+                    self.headphone_filter = Filter(self.check_filter(filter_type, matvar['filter'][0][row]),
                                                    self.headphone_ir_blocks, self.block_size, self.torch_settings)
                     self.headphone_filter.storeInFDomain()
                     continue
 
                 # Parse Source directiviy filters
-                if self.matfile[self.matvarname]['type'][0][row] == 'SD':
-                    filter_type = FilterType.directivity_Filter
-                    filter_value_list = np.concatenate([self.matfile[self.matvarname]['sourceOrientation'][0][row],
-                                        self.matfile[self.matvarname]['sourcePosition'][0][row],
-                                        self.matfile[self.matvarname]['custom'][0][row]], axis=1)
+                if matvar['type'][0][row] == 'SD':
+                    filter_value_list = np.concatenate([matvar['sourceOrientation'][0][row],
+                                                        matvar['sourcePosition'][0][row],
+                                                        matvar['custom'][0][row]], axis=1)
 
                     filter_pose = SourcePose.from_filterValueList(filter_value_list)
-
-                    current_filter = Filter(self.check_filter(filter_type, self.matfile[self.matvarname]['filter'][0][row]),
-                                            self.sd_blocks, self.block_size, self.torch_settings)
-
-                    current_filter.storeInFDomain()
-
-                    # create key and store in dict
-                    key = filter_pose.create_key()
-                    self.sd_filter_dict.update({key: current_filter})
-
+                    entries[FilterType.directivity_Filter].append((filter_pose.create_key(),
+                                                                   matvar['filter'][0][row]))
                     continue
 
                 # Parse all other filters
-                filter_value_list = np.concatenate((self.matfile[self.matvarname]['listenerOrientation'][0][row],
-                                    self.matfile[self.matvarname]['listenerPosition'][0][row],
-                                    self.matfile[self.matvarname]['sourceOrientation'][0][row],
-                                    self.matfile[self.matvarname]['sourcePosition'][0][row],
-                                    self.matfile[self.matvarname]['custom'][0][row]), axis=1)
+                filter_value_list = np.concatenate((matvar['listenerOrientation'][0][row],
+                                                    matvar['listenerPosition'][0][row],
+                                                    matvar['sourceOrientation'][0][row],
+                                                    matvar['sourcePosition'][0][row],
+                                                    matvar['custom'][0][row]), axis=1)
 
                 filter_pose = Pose.from_filterValueList(filter_value_list)
 
-                if self.matfile[self.matvarname]['type'][0][row] == 'DS':
+                if matvar['type'][0][row] == 'DS':
                     filter_type = FilterType.ds_Filter
-
-                    current_filter = Filter(self.check_filter(filter_type, self.matfile[self.matvarname]['filter'][0][row]),
-                                            self.ds_blocks, self.block_size,
-                                            self.torch_settings)
-
-                    current_filter.storeInFDomain()
-
-                    # create key and store in dict
-                    key = filter_pose.create_key()
-                    self.ds_filter_dict.update({key: current_filter})
-
-                elif self.matfile[self.matvarname]['type'][0][row] == 'ER':
+                elif matvar['type'][0][row] == 'ER':
                     filter_type = FilterType.early_Filter
-
-                    current_filter = Filter(self.check_filter(filter_type, self.matfile[self.matvarname]['filter'][0][row]),
-                                            self.early_blocks, self.block_size,
-                                            self.torch_settings)
-
-                    current_filter.storeInFDomain()
-
-                    # create key and store in dict
-                    key = filter_pose.create_key()
-                    self.early_filter_dict.update({key: current_filter})
-
-                elif self.matfile[self.matvarname]['type'][0][row] == 'LR':
+                elif matvar['type'][0][row] == 'LR':
                     filter_type = FilterType.late_Filter
-
-                    current_filter = Filter(self.check_filter(filter_type, self.matfile[self.matvarname]['filter'][0][row]),
-                                            self.late_blocks, self.block_size,
-                                            self.torch_settings)
-
-                    current_filter.storeInFDomain()
-
-                    # create key and store in dict
-                    key = filter_pose.create_key()
-                    self.late_filter_dict.update({key: current_filter})
-
                 else:
                     filter_type = FilterType.Undefined
                     raise RuntimeError("Filter indentifier wrong or missing")
 
+                entries[filter_type].append((filter_pose.create_key(), matvar['filter'][0][row]))
+
             # Delete parsed variable
             self.matfile.pop(self.matvarname)
 
+        # all filters of a type are stored in one FilterBank
+        with ThreadPoolExecutor(self.loading_threads, thread_name_prefix="pybinsim-loading") as executor:
+            for filter_type, type_entries in entries.items():
+                self.store_filters(filter_type, [(key, partial(self.check_filter, filter_type, mat_filter))
+                                                 for key, mat_filter in type_entries], executor)
+
         # clear whole matfile after parsing
         self.matfile = []
 
+    def get_filter_stage(self, filter_type):
+        """ Dict, number of blocks, partitioning and silence threshold of the filters of a type """
+        if filter_type == FilterType.ds_Filter:
+            return self.ds_filter_dict, self.ds_blocks, self.ds_partitioning, self.silence_threshold
+        if filter_type == FilterType.early_Filter:
+            return self.early_filter_dict, self.early_blocks, self.early_partitioning, self.silence_threshold
+        if filter_type == FilterType.late_Filter:
+            return self.late_filter_dict, self.late_blocks, self.late_partitioning, self.silence_threshold
+        if filter_type == FilterType.directivity_Filter:
+            return self.sd_filter_dict, self.sd_blocks, None, -200.
+
+        raise RuntimeError("No stored filters of type {}".format(filter_type))
+
+    def store_filters(self, filter_type, entries, executor):
+        """
+        Load filters on the threads of executor and transform them to the frequency domain in batches.
+        The spectra of all filters are stored in one FilterBank.
+
+        :param filter_type: type of all filters
+        :param entries: list of (key, load) tuples, load() returns the time domain filter checked by check_filter
+        :param executor: executor for loading the filters
+        """
+        filter_dict, blocks, partitioning, silence_threshold = self.get_filter_stage(filter_type)
+        torch_device = torch.device(self.torch_settings)
+
+        # composing the headphone filter on the loading threads needs it in the time domain
+        if self.headphone_composition and self.headphone_ir is None:
+            self.headphone_ir = self.get_headphone_filter().getImpulseResponse().cpu()
+
+        if not entries:
+            return
+
+        segments = None
+        active_partitions = []
+        for start in range(0, len(entries), FILTER_BATCH_SIZE):
+            batch = entries[start:start + FILTER_BATCH_SIZE]
+
+            irs = list(executor.map(lambda entry: entry[1](), batch))
+            # mono filters are used for both ears, like in Filter
+            irs = np.stack([ir if ir.shape[1] == 2 else ir[:, [0, 0]] for ir in irs])
+            irs = torch.as_tensor(irs, dtype=torch.float32, device=torch_device).permute(0, 2, 1).contiguous()
+
+            spectra, batch_active_partitions = transform_filters(irs, self.block_size, partitioning,
+                                                                 silence_threshold)
+
+            if segments is None:
+                segments = [torch.empty((len(entries),) + spectrum.shape[1:], dtype=spectrum.dtype,
+                                        device=torch_device) for spectrum in spectra]
+            for segment, spectrum in zip(segments, spectra):
+                segment[start:start + len(batch)] = spectrum
+            active_partitions += batch_active_partitions
+
+        bank = FilterBank(segments, active_partitions, [key for key, _ in entries], blocks, self.block_size,
+                          self.torch_settings, partitioning=partitioning, silence_threshold=silence_threshold)
+        filter_dict.update(bank.get_filter_dict())
+
+    def load_mat_headphone_filter(self):
+        """ Load the headphone filter from the mat file before all other filters """
+        for var in range(len(self.mat_vars)):
+            matvar = self.matfile[self.mat_vars[var][0]]
+
+            for row in range(matvar.shape[1]):
+                if matvar['type'][0][row] == 'HP':
+                    self.headphone_filter = Filter(self.check_filter(FilterType.headphone_Filter, matvar['filter'][0][row]),
+                                                   self.headphone_ir_blocks, self.block_size, self.torch_settings)
+                    self.headphone_filter.storeInFDomain()
+                    return
+
+        raise RuntimeError("Headphone filter not found for composition")
+
     def parse_filter_list(self):
         """
         Generator for filter list lines
@@ -378,6 +735,10 @@ class FilterStorage(object):
 #            key = pose.create_key()
 #            self.filter_dict.update({key: current_filter})
 
+        # filters of each type with their keys, loaded and transformed by store_filters
+        entries = {filter_type: [] for filter_type in (FilterType.ds_Filter, FilterType.early_Filter,
+                                                       FilterType.late_Filter)}
+
         for filter_pose, filter_path, filter_type in parsed_filter_list:
             # Skip undefined types (e.g. old format)
             if filter_type == FilterType.Undefined:
@@ -391,35 +752,12 @@ class FilterStorage(object):
                 raise FileNotFoundError(f'File {fn_filter} is missing.')
             
             self.log.debug(f'Loading {filter_path}')
-            if filter_type == FilterType.ds_Filter:
-                # preprocess filters and put them in a dict
-                current_filter = Filter(self.load_wav_filter(filter_path, filter_type), self.ds_blocks, self.block_size, self.torch_settings)
-
-                current_filter.storeInFDomain()
-                
-                # create key and store in dict
-                key = filter_pose.create_key()
-                self.ds_filter_dict.update({key: current_filter})
-            
-            if filter_type == FilterType.early_Filter:
-                # preprocess late reverb filters and put them in a separate dict
-                current_filter = Filter(self.load_wav_filter(filter_path, filter_type), self.early_blocks, self.block_size, self.torch_settings)
+            entries[filter_type].append((filter_pose.create_key(), partial(self.load_wav_filter, filter_path,
+                                                                           filter_type)))
 
-                current_filter.storeInFDomain()
-                
-                #create key and store in dict
-                key = filter_pose.create_key()
-                self.early_filter_dict.update({key: current_filter})
-
-            if filter_type == FilterType.late_Filter:
-                # preprocess late reverb filters and put them in a separate dict
-                current_filter = Filter(self.load_wav_filter(filter_path, filter_type), self.late_blocks, self.block_size, self.torch_settings)
-
-                current_filter.storeInFDomain()
-
-                # create key and store in dict
-                key = filter_pose.create_key()
-                self.late_filter_dict.update({key: current_filter})
+        with ThreadPoolExecutor(self.loading_threads, thread_name_prefix="pybinsim-loading") as executor:
+            for filter_type, type_entries in entries.items():
+                self.store_filters(filter_type, type_entries, executor)
         
         end = time.time()
         self.log.info("Finished loading filters in" + str(end-start) + "sec.")
@@ -428,7 +766,8 @@ class FilterStorage(object):
     def get_sd_filter(self, source_pose):
         """
         Searches in the dict if key is available and return corresponding filter
-        When no filter is found, defaultFilter is returned which results in silence
+        When no filter is found, the filter of the nearest key is returned with nearest neighbour lookup,
+        otherwise defaultFilter is returned which results in silence
 
         :param source_pose
         :return: corresponding filter for pose
@@ -439,17 +778,63 @@ class FilterStorage(object):
         if key in self.sd_filter_dict:
             #self.log.info("Filter found: key: {}".format(key))
             result_filter = self.sd_filter_dict.get(key)
-            if result_filter.filename is not None:
-                self.log.info("   use file:: {}".format(result_filter.filename))
-            return result_filter
         else:
-            self.log.warning('Filter not found: key: {}'.format(key))
-            return self.default_sd_filter
+            result_filter = self.find_nearest_filter(self.sd_pose_index, self.sd_filter_dict, key)
+            if result_filter is None:
+                self.log.warning('Filter not found: key: %s', key)
+                return self.default_sd_filter
+
+        if result_filter.filename is not None:
+            self.log.info("   use file:: %s", result_filter.filename)
+        return result_filter
+
+    def find_nearest_filter(self, pose_index, filter_dict, key):
+        """
+        Filter of the stored key nearest to key
+
+        :param pose_index: PoseIndex of the keys of filter_dict or None
+        :return: filter or None, if there is no pose index or no stored key within the maximum distance
+        """
+        if pose_index is None:
+            return None
+
+        nearest_key, distance = pose_index.query(key)
+        if nearest_key is None:
+            return None
+
+        self.log.debug('Using nearest filter (distance %s) for key: %s', distance, key)
+        return filter_dict[nearest_key]
+
+    def get_ds_sd_filter(self, ds_filter, sd_filter):
+        """
+        Returns the composition of a ds filter with a source directivity filter.
+        Composed filters are cached for each pair of filters. Composing a filter takes several FFTs, so this
+        should not be called by the audio thread (BinSim uses the FilterUpdater for it).
+
+        :param ds_filter: filter returned by get_ds_filter
+        :param sd_filter: filter returned by get_sd_filter
+        :return: filter applying both filters in series
+        """
+        return self.ds_sd_filter_lru.get((ds_filter, sd_filter),
+                                         partial(self.compose_ds_sd_filter, ds_filter, sd_filter))
+
+    def compose_ds_sd_filter(self, ds_filter, sd_filter):
+        """ Composition of a ds filter with a source directivity filter, see get_ds_sd_filter """
+        ir = compose_impulse_responses(ds_filter.getImpulseResponse(), sd_filter.getImpulseResponse())
+        ir = ir[:, :self.ds_blocks*self.block_size]
+        ir = torch.nn.functional.pad(ir, (0, self.ds_blocks*self.block_size - ir.shape[1]))
+
+        composed_filter = Filter(ir.T.cpu().numpy(), self.ds_blocks, self.block_size, self.torch_settings,
+                                 partitioning=self.ds_partitioning, silence_threshold=self.silence_threshold)
+        composed_filter.storeInFDomain()
+
+        return composed_filter
 
     def get_ds_filter(self, pose):
         """
         Searches in the dict if key is available and return corresponding filter
-        When no filter is found, defaultFilter is returned which results in silence
+        When no filter is found, the filter of the nearest key is returned with nearest neighbour lookup,
+        otherwise defaultFilter is returned which results in silence
 
         :param pose
         :return: corresponding filter for pose
@@ -460,17 +845,20 @@ class FilterStorage(object):
         try:
             result_filter = self.ds_filter_dict[key]
         except KeyError as err:
-            self.log.warning('Filter not found: key: {}'.format(key))
-            return self.default_ds_filter
+            result_filter = self.find_nearest_filter(self.ds_pose_index, self.ds_filter_dict, key)
+            if result_filter is None:
+                self.log.warning('Filter not found: key: %s', key)
+                return self.default_ds_filter
         
         if result_filter.filename is not None:
-            self.log.info("   use file:: {}".format(result_filter.filename))
+            self.log.info("   use file:: %s", result_filter.filename)
         return result_filter
 
     def get_early_filter(self, pose):
         """
         Searches in the dict if key is available and return corresponding filter
-        When no filter is found, defaultFilter is returned which results in silence
+        When no filter is found, the filter of the nearest key is returned with nearest neighbour lookup,
+        otherwise defaultFilter is returned which results in silence
 
         :param pose
         :return: corresponding filter for pose
@@ -481,17 +869,20 @@ class FilterStorage(object):
         try:
             result_filter = self.early_filter_dict[key]
         except KeyError as err:
-            self.log.warning('Filter not found: key: {}'.format(key))
-            return self.default_early_filter
+            result_filter = self.find_nearest_filter(self.early_pose_index, self.early_filter_dict, key)
+            if result_filter is None:
+                self.log.warning('Filter not found: key: %s', key)
+                return self.default_early_filter
         
         if result_filter.filename is not None:
-            self.log.info("   use file:: {}".format(result_filter.filename))
+            self.log.info("   use file:: %s", result_filter.filename)
         return result_filter
 
     def get_late_filter(self, pose):
         """
         Searches in the dict if key is available and return corresponding filter
-        When no filter is found, defaultFilter is returned which results in silence
+        When no filter is found, the filter of the nearest key is returned with nearest neighbour lookup,
+        otherwise defaultFilter is returned which results in silence
 
         :param pose
         :return: corresponding filter for pose
@@ -502,11 +893,13 @@ class FilterStorage(object):
         try:
             result_filter = self.late_filter_dict[key]
         except KeyError as err:
-            self.log.warning('Filter not found: key: {}'.format(key))
-            return self.default_late_filter
+            result_filter = self.find_nearest_filter(self.late_pose_index, self.late_filter_dict, key)
+            if result_filter is None:
+                self.log.warning('Filter not found: key: %s', key)
+                return self.default_late_filter
         
         if result_filter.filename is not None:
-            self.log.info("   use file:: {}".format(result_filter.filename))
+            self.log.info("   use file:: %s", result_filter.filename)
         return result_filter
 
     def get_headphone_filter(self):
@@ -567,7 +960,42 @@ class FilterStorage(object):
                 current_filter = np.concatenate((current_filter, np.zeros(
                     (self.headPhoneFilterSize - filter_size[0], 2), np.float32)), 0)
 
+        if filter_type == FilterType.ds_Filter:
+            current_filter = self.extend_filter(current_filter, self.ds_blocks*self.block_size)
+        elif filter_type == FilterType.early_Filter:
+            current_filter = self.extend_filter(current_filter, self.early_blocks*self.block_size)
+        elif filter_type == FilterType.late_Filter:
+            current_filter = self.extend_filter(current_filter, self.late_blocks*self.block_size)
+
+        return current_filter
+
+    def extend_filter(self, current_filter, filter_size):
+        """ Compose the headphone filter into a filter and zero pad it to the extended filter size """
+        if self.headphone_composition:
+            if self.headphone_ir is None:
+                self.headphone_ir = self.get_headphone_filter().getImpulseResponse().cpu()
+
+            ir = torch.as_tensor(np.asarray(current_filter, dtype=np.float32).T)
+            if ir.shape[0] != 2:
+                ir = ir[:1].expand(2, -1)
+            current_filter = compose_impulse_responses(ir, self.headphone_ir).T.numpy()
+
+        if current_filter.shape[0] < filter_size:
+            current_filter = np.concatenate((current_filter, np.zeros(
+                (filter_size - current_filter.shape[0], current_filter.shape[1]), np.float32)), 0)
+
         return current_filter
 
+    def get_cache_statistics(self):
+        """ Hits, misses, evictions and resident bytes of the lazy filter storage, None if not used """
+        if self.filter_lru is None:
+            return None
+
+        return self.filter_lru.get_statistics()
+
     def close(self):
-        self.log.info('FilterStorage: close()')
\ No newline at end of file
+        self.log.info('FilterStorage: close()')
+        if self.filter_lru is not None:
+            self.log.info("Lazy filter storage: {}".format(self.filter_lru.get_statistics()))
+        if self.directivity_composition:
+            self.log.info("Composed filters: {}".format(self.ds_sd_filter_lru.get_statistics()))
\ No newline at end of file
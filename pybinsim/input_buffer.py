@@ -52,6 +52,14 @@ class InputBufferMulti(object):
 
         self.fft_buffer = torch.zeros(self.inputs, self.block_size + 1, dtype=torch.complex64, device=self.torch_device)
 
+        # The two halves of buffer are used as ring: new blocks are written alternately to the second and the first
+        # half instead of shifting the buffer. With the newest block in the first half, the buffer is rotated by
+        # block_size, which multiplies the spectrum with (-1)^k. The signs are complex, a real tensor would be
+        # converted to complex (and allocated) by every multiplication.
+        self.write_half = 1
+        self.rotation_sign = torch.ones(self.block_size + 1, dtype=torch.complex64, device=self.torch_device)
+        self.rotation_sign[1::2] = -1
+
         self.processCounter = 0
 
         end = default_timer()
@@ -80,13 +88,15 @@ class InputBufferMulti(object):
         :param block: Mono sound block
         :return: None
         """
-        # shift buffer
-        self.buffer[:, :self.block_size] = self.buffer[:, self.block_size:]
-
-        # insert new block to buffer
-        self.buffer[:, self.block_size:] = block
+        # insert new block over the oldest one
+        start = self.write_half * self.block_size
+        self.buffer[:, start:start + self.block_size] = block
 
         torch.fft.rfftn(self.buffer, dim=1, out=self.fft_buffer)
+        if self.write_half == 0:
+            self.fft_buffer.mul_(self.rotation_sign)
+
+        self.write_half = 1 - self.write_half
         return self.fft_buffer
 
     def process(self, block: torch.Tensor):
@@ -0,0 +1,330 @@
+# This file is part of the pyBinSim project.
+#
+# Copyright (c) 2017 A. Neidhardt, F. Klein, N. Knoop, T. Köllmer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+NumPy engine for the convolution
+
+InputBufferNumpy and ConvolverNumpy can be used in place of InputBufferMulti and ConvolverTorch
+(process, setAllFilters, setFilter, stageFilter, publishFilters, get_counter, get_memory_footprint, close).
+The FFTs are computed with scipy.fft (pocketfft) on the CPU. At small block sizes this avoids the
+dispatch overhead of torch, which can exceed the arithmetic.
+"""
+
+import logging
+from timeit import default_timer
+from typing import List
+
+import numpy as np
+import scipy.fft
+import torch
+
+from pybinsim.filterstorage import Filter
+
+
+class InputBufferNumpy(object):
+    """
+    InputBufferMulti computing the input spectra with scipy.fft
+    """
+
+    def __init__(self, block_size, inputs):
+        self.log = logging.getLogger("pybinsim.input_buffer")
+        self.log.info("Input_buffer: Init (numpy)")
+
+        self.block_size = block_size
+        self.inputs = inputs
+
+        # Create Input Buffers
+        self.buffer = np.zeros((self.inputs, self.block_size * 2), dtype=np.float32)
+
+        self.processCounter = 0
+
+    def get_counter(self):
+        """
+        Returns processing counter
+        :return: processing counter
+        """
+        return self.processCounter
+
+    def process(self, block):
+        """
+        Main function
+
+        :param block: time domain block [inputs, block_size] as numpy array or torch tensor on the CPU
+        :return: input spectra [inputs, block_size+1]
+        """
+        # shift buffer and insert new block
+        self.buffer[:, :self.block_size] = self.buffer[:, self.block_size:]
+        self.buffer[:, self.block_size:] = block
+
+        self.processCounter += 1
+
+        # single precision input gives single precision spectra
+        return scipy.fft.rfft(self.buffer, axis=1)
+
+    def close(self):
+        self.log.info("Input_buffer: close")
+
+
+class ConvolverNumpy(object):
+    """
+    ConvolverTorch for uniformly partitioned convolution with NumPy.
+    The products and sums of the multiply and accumulate are written to preallocated buffers.
+    The output is returned as torch tensor sharing the memory of the output buffer.
+    """
+
+    def __init__(self, ir_size: int, block_size: int, stereoInput: bool, sources: int, interpolate: bool):
+        start = default_timer()
+
+        self.log = logging.getLogger("pybinsim.ConvolverNumpy")
+        self.log.info("Convolver: Start Init")
+
+        self.IR_size = ir_size
+        self.block_size = block_size
+        self.sources = sources
+
+        self.stereoInput = stereoInput
+        if self.stereoInput:
+            self.log.info("Convolver used for stereo input")
+            self.sources = 1
+
+        self.IR_blocks = self.IR_size // block_size
+
+        block_time_in_samples = np.arange(0, self.block_size, dtype=np.float32)
+        self.crossFadeOut = np.square(np.cos(block_time_in_samples / (self.block_size - 1) * (np.pi / 2)),
+                                      dtype=np.float32)
+        self.crossFadeIn = np.ascontiguousarray(np.flipud(self.crossFadeOut))
+
+        # Filter format: [2, nBlocks*sources, blockSize+1] (2 for left, right), see ConvolverTorch
+        self.filters_blocked = np.zeros((2, self.IR_blocks * self.sources, self.block_size + 1), dtype=np.complex64)
+        self.complex_buffer = np.zeros_like(self.filters_blocked)
+
+        self.interpolate = interpolate
+
+        # Filter objects currently set for each source and sources whose filter changed since the last block
+        self.current_filters = [None] * self.sources
+        self.changed_sources = []
+
+        # Spectra of the last processed block, equal to filters_blocked except for the sources in changed_sources
+        self.previous_filters_blocked = None
+        if self.interpolate:
+            self.previous_filters_blocked = np.zeros_like(self.filters_blocked)
+
+        self.filter_segment = 0
+
+        # Range (first, end) of the filter partitions, which are not silent, see ConvolverTorch
+        self.partition_ranges = [(0, 0)] * self.sources
+        self.active_partitions = (0, 0)
+
+        # Filters handed over by publishFilters(), see ConvolverTorch.stageFilter
+        self.staged_filters = {}
+        self.pending_filters = None
+
+        # FDL ring buffer: [1 or 2, nBlocks*sources, blockSize+1], the position moves backwards
+        self.fdl_channels = 2 if self.stereoInput else 1
+        self.frequency_domain_input = np.zeros((self.fdl_channels, self.IR_blocks * self.sources, self.block_size + 1),
+                                               dtype=np.complex64)
+        self.fdl_position = 0
+
+        self.resultFreq = np.zeros((2, 1, self.block_size + 1), dtype=np.complex64)
+        self.differenceFreq = None
+        if self.interpolate:
+            self.differenceFreq = np.zeros((2, 1, self.block_size + 1), dtype=np.complex64)
+
+        self.output = np.zeros((2, 1, self.block_size), dtype=np.float32)
+        self.output_tensor = torch.from_numpy(self.output)
+        self.outputEmpty = torch.zeros(2, 1, self.block_size, dtype=torch.float32)
+
+        # Counts how often process() is called
+        self.processCounter = 0
+
+        self.active = True
+
+        end = default_timer()
+        delta = end - start
+        self.log.info("Convolver: Finished Init (took {}s)".format(delta))
+
+    def get_counter(self):
+        """
+        Returns processing counter
+        :return: processing counter
+        """
+        return self.processCounter
+
+    def get_memory_footprint(self):
+        """
+        Returns the memory used by the buffers of the convolver in bytes.
+        """
+        arrays = [self.filters_blocked, self.complex_buffer, self.previous_filters_blocked,
+                  self.frequency_domain_input, self.resultFreq, self.differenceFreq, self.output]
+
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def setAllFilters(self, filters: List[Filter], segment: int = 0):
+        """
+        Set filters for all sources
+
+        :param filters: one filter per source
+        :param segment: filter segment to use
+        """
+        # crossfade from the filters set before this call
+        self.changed_sources.clear()
+
+        for i in range(self.sources):
+            self.setFilter(i, filters[i], segment)
+
+    def setFilter(self, source_index: int, filter: Filter, segment: int = 0):
+        """
+        Set filter for a single source
+
+        :param source_index: index of the source
+        :param filter: new filter
+        :param segment: filter segment to use
+        """
+        if filter is self.current_filters[source_index]:
+            return
+
+        self.filter_segment = segment
+        self._applyFilter(source_index, filter, filter.getFilterFD(segment).cpu().numpy())
+
+    def stageFilter(self, source_index: int, filter: Filter, segment: int = 0):
+        """
+        Prepare filter for a single source without changing the filters in use.
+        Staged filters are used after publishFilters() from the next processed block on.
+        Must only be called from one thread, which is not the audio thread.
+        """
+        self.filter_segment = segment
+        self.staged_filters[source_index] = (filter, filter.getFilterFD(segment).cpu().numpy())
+
+    def publishFilters(self):
+        """
+        Hand the staged filters over to the audio thread.
+
+        :return: False if the last published filters were not picked up yet and the staged filters are kept
+        """
+        if not self.staged_filters:
+            return True
+
+        if self.pending_filters is not None:
+            return False
+
+        self.pending_filters = self.staged_filters
+        self.staged_filters = {}
+
+        return True
+
+    def applyPendingFilters(self):
+        """ Use the filters published by publishFilters(). Called by the audio thread before processing a block """
+        pending = self.pending_filters
+        if pending is None:
+            return
+
+        for source_index, (filter, filter_fd) in pending.items():
+            self._applyFilter(source_index, filter, filter_fd)
+
+        self.pending_filters = None
+
+    def _applyFilter(self, source_index: int, filter: Filter, filter_fd):
+        if filter is self.current_filters[source_index]:
+            return
+
+        source = slice(source_index, None, self.sources)
+
+        if source_index not in self.changed_sources:
+            # keep the filter of the last processed block for crossfading in the next block
+            if self.previous_filters_blocked is not None:
+                self.previous_filters_blocked[:, source, :] = self.filters_blocked[:, source, :]
+            self.changed_sources.append(source_index)
+
+        self.filters_blocked[:, source, :] = filter_fd
+        self.current_filters[source_index] = filter
+
+        self.partition_ranges[source_index] = filter.getActivePartitions(self.filter_segment)
+        ranges = [partition_range for partition_range in self.partition_ranges if partition_range[0] < partition_range[1]]
+        if ranges:
+            self.active_partitions = (min(first for first, _ in ranges),
+                                      min(max(end for _, end in ranges), self.IR_blocks))
+        else:
+            self.active_partitions = (0, 0)
+
+    def process(self, input_buffer, block=None):
+        # block (time domain input) is ignored, like in ConvolverTorch
+        self.applyPendingFilters()
+
+        if not self.active:
+            return self.outputEmpty
+
+        self.fdl_position = (self.fdl_position - 1) % self.IR_blocks
+        start = self.fdl_position * self.sources
+
+        if self.stereoInput:
+            self.frequency_domain_input[:, start, :] = input_buffer
+        else:
+            self.frequency_domain_input[0, start:start + self.sources, :] = input_buffer
+
+        self.multiply_accumulate(self.filters_blocked, self.resultFreq)
+        self.output[:] = scipy.fft.irfft(self.resultFreq, n=self.block_size * 2, axis=2)[:, :, self.block_size:]
+
+        # crossfade only in the block after a filter change, see ConvolverTorch.accumulate_crossfade_difference
+        if self.interpolate and self.changed_sources:
+            np.subtract(self.previous_filters_blocked, self.filters_blocked, out=self.previous_filters_blocked)
+            self.multiply_accumulate(self.previous_filters_blocked, self.differenceFreq, full=True)
+            output_difference = scipy.fft.irfft(self.differenceFreq, n=self.block_size * 2, axis=2)[:, :, self.block_size:]
+            self.output += output_difference * self.crossFadeOut
+
+            # previous and current filters are equal for all sources until the next change
+            np.copyto(self.previous_filters_blocked, self.filters_blocked)
+
+        self.changed_sources.clear()
+
+        self.processCounter += 1
+
+        return self.output_tensor
+
+    def multiply_accumulate(self, filters_blocked, result, full=False):
+        """
+        Multiply the filters with the FDL and accumulate over blocks and sources
+
+        :param filters_blocked: filters in the format of filters_blocked
+        :param result: spectrum [2, 1, blockSize+1] for the result
+        :param full: process all partitions instead of the active partitions
+        """
+        first, end = (0, self.IR_blocks) if full else self.active_partitions
+        first *= self.sources
+        end *= self.sources
+        if first >= end:
+            result[:] = 0
+            return
+
+        fdl = self.frequency_domain_input
+        start = (self.fdl_position * self.sources + first) % fdl.shape[1]
+        split = min(end - first, fdl.shape[1] - start)
+        wrapped = end - first - split
+
+        np.multiply(filters_blocked[:, first:first + split, :], fdl[:, start:start + split, :],
+                    out=self.complex_buffer[:, :split, :])
+        np.multiply(filters_blocked[:, first + split:end, :], fdl[:, :wrapped, :],
+                    out=self.complex_buffer[:, split:end - first, :])
+
+        np.sum(self.complex_buffer[:, :end - first, :], axis=1, keepdims=True, out=result)
+
+    def close(self):
+        self.log.info("Convolver: close")
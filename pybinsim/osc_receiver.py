@@ -110,24 +110,28 @@ class OscReceiver(PkgReceiver):
         osc_thread = threading.Thread(target=self.server.serve_forever)
         osc_thread.daemon = True
         osc_thread.start()
+        self.threads.append(osc_thread)
 
         self.log.info("Serving on {}".format(self.server2.server_address))
 
         osc_thread2 = threading.Thread(target=self.server2.serve_forever)
         osc_thread2.daemon = True
         osc_thread2.start()
+        self.threads.append(osc_thread2)
 
         self.log.info("Serving on {}".format(self.server3.server_address))
 
         osc_thread3 = threading.Thread(target=self.server3.serve_forever)
         osc_thread3.daemon = True
         osc_thread3.start()
+        self.threads.append(osc_thread3)
 
         self.log.info("Serving on {}".format(self.server4.server_address))
 
         osc_thread4 = threading.Thread(target=self.server4.serve_forever)
         osc_thread4.daemon = True
         osc_thread4.start()
+        self.threads.append(osc_thread4)
 
     def close(self):
         """
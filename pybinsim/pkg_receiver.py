@@ -18,15 +18,22 @@ class PkgReceiver(object):
         self.ip = current_config.get('recv_ip')
         self.port = current_config.get('recv_port')
         self.proto = current_config.get('recv_protocol')
+
+        # Threads receiving the messages, started by start_listening
+        self.threads = []
         self.maxChannels = 100
 
         self.currentConfig = current_config
 
-        # Default values; Stores filter keys for all channels/convolvers
-        self.ds_filters_updated = [True] * self.maxChannels
-        self.early_filters_updated = [True] * self.maxChannels
-        self.late_filters_updated = [True] * self.maxChannels
-        self.sd_filters_updated = [True] * self.maxChannels
+        # Channels with new filter values. Entries are added by the receiver threads and removed with set.pop()
+        # by the audio thread or the FilterUpdater; both are atomic, so no lock is needed
+        self.ds_dirty_channels = set(range(self.maxChannels))
+        self.early_dirty_channels = set(range(self.maxChannels))
+        self.late_dirty_channels = set(range(self.maxChannels))
+        self.sd_dirty_channels = set(range(self.maxChannels))
+
+        # Set whenever a channel is added to one of the dirty sets, wakes up the FilterUpdater
+        self.filter_update_event = threading.Event()
 
         self.default_filter_value = np.zeros((1, 15))
         self.default_sd_filter_value = np.zeros((1, 9))
@@ -91,8 +98,9 @@ class PkgReceiver(object):
             if all(args == self.valueList_ds_filter[current_channel, key_slice]):
                 self.log.debug("Same direct sound filter as before")
             else:
-                self.ds_filters_updated[current_channel] = True
                 self.valueList_ds_filter[current_channel, key_slice] = args
+                self.ds_dirty_channels.add(current_channel)
+                self.filter_update_event.set()
         else:
             self.log.warning("OSC identifier and key mismatch")
             self.log.warning(f"key_slice: {key_slice}; args: {len(args)}")
@@ -118,8 +126,9 @@ class PkgReceiver(object):
             if all(args == self.valueList_early_filter[current_channel, key_slice]):
                 self.log.debug("Same early filter as before")
             else:
-                self.early_filters_updated[current_channel] = True
                 self.valueList_early_filter[current_channel, key_slice] = args
+                self.early_dirty_channels.add(current_channel)
+                self.filter_update_event.set()
         else:
             self.log.warning('OSC identifier and key mismatch')
 
@@ -143,8 +152,9 @@ class PkgReceiver(object):
             if all(args == self.valueList_late_filter[current_channel, key_slice]):
                 self.log.debug("Same late  filter as before")
             else:
-                self.late_filters_updated[current_channel] = True
                 self.valueList_late_filter[current_channel, key_slice] = args
+                self.late_dirty_channels.add(current_channel)
+                self.filter_update_event.set()
         else:
             self.log.warning('OSC identifier and key mismatch')
 
@@ -171,8 +181,9 @@ class PkgReceiver(object):
             if all(args == self.valueList_sd_filter[current_channel, key_slice]):
                 self.log.debug("Same direct sound filter as before")
             else:
-                self.sd_filters_updated[current_channel] = True
                 self.valueList_sd_filter[current_channel, key_slice] = args
+                self.sd_dirty_channels.add(current_channel)
+                self.filter_update_event.set()
         else:
             self.log.warning("OSC identifier and key mismatch")
 
@@ -285,40 +296,20 @@ class PkgReceiver(object):
         self.currentConfig.set('loudnessFactor', float(value))
         self.log.info("Changing loudness")
 
-    def is_ds_filter_update_necessary(self, channel):
-        """ Check if there is a new direct filter for channel """
-        return self.ds_filters_updated[channel]
-
-    def is_early_filter_update_necessary(self, channel):
-        """ Check if there is a new early reverb filter for channel """
-        return self.early_filters_updated[channel]
-
-    def is_late_filter_update_necessary(self, channel):
-        """ Check if there is a new late reverb filter for channel """
-        return self.late_filters_updated[channel]
-
-    def is_sd_filter_update_necessary(self, channel):
-        """ Check if there is a new source directivity filter for channel """
-        return self.sd_filters_updated[channel]
-
     def get_current_ds_filter_values(self, channel):
         """ Return key for filter """
-        self.ds_filters_updated[channel] = False
         return self.valueList_ds_filter[channel, :]
 
     def get_current_early_filter_values(self, channel):
         """ Return key for late reverb filters """
-        self.early_filters_updated[channel] = False
         return self.valueList_early_filter[channel, :]
 
     def get_current_late_filter_values(self, channel):
         """ Return key for late reverb filters """
-        self.late_filters_updated[channel] = False
         return self.valueList_late_filter[channel, :]
 
     def get_current_sd_filter_values(self, channel):
         """ Return key for source directivity filters """
-        self.sd_filters_updated[channel] = False
         return self.valueList_sd_filter[channel, :]
 
     def get_current_config(self):
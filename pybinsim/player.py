@@ -64,6 +64,9 @@ class Player(object):
 
         self._playback_queue: SimpleQueue[np.ndarray] = SimpleQueue()
 
+        # returned while paused or on queue underruns, must not be modified by the caller
+        self._zeros = np.zeros((1, self._block_size), dtype=np.float32)
+
         self._thread_pool = ThreadPoolExecutor(1)
 
         if filepaths:
@@ -89,11 +92,9 @@ class Player(object):
                     self._request_filling_queue()
             except Empty:
                 logger.warning('Playback queue empty')
-                # TODO remove allocation and benchmark
-                block = np.zeros((1, self._block_size), dtype=np.float32)
+                block = self._zeros
         elif self.play_state == PlayState.PAUSED:
-            # TODO remove allocation and benchmark
-            block = np.zeros((1, self._block_size), dtype=np.float32)
+            block = self._zeros
         else:
             block = None
 
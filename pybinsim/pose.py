@@ -30,6 +30,13 @@ class Pose:
     def create_key(self):
         return (self.listener_orientation, self.listener_position, self.source_orientation, self.source_position, self.custom)
 
+    @staticmethod
+    def key_from_array(values):
+        """ Inverse of np.asarray(key, dtype=np.float32).reshape(-1) for a key of create_key """
+        values = np.asarray(values, dtype=np.float32)
+        return (Orientation(*values[0:3]), Position(*values[3:6]), Orientation(*values[6:9]),
+                Position(*values[9:12]), Custom(*values[12:15]))
+
     @staticmethod
     def from_filterValueList(filter_value_list):
 
@@ -76,6 +83,12 @@ class SourcePose:
     def create_key(self):
         return (self.source_orientation, self.source_position, self.custom)
 
+    @staticmethod
+    def key_from_array(values):
+        """ Inverse of np.asarray(key, dtype=np.float32).reshape(-1) for a key of create_key """
+        values = np.asarray(values, dtype=np.float32)
+        return Orientation(*values[0:3]), Position(*values[3:6]), Custom(*values[6:9])
+
     @staticmethod
     def from_filterValueList(filter_value_list):
 
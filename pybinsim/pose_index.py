@@ -0,0 +1,125 @@
+# This file is part of the pyBinSim project.
+#
+# Copyright (c) 2017 A. Neidhardt, F. Klein, N. Knoop, T. Köllmer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Nearest neighbour lookup of filter keys
+
+Clients do not have to snap their poses to the grid of the stored filters: for a key without a stored filter,
+a PoseIndex returns the stored key with the smallest weighted distance. The keys are stored in a KD-tree, so a
+query takes some microseconds. Orientations are compared on the circle, i.e. 359 degrees are next to 0 degrees.
+"""
+
+import itertools
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from pybinsim.pose import Orientation
+
+
+def parse_pose_weights(weights: str):
+    """
+    Parse comma separated weights of the values of a Pose key (see Pose.create_key)
+
+    :param weights: 15 weights, one per value, or 5 weights for listener orientation, listener position,
+                    source orientation, source position and custom values
+    :return: array of 15 weights
+    """
+    values = np.array([float(weight) for weight in weights.split(',') if weight.strip()], dtype=np.float64)
+
+    if len(values) == 5:
+        values = np.repeat(values, 3)
+    if len(values) != 15:
+        raise ValueError("Expected 5 or 15 pose weights, got '{}'".format(weights))
+    if np.any(values < 0):
+        raise ValueError("Pose weights must not be negative: '{}'".format(weights))
+
+    return values
+
+
+class PoseIndex(object):
+    """
+    KD-tree over the keys of a filter dict
+
+    :param keys: keys of the stored filters, all of the same format (Pose or SourcePose keys)
+    :param weights: weight of each key value, the distance of two keys is the euclidean distance of the
+                    weighted values
+    :param max_distance: keys farther away than this are not returned
+    """
+
+    def __init__(self, keys, weights, max_distance=np.inf):
+        self.keys = list(keys)
+        self.max_distance = max_distance if max_distance > 0 else np.inf
+
+        # values with a weight of 0 are ignored
+        weights = np.asarray(weights, dtype=np.float64)
+        self.dimensions = np.flatnonzero(weights > 0)
+        self.weights = weights[self.dimensions]
+
+        self.tree = None
+        if not self.keys or len(self.dimensions) == 0:
+            return
+
+        # orientations wrap around at 360 degrees, a box size of 0 means no wrap around
+        periodic = np.concatenate([[isinstance(part, Orientation)] * len(part) for part in self.keys[0]])
+        periodic = periodic[self.dimensions]
+        self.periodic = np.flatnonzero(periodic)
+        self.periodic_boxsize = 360. * self.weights[self.periodic]
+
+        points = np.array([self.flatten(key) for key in self.keys])
+        self.tree = cKDTree(self.to_points(points), boxsize=np.where(periodic, 360. * self.weights, 0.))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def flatten(key):
+        """ Values of a key as array """
+        return np.fromiter(itertools.chain.from_iterable(key), dtype=np.float64)
+
+    def to_points(self, values):
+        """ Weighted values, orientations mapped to [0, 360) """
+        points = values[..., self.dimensions] * self.weights
+
+        periodic = np.mod(points[..., self.periodic], self.periodic_boxsize)
+        # np.mod of tiny negative values returns the box size itself
+        periodic[periodic >= self.periodic_boxsize] = 0.
+        points[..., self.periodic] = periodic
+
+        return points
+
+    def query(self, key):
+        """
+        Nearest stored key
+
+        :param key: key of a pose, e.g. from Pose.create_key()
+        :return: (nearest key, distance) or (None, inf) if no key is within max_distance
+        """
+        if self.tree is None:
+            return None, np.inf
+
+        point = self.to_points(self.flatten(key))
+        distance, index = self.tree.query(point, distance_upper_bound=self.max_distance)
+        if index == len(self.keys):
+            return None, np.inf
+
+        return self.keys[index], distance
@@ -0,0 +1,118 @@
+# This file is part of the pyBinSim project.
+#
+# Copyright (c) 2017 A. Neidhardt, F. Klein, N. Knoop, T. Köllmer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Scheduling of the threads of pyBinSim
+
+The functions take the native id of a thread (threading.Thread.native_id), 0 is the calling thread.
+On Linux, priority, nice level and CPU affinity are set for single threads. Settings, which are not supported
+by the operating system or not permitted for the user, are logged and skipped, so pyBinSim still runs.
+"""
+
+import logging
+import os
+
+import torch
+
+log = logging.getLogger("pybinsim.realtime")
+
+
+def parse_cpu_list(cpus: str) -> set:
+    """
+    Parse a list of CPUs like '2,3' or '0-1,4' as used by taskset
+
+    :param cpus: comma separated CPU numbers or ranges
+    :return: set of CPU numbers, empty for an empty string
+    """
+    cpu_set = set()
+    for entry in filter(None, cpus.split(',')):
+        first, _, last = entry.partition('-')
+        cpu_set.update(range(int(first), int(last or first) + 1))
+
+    return cpu_set
+
+
+def configure_thread(thread_id: int = 0, priority: int = 0, nice: int = 0, cpus: set = None, name: str = "thread"):
+    """
+    Set scheduling policy and CPU affinity of a thread
+
+    :param thread_id: native id of the thread, 0 for the calling thread
+    :param priority: SCHED_FIFO priority from 1 to 99, 0 keeps the scheduling policy
+    :param nice: nice level used when no priority is given, 0 keeps the nice level
+    :param cpus: CPUs the thread may run on, None or an empty set keeps the affinity
+    :param name: name of the thread for the log
+    :return: True if all settings were applied
+    """
+    applied = True
+
+    try:
+        if priority > 0:
+            os.sched_setscheduler(thread_id, os.SCHED_FIFO, os.sched_param(priority))
+            log.info("{}: SCHED_FIFO priority {}".format(name, priority))
+        elif nice != 0:
+            os.setpriority(os.PRIO_PROCESS, thread_id, nice)
+            log.info("{}: nice level {}".format(name, nice))
+    except (AttributeError, OSError) as e:
+        log.warning("{}: cannot set priority ({}), grant rtprio/nice in /etc/security/limits.conf".format(name, e))
+        applied = False
+
+    try:
+        if cpus:
+            os.sched_setaffinity(thread_id, cpus)
+            log.info("{}: running on CPUs {}".format(name, sorted(cpus)))
+    except (AttributeError, OSError) as e:
+        log.warning("{}: cannot set CPU affinity ({})".format(name, e))
+        applied = False
+
+    return applied
+
+
+def configure_torch_threads(intra_op_threads: int, inter_op_threads: int):
+    """
+    Set the sizes of the thread pools of torch, 0 keeps the default of torch.
+    Must be called before torch runs any parallel work.
+    """
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+        log.info("torch intra-op threads: {}".format(intra_op_threads))
+
+    if inter_op_threads > 0:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+            log.info("torch inter-op threads: {}".format(inter_op_threads))
+        except RuntimeError as e:
+            log.warning("Cannot set torch inter-op threads: {}".format(e))
+
+
+def flush_denormals():
+    """
+    Treat denormal floats as zero on the calling thread (flush-to-zero and denormals-are-zero on x86).
+    Decaying filter tails and fade-outs otherwise produce denormals, which are much slower to compute.
+
+    :return: True if supported by the CPU
+    """
+    supported = torch.set_flush_denormal(True)
+    if not supported:
+        log.warning("Flushing denormals is not supported on this CPU")
+
+    return supported
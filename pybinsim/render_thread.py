@@ -0,0 +1,149 @@
+# This file is part of the pyBinSim project.
+#
+# Copyright (c) 2017 A. Neidhardt, F. Klein, N. Knoop, T. Köllmer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Rendering ahead of the audio device
+
+The RenderThread renders blocks of blockSize into an OutputRingBuffer, until it holds the configured number
+of blocks. The callback of the audio device only copies the requested number of frames out of the ring buffer,
+so it does not depend on the block size of the device and has time until the ring buffer is empty.
+The device callback neither locks nor notifies, the RenderThread polls the ring buffer instead.
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+
+class OutputRingBuffer(object):
+    """
+    Ring buffer of output frames [frames, channels] for one writing and one reading thread.
+    Each thread only changes its own counter after copying the frames, so no lock is needed.
+    """
+
+    def __init__(self, capacity: int, channels: int = 2):
+        self.capacity = capacity
+        self.buffer = np.zeros((capacity, channels), dtype=np.float32)
+
+        # total number of frames written and read
+        self.write_count = 0
+        self.read_count = 0
+
+    def available(self):
+        """ Number of frames, which can be read """
+        return self.write_count - self.read_count
+
+    def free(self):
+        """ Number of frames, which can be written """
+        return self.capacity - self.available()
+
+    def write(self, frames):
+        """
+        Append frames, the caller must check free() before
+
+        :param frames: frames [frames, channels]
+        """
+        count = frames.shape[0]
+        start = self.write_count % self.capacity
+        first = min(count, self.capacity - start)
+
+        self.buffer[start:start + first] = frames[:first]
+        self.buffer[:count - first] = frames[first:]
+
+        self.write_count += count
+
+    def read(self, out):
+        """
+        Copy the next frames into out, missing frames are filled with zeros
+
+        :param out: array [frames, channels] to fill
+        :return: number of frames read
+        """
+        count = min(out.shape[0], self.available())
+        start = self.read_count % self.capacity
+        first = min(count, self.capacity - start)
+
+        out[:first] = self.buffer[start:start + first]
+        out[first:count] = self.buffer[:count - first]
+        out[count:] = 0
+
+        self.read_count += count
+
+        return count
+
+
+class RenderThread(object):
+    """
+    Calls render for each block, as long as the ring buffer has space for it, and polls the ring buffer
+    four times per block otherwise. After a refill, at least capacity - block_size + 1 frames can be read.
+
+    :param render: function like the callback of audio_callback: render(outdata, frame_count, time_info, status)
+    :param block_size: frames rendered per call
+    :param ring: OutputRingBuffer, its capacity is a multiple of block_size
+    :param sample_rate: sampling rate, sets the poll interval
+    """
+
+    def __init__(self, render, block_size: int, ring: OutputRingBuffer, sample_rate: int):
+        self.log = logging.getLogger("pybinsim.RenderThread")
+
+        self.render = render
+        self.block_size = block_size
+        self.ring = ring
+        self.block = np.zeros((block_size, ring.buffer.shape[1]), dtype=np.float32)
+
+        self.poll_interval = block_size / sample_rate / 4
+
+        self.running = False
+        # set when rendering raised an exception, the ring buffer is not filled anymore
+        self.failed = False
+        self.filled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="pybinsim-render", daemon=True)
+
+    def start(self):
+        """ Start rendering and wait until the ring buffer is filled """
+        self.log.info("RenderThread: rendering {} frames ahead".format(self.ring.capacity))
+
+        self.running = True
+        self.thread.start()
+        self.filled.wait()
+
+    def run(self):
+        try:
+            while self.running:
+                while self.ring.free() >= self.block_size:
+                    self.render(self.block, self.block_size, None, 0)
+                    self.ring.write(self.block)
+
+                self.filled.set()
+                time.sleep(self.poll_interval)
+        except Exception:
+            self.failed = True
+            self.log.exception("RenderThread: rendering failed, stopping audio output")
+        finally:
+            self.filled.set()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
@@ -66,6 +66,8 @@ class SoundHandler(object):
 
         self._output_buffer = np.zeros(
             (self._n_channels, self._block_size), dtype=np.float32)
+        # scaled player blocks are written here instead of allocating a new array
+        self._scale_buffer = np.zeros_like(self._output_buffer)
 
     def create_player(self, filepaths, player_name, start_channel=0, loop_state=LoopState.SINGLE, play_state=PlayState.PLAYING, volume=1.):
         entry = PlayerEntry(
@@ -122,11 +124,19 @@ class SoundHandler(object):
                         continue
                     volume = entry.volume * loudness
                     add_at_start_channel(
-                        self._output_buffer, volume * block, entry.start_channel)
+                        self._output_buffer, block, entry.start_channel, volume, self._scale_buffer)
             # TODO This might be better done in a background thread so it doesn't block the audio thread, but that needs some benchmarking
             self._remove_stopped_players()
         return self._output_buffer
 
+    def get_output_buffer(self):
+        """Return the internal buffer filled by `get_block` and `get_zeros`.
+
+        The buffer is never replaced, so e.g. a torch tensor sharing its memory
+        can be created once and used for every block.
+        """
+        return self._output_buffer
+
     def get_zeros(self):
         """Fill the internal buffer with zeros and return it.
 
@@ -154,11 +164,20 @@ class PlayerEntry:
     lock: threading.Lock
 
 
-def add_at_start_channel(output, input, start_channel):
-    """Add input to output at specified start_channel, ignoring channels outside of output."""
+def add_at_start_channel(output, input, start_channel, volume=1., scale_buffer=None):
+    """Add input multiplied by volume to output at specified start_channel, ignoring channels outside of output.
+
+    If given, scale_buffer (same shape as output) holds the scaled input, so no array is allocated.
+    """
     input_start = max(0, -start_channel)
     input_stop = max(min(input.shape[0], output.shape[0]-start_channel), 0)
     output_start = max(0, start_channel)
     output_stop = max(start_channel + input.shape[0], 0)
-    output[output_start:output_stop, :] += input[input_start:input_stop, :]
+    input = input[input_start:input_stop, :]
+    if volume != 1.:
+        if scale_buffer is None:
+            input = volume * input
+        else:
+            input = np.multiply(input, volume, out=scale_buffer[:input.shape[0], :input.shape[1]])
+    output[output_start:output_stop, :] += input
     return output
@@ -84,6 +84,7 @@ class ZmqReceiver(PkgReceiver):
         self.run_thread = True
         self.zmq_thread.daemon = True
         self.zmq_thread.start()
+        self.threads.append(self.zmq_thread)
 
     # NOTE: The following protocols have been tested
     # TCP - slow, reliable, distributed, supports pretty much all patterns
@@ -0,0 +1,147 @@
+import itertools
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pytest
+from torch.profiler import profile, ProfilerActivity
+
+from pybinsim.application import BinSim, audio_callback
+from pybinsim.pkg_receiver import CONFIG_SOUNDFILE_PLAYER_NAME
+from pybinsim.player import PlayState
+
+BLOCKSIZE = 512
+FILTERSIZE = 3072
+
+RESOURCES = Path(__file__).parent / "resources"
+
+# Each block the callback creates small Python objects like tensor and array views or index tuples, which are
+# freed within the block. Measured: 1076 bytes per block in the steady state and up to 1476 bytes in a block
+# with a filter update. The bounds are a bit higher, but below one allocated block of audio (BLOCKSIZE * 4 bytes).
+STEADY_STATE_BYTES = 1280
+FILTER_UPDATE_BYTES = 1792
+
+# The OSC receiver does not release its ports on close, so each BinSim uses ports of its own
+RECV_PORTS = itertools.count(10200, 10)
+
+# The CPU FFTs of torch allocate their output internally, even when called with out=
+FFT_OPERATORS = ("aten::_fft_r2c", "aten::_fft_c2r")
+
+
+class FakeStream(object):
+    cpu_load = 0.
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def binsim(tmp_path):
+    filter_path = RESOURCES / "test_filter.wav"
+    pose = " ".join(["0"] * 15)
+    # a second direct sound filter to switch to
+    turned_pose = " ".join(["10"] + ["0"] * 14)
+    filter_list = tmp_path / "filter_list.txt"
+    filter_list.write_text("".join("{} {} {}\n".format(filter_type, pose, filter_path)
+                                   for filter_type in ("DS", "ER", "LR"))
+                           + "DS {} {}\n".format(turned_pose, filter_path))
+
+    config = {
+        "soundfile": RESOURCES / "speech2_48000_mono.wav",
+        "loopSound": True,
+        "blockSize": BLOCKSIZE,
+        "ds_filterSize": FILTERSIZE,
+        "early_filterSize": FILTERSIZE,
+        "late_filterSize": FILTERSIZE,
+        "filterSource[mat/wav]": "wav",
+        "filterList": filter_list,
+        "maxChannels": 2,
+        "enableCrossfading": True,
+        "torchConvolution[cpu/cuda]": "cpu",
+        "torchStorage[cpu/cuda]": "cpu",
+        "strictRealtime": True,
+        "recv_port": next(RECV_PORTS),
+    }
+    config_file = tmp_path / "config.txt"
+    config_file.write_text("".join("{} {}\n".format(key, value) for key, value in config.items()))
+
+    with BinSim(str(config_file)) as binsim:
+        binsim.stream = FakeStream()
+        yield binsim
+
+
+def turn_source(binsim, yaw):
+    """ Send a new direct sound orientation for channel 0, which is applied in the next callback """
+    binsim.pkgReceiver.handle_ds_filter_input("/pyBinSim_ds_Filter_Orientation", 0, yaw, 0, 0)
+
+
+def traced_bytes(callback, outdata):
+    """ Peak of the memory traced by tracemalloc during one callback, relative to the memory before """
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    callback(outdata, BLOCKSIZE, None, 0)
+    _, peak = tracemalloc.get_traced_memory()
+    return peak - before
+
+
+def tensor_allocations(events):
+    """ Names of the torch operators in events, which allocated CPU memory outside of an FFT """
+    allocations = []
+    for event in events:
+        if event.cpu_memory_usage <= 0:
+            continue
+        parent = event
+        while parent is not None and parent.name not in FFT_OPERATORS:
+            parent = parent.cpu_parent
+        if parent is None:
+            allocations.append(event.name)
+    return allocations
+
+
+def test_audio_callback_does_not_allocate(binsim):
+    """
+    In strict real-time mode the callback must not allocate arrays, neither in the steady state nor in a block
+    with a filter update and crossfade. tracemalloc sees the Python objects and NumPy arrays, also those of the
+    player reading the sound file on its own thread (the whole file is queued before, so it does not read).
+    """
+    callback = audio_callback(binsim)
+    outdata = np.zeros((BLOCKSIZE, 2), dtype=np.float32)
+
+    # filter updates and crossfades of the first blocks are not steady state
+    for _ in range(10):
+        callback(outdata, BLOCKSIZE, None, 0)
+
+    tracemalloc.start()
+    try:
+        for block in range(50):
+            if block % 10 == 5:
+                turn_source(binsim, 10 if block % 20 == 5 else 0)
+                bound = FILTER_UPDATE_BYTES
+            else:
+                bound = STEADY_STATE_BYTES
+
+            allocated = traced_bytes(callback, outdata)
+            assert allocated <= bound, "audio callback allocated {} bytes in block {}".format(allocated, block)
+    finally:
+        tracemalloc.stop()
+
+    assert binsim.soundHandler.get_player(CONFIG_SOUNDFILE_PLAYER_NAME).play_state == PlayState.PLAYING
+
+
+def test_audio_callback_does_not_allocate_tensors(binsim):
+    """ The tensors of the callback are preallocated, also those for crossfading after a filter update """
+    callback = audio_callback(binsim)
+    outdata = np.zeros((BLOCKSIZE, 2), dtype=np.float32)
+
+    for _ in range(10):
+        callback(outdata, BLOCKSIZE, None, 0)
+
+    # steady state blocks with both halves of the input buffer ring, then blocks with filter updates
+    for yaw in (None, None, 10, None, 0):
+        if yaw is not None:
+            turn_source(binsim, yaw)
+
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as profiler:
+            callback(outdata, BLOCKSIZE, None, 0)
+
+        assert tensor_allocations(profiler.events()) == []
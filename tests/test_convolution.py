@@ -1,9 +1,13 @@
-from pybinsim.convolver import ConvolverTorch
+from pybinsim.convolver import ConvolverTorch, ConvolverFused, ConvolverNonUniform, nonuniform_partitioning, \
+    multirate_partitioning
 from pybinsim.input_buffer import InputBufferMulti
-from pybinsim.filterstorage import Filter
+from pybinsim.numpy_convolver import ConvolverNumpy, InputBufferNumpy
+from pybinsim.filterstorage import Filter, FilterBank, FilterStorage, transform_filters
 from pybinsim.soundhandler import SoundHandler
 from pybinsim.parsing import parse_soundfile_list
 
+import threading
+
 import numpy as np
 import torch
 import pytest
@@ -28,6 +32,20 @@ def change_test_dir(request, monkeypatch):
     monkeypatch.chdir(request.fspath.dirname)
 
 
+@pytest.fixture(autouse=True)
+def seed_random():
+    # random filters and signals are the same in every run
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+
+def random_filter(blocksize, blocks):
+    """ Uniformly partitioned filter of white noise in the frequency domain """
+    filter = Filter(np.random.randn(blocksize * blocks, 2).astype('float32'), blocks, blocksize, 'cpu')
+    filter.storeInFDomain()
+    return filter
+
+
 def test_convolution_basic():
 
     # Simple Filter
@@ -121,3 +139,577 @@ def test_convolution_basic():
 
     print('Done')
 
+
+
+def test_nonuniform_partitioning():
+    partitioning = nonuniform_partitioning(48640, 512, 8192)
+
+    assert partitioning[0][0] == 512
+    assert sum(size * count for size, count in partitioning) >= 48640
+    assert max(size for size, count in partitioning) == 8192
+
+    # every segment must start at least one partition size into the filter
+    offset = 0
+    for size, count in partitioning:
+        assert offset == 0 or offset >= size
+        offset += size * count
+
+    # threaded segments return their output one partition later
+    partitioning = nonuniform_partitioning(48640, 512, 8192, threaded=True)
+    assert partitioning[0] == (512, 4)
+    offset = 0
+    for size, count in partitioning:
+        assert offset == 0 or offset >= 2 * size
+        offset += size * count
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_convolution_nonuniform(threaded):
+    blocksize = 128
+    n_blocks = 40
+
+    test_filter, _ = sf.read("resources/test_filter.wav", dtype='float32')
+    partitioning = nonuniform_partitioning(FILTERSIZE, blocksize, 1024, threaded)
+
+    input_Buffer = InputBufferMulti(blocksize, 1, 'cpu')
+    convolver = ConvolverNonUniform(FILTERSIZE, blocksize, False, 1, False, 'cpu', partitioning,
+                                    threaded_segments=threaded)
+
+    filter = Filter(test_filter, FILTERSIZE // blocksize, blocksize, 'cpu', partitioning=partitioning)
+    filter.storeInFDomain()
+    convolver.setAllFilters([filter])
+
+    audio, _ = sf.read("resources/speech2_48000_mono.wav", dtype='float32')
+    audio = audio[:n_blocks * blocksize]
+
+    result_pybinsim = []
+    for i in range(n_blocks):
+        block = torch.as_tensor(audio[i * blocksize:(i + 1) * blocksize], dtype=torch.float32).reshape(1, -1)
+        result = convolver.process(input_Buffer.process(block), block)
+        result_pybinsim.append(result[:, 0, :].clone())
+
+    convolver.close()
+
+    result_matrix_pybinsim = np.concatenate(result_pybinsim, axis=1)
+
+    left = np.convolve(audio, test_filter[:, 0])[:n_blocks * blocksize]
+    right = np.convolve(audio, test_filter[:, 1])[:n_blocks * blocksize]
+
+    assert np.allclose(result_matrix_pybinsim[0, :], left, atol=ACCURACY, rtol=ACCURACY)
+    assert np.allclose(result_matrix_pybinsim[1, :], right, atol=ACCURACY, rtol=ACCURACY)
+
+
+def test_nonuniform_block_cost(monkeypatch):
+    blocksize = 64
+    n_blocks = 64
+
+    partitioning = nonuniform_partitioning(FILTERSIZE, blocksize, 512, threaded=True)
+    convolver = ConvolverNonUniform(FILTERSIZE, blocksize, False, 1, False, 'cpu', partitioning,
+                                    threaded_segments=True)
+    filter = Filter(np.random.randn(FILTERSIZE, 2).astype('float32'), FILTERSIZE // blocksize, blocksize, 'cpu',
+                    partitioning=partitioning)
+    filter.storeInFDomain()
+    convolver.setAllFilters([filter])
+
+    # partitions multiplied and accumulated by the audio thread
+    audio_thread = threading.get_ident()
+    partitions = [0]
+    multiply_accumulate = ConvolverTorch.multiply_accumulate
+
+    def counting_multiply_accumulate(self, *args, **kwargs):
+        if threading.get_ident() == audio_thread:
+            partitions[0] += self.IR_blocks
+        return multiply_accumulate(self, *args, **kwargs)
+
+    monkeypatch.setattr(ConvolverTorch, "multiply_accumulate", counting_multiply_accumulate)
+
+    input_Buffer = InputBufferMulti(blocksize, 1, 'cpu')
+    block_partitions = []
+    for i in range(n_blocks):
+        partitions[0] = 0
+        block = torch.randn(1, blocksize)
+        convolver.process(input_Buffer.process(block), block)
+        block_partitions.append(partitions[0])
+
+    convolver.close()
+
+    # every block costs the same, the tail segments never run on the audio thread
+    head_size, head_count = partitioning[0]
+    assert block_partitions == [head_count] * n_blocks
+
+
+def test_convolution_multirate():
+    blocksize = 64
+    stage_blocksize = 256
+    n_blocks = 60
+
+    test_filter, _ = sf.read("resources/test_filter.wav", dtype='float32')
+    partitioning = multirate_partitioning(FILTERSIZE, blocksize, stage_blocksize)
+    assert partitioning[0] == (blocksize, 2 * stage_blocksize // blocksize)
+    assert partitioning[1][0] == stage_blocksize
+
+    input_Buffer = InputBufferMulti(blocksize, 1, 'cpu')
+    convolver = ConvolverNonUniform(FILTERSIZE, blocksize, False, 1, False, 'cpu', partitioning,
+                                    threaded_segments=True)
+
+    filter = Filter(test_filter, FILTERSIZE // blocksize, blocksize, 'cpu', partitioning=partitioning)
+    filter.storeInFDomain()
+    convolver.setAllFilters([filter])
+
+    audio, _ = sf.read("resources/speech2_48000_mono.wav", dtype='float32')
+    audio = audio[:n_blocks * blocksize]
+
+    result_pybinsim = []
+    for i in range(n_blocks):
+        block = torch.as_tensor(audio[i * blocksize:(i + 1) * blocksize], dtype=torch.float32).reshape(1, -1)
+        result = convolver.process(input_Buffer.process(block), block)
+        result_pybinsim.append(result[:, 0, :].clone())
+
+    convolver.close()
+
+    result_matrix_pybinsim = np.concatenate(result_pybinsim, axis=1)
+
+    left = np.convolve(audio, test_filter[:, 0])[:n_blocks * blocksize]
+    right = np.convolve(audio, test_filter[:, 1])[:n_blocks * blocksize]
+
+    assert np.allclose(result_matrix_pybinsim[0, :], left, atol=ACCURACY, rtol=ACCURACY)
+    assert np.allclose(result_matrix_pybinsim[1, :], right, atol=ACCURACY, rtol=ACCURACY)
+
+
+@pytest.mark.parametrize("lean_memory", [False, True])
+def test_crossfade_changed_source_only(lean_memory):
+    blocksize = 64
+    blocks = 4
+    sources = 3
+
+    filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+    changed_filters = list(filters)
+    changed_filters[1] = random_filter(blocksize, blocks)
+
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu', lean_memory=lean_memory)
+    convolver_old = ConvolverTorch(blocksize * blocks, blocksize, False, sources, False, 'cpu')
+    convolver_new = ConvolverTorch(blocksize * blocks, blocksize, False, sources, False, 'cpu')
+
+    convolver.setAllFilters(filters)
+    convolver_old.setAllFilters(filters)
+    convolver_new.setAllFilters(changed_filters)
+
+    for i in range(2 * blocks):
+        if i == blocks:
+            convolver.setAllFilters(changed_filters)
+            assert convolver.changed_sources == [1]
+
+        input_buffer = torch.randn(sources, blocksize + 1, dtype=torch.complex64)
+        result = convolver.process(input_buffer).clone()
+        result_old = convolver_old.process(input_buffer).clone()
+        result_new = convolver_new.process(input_buffer).clone()
+
+        if i == 0:
+            # initial filters fade in from silence
+            expected = result_old * convolver.crossFadeIn
+        elif i < blocks:
+            expected = result_old
+        elif i == blocks:
+            expected = result_new * convolver.crossFadeIn + result_old * convolver.crossFadeOut
+        else:
+            expected = result_new
+
+        assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_set_single_filter():
+    blocksize = 64
+    blocks = 4
+    sources = 3
+
+    filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+    new_filter = random_filter(blocksize, blocks)
+
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu')
+    convolver_all = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu')
+    convolver.setAllFilters(filters)
+    convolver_all.setAllFilters(filters)
+
+    for i in range(2 * blocks):
+        if i == blocks:
+            convolver.setFilter(2, new_filter)
+            convolver.setFilter(2, new_filter)  # setting the same filter again is a no-op
+            assert convolver.changed_sources == [2]
+            convolver_all.setAllFilters(filters[:2] + [new_filter])
+
+        input_buffer = torch.randn(sources, blocksize + 1, dtype=torch.complex64)
+        result = convolver.process(input_buffer).clone()
+        expected = convolver_all.process(input_buffer).clone()
+
+        assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_staged_filters():
+    blocksize = 64
+    blocks = 4
+    sources = 2
+
+    filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+    new_filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu')
+    convolver_direct = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu')
+
+    for i in range(sources):
+        convolver.stageFilter(i, filters[i])
+    assert convolver.publishFilters()
+    convolver_direct.setAllFilters(filters)
+
+    for i in range(3 * blocks):
+        if i == blocks:
+            convolver.stageFilter(1, new_filters[1])
+            assert convolver.publishFilters()
+
+            # the published filters were not picked up yet
+            convolver.stageFilter(0, new_filters[0])
+            assert not convolver.publishFilters()
+            assert convolver.current_filters[1] is filters[1]
+
+            convolver_direct.setFilter(1, new_filters[1])
+        elif i == blocks + 1:
+            assert convolver.publishFilters()
+            convolver_direct.setFilter(0, new_filters[0])
+
+        input_buffer = torch.randn(sources, blocksize + 1, dtype=torch.complex64)
+        result = convolver.process(input_buffer).clone()
+        expected = convolver_direct.process(input_buffer).clone()
+
+        assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_fused_convolution():
+    blocksize = 64
+    sources = 2
+    stage_blocks = [1, 4, 8]
+
+    separate = [ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu') for blocks in stage_blocks]
+    stages = [ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu', shared_fdl=True)
+              for blocks in stage_blocks]
+    fused = ConvolverFused(stages, blocksize, sources, 'cpu')
+
+    for i in range(20):
+        if i % 7 == 0:
+            for blocks, convolver, stage in zip(stage_blocks, separate, stages):
+                filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+                convolver.setAllFilters(filters)
+                stage.setAllFilters(filters)
+
+        input_buffer = torch.randn(sources, blocksize + 1, dtype=torch.complex64)
+        expected = sum(convolver.process(input_buffer).clone() for convolver in separate)
+        result = fused.process(input_buffer)
+
+        assert torch.allclose(result, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("stereo", [False, True])
+def test_matmul_accumulate(stereo):
+    blocksize = 64
+    blocks = 5
+    sources = 1 if stereo else 3
+
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, stereo, sources, True, 'cpu')
+    convolver_matmul = ConvolverTorch(blocksize * blocks, blocksize, stereo, sources, True, 'cpu', matmul=True)
+    assert convolver_matmul.complex_buffer is None
+
+    for i in range(3 * blocks):
+        if i % 4 == 0:
+            filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+            convolver.setAllFilters(filters)
+            convolver_matmul.setAllFilters(filters)
+
+        input_buffer = torch.randn(2 if stereo else sources, blocksize + 1, dtype=torch.complex64)
+        expected = convolver.process(input_buffer).clone()
+        result = convolver_matmul.process(input_buffer)
+
+        assert torch.allclose(result, expected, atol=1e-4)
+
+
+def test_memory_footprint():
+    blocksize = 64
+    blocks = 8
+    sources = 4
+
+    default = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu')
+    lean = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu', lean_memory=True)
+    no_crossfade = ConvolverTorch(blocksize * blocks, blocksize, False, sources, False, 'cpu')
+
+    filter_bank_bytes = 2 * blocks * sources * (blocksize + 1) * 8
+    assert default.filters_cpu is None
+    assert default.get_memory_footprint() - lean.get_memory_footprint() == filter_bank_bytes
+    assert no_crossfade.get_memory_footprint() < lean.get_memory_footprint()
+
+
+@pytest.mark.parametrize("matmul", [False, True])
+def test_silent_partitions(matmul):
+    blocksize = 64
+    blocks = 8
+    sources = 2
+    n_blocks = 3 * blocks
+
+    # filters with leading and trailing silence
+    filters_td = np.zeros((sources, blocksize * blocks, 2), dtype='float32')
+    filters_td[0, 2 * blocksize:5 * blocksize] = np.random.randn(3 * blocksize, 2)
+    filters_td[1, 3 * blocksize + 10:6 * blocksize - 10] = np.random.randn(3 * blocksize - 20, 2)
+
+    filters = [Filter(filter_td, blocks, blocksize, 'cpu') for filter_td in filters_td]
+    for filter in filters:
+        filter.storeInFDomain()
+    assert filters[0].getActivePartitions() == (2, 5)
+    assert filters[1].getActivePartitions() == (3, 6)
+
+    input_Buffer = InputBufferMulti(blocksize, sources, 'cpu')
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, False, sources, False, 'cpu', matmul=matmul)
+    convolver.setAllFilters(filters)
+    assert convolver.active_partitions == (2, 6)
+
+    audio = np.random.randn(sources, n_blocks * blocksize).astype('float32')
+
+    result_pybinsim = []
+    for i in range(n_blocks):
+        block = torch.as_tensor(audio[:, i * blocksize:(i + 1) * blocksize])
+        result = convolver.process(input_Buffer.process(block))
+        result_pybinsim.append(result[:, 0, :].clone())
+
+    result_matrix_pybinsim = np.concatenate(result_pybinsim, axis=1)
+
+    for ear in range(2):
+        expected = sum(np.convolve(audio[source], filters_td[source, :, ear])[:n_blocks * blocksize]
+                       for source in range(sources))
+        assert np.allclose(result_matrix_pybinsim[ear, :], expected, atol=1e-4)
+
+    # all filters silent
+    silent_filter = Filter(np.zeros((blocksize * blocks, 2), dtype='float32'), blocks, blocksize, 'cpu')
+    silent_filter.storeInFDomain()
+    convolver.setAllFilters([silent_filter] * sources)
+    assert convolver.active_partitions == (0, 0)
+
+
+@pytest.mark.parametrize("matmul", [False, True])
+def test_lookahead(matmul):
+    blocksize = 64
+    blocks = 6
+    sources = 2
+
+    filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu', matmul=matmul,
+                               lookahead=True)
+    convolver_reference = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu', matmul=matmul)
+
+    for i in range(3 * blocks):
+        # filter changes invalidate the look-ahead
+        if i % 5 == 0:
+            filters[i % sources] = random_filter(blocksize, blocks)
+        convolver.setAllFilters(filters)
+        convolver_reference.setAllFilters(filters)
+
+        input_buffer = torch.randn(sources, blocksize + 1, dtype=torch.complex64)
+        result = convolver.process(input_buffer).clone()
+        result_reference = convolver_reference.process(input_buffer).clone()
+
+        assert torch.allclose(result, result_reference, atol=1e-4)
+
+    convolver.close()
+    assert not convolver.lookahead_thread.is_alive()
+
+
+def test_precomposed_directivity(tmp_path):
+    blocksize = 64
+    ds_size = 256
+    sd_size = 128
+
+    filter_list = tmp_path / "filter_list.txt"
+    filter_list.write_text("")
+    filterStorage = FilterStorage(blocksize, 'wav', str(filter_list), None, 'cpu', False, 0, ds_size, blocksize,
+                                  blocksize, sd_size, directivity_composition=True)
+    assert filterStorage.ds_blocks == (ds_size + sd_size) // blocksize
+
+    ds_td = np.zeros((ds_size + sd_size, 2), dtype='float32')
+    ds_td[:ds_size] = np.random.randn(ds_size, 2)
+    sd_td = np.random.randn(sd_size, 2).astype('float32')
+
+    ds_filter = Filter(ds_td, filterStorage.ds_blocks, blocksize, 'cpu')
+    ds_filter.storeInFDomain()
+    sd_filter = Filter(sd_td, sd_size // blocksize, blocksize, 'cpu')
+    sd_filter.storeInFDomain()
+
+    composed_filter = filterStorage.get_ds_sd_filter(ds_filter, sd_filter)
+    assert filterStorage.get_ds_sd_filter(ds_filter, sd_filter) is composed_filter
+
+    composed_td = composed_filter.getImpulseResponse().numpy()
+    for ear in range(2):
+        expected = np.convolve(ds_td[:ds_size, ear], sd_td[:, ear])
+        assert np.allclose(composed_td[ear, :len(expected)], expected, atol=1e-4)
+
+    # only the composed filters fitting into the memory budget are kept
+    filterStorage.ds_sd_filter_lru.budget = 1
+    other_sd_filter = Filter(np.random.randn(sd_size, 2).astype('float32'), sd_size // blocksize, blocksize, 'cpu')
+    other_sd_filter.storeInFDomain()
+    filterStorage.get_ds_sd_filter(ds_filter, other_sd_filter)
+    assert len(filterStorage.ds_sd_filter_lru.filters) == 1
+    assert filterStorage.get_ds_sd_filter(ds_filter, sd_filter) is not composed_filter
+
+
+@pytest.mark.parametrize("stereo", [False, True])
+def test_numpy_engine(stereo):
+    blocksize = 64
+    blocks = 4
+    sources = 1 if stereo else 3
+    inputs = 2 if stereo else sources
+
+    filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+
+    input_buffer_torch = InputBufferMulti(blocksize, inputs, 'cpu')
+    input_buffer_numpy = InputBufferNumpy(blocksize, inputs)
+    convolver_torch = ConvolverTorch(blocksize * blocks, blocksize, stereo, sources, True, 'cpu')
+    convolver_numpy = ConvolverNumpy(blocksize * blocks, blocksize, stereo, sources, True)
+
+    for i in range(3 * blocks):
+        # filter changes are crossfaded by both engines
+        if i % 5 == 0:
+            filters[i % sources] = random_filter(blocksize, blocks)
+        convolver_torch.setAllFilters(filters)
+        convolver_numpy.setAllFilters(filters)
+
+        block = torch.randn(inputs, blocksize)
+        result_torch = convolver_torch.process(input_buffer_torch.process(block))
+        result_numpy = convolver_numpy.process(input_buffer_numpy.process(block))
+
+        assert torch.allclose(result_numpy, result_torch, atol=1e-4)
+
+
+@pytest.mark.parametrize("compile_mode", ["script", "unknown"])
+def test_compiled_convolution(compile_mode):
+    blocksize = 64
+    blocks = 4
+    sources = 2
+
+    filters = [random_filter(blocksize, blocks) for _ in range(sources)]
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu', compile_mode=compile_mode)
+    convolver_reference = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu')
+
+    # unknown modes fall back to processing op by op
+    assert (convolver.compiled_block is None) == (compile_mode == "unknown")
+
+    for i in range(3 * blocks):
+        if i % 5 == 0:
+            filters[i % sources] = random_filter(blocksize, blocks)
+        convolver.setAllFilters(filters)
+        convolver_reference.setAllFilters(filters)
+
+        input_buffer = torch.randn(sources, blocksize + 1, dtype=torch.complex64)
+        result = convolver.process(input_buffer).clone()
+        result_reference = convolver_reference.process(input_buffer).clone()
+
+        assert torch.allclose(result, result_reference, atol=1e-4)
+
+
+@pytest.mark.parametrize("lean_memory", [False, True])
+def test_filter_bank_gather(lean_memory):
+    blocksize = 64
+    blocks = 4
+    sources = 3
+
+    irs = torch.randn(8, 2, blocksize * blocks)
+    spectra, active_partitions = transform_filters(irs, blocksize)
+    bank = FilterBank(spectra, active_partitions, list(range(8)), blocks, blocksize, 'cpu')
+
+    # the same filters with their own spectra are copied source by source
+    copies = [Filter.from_spectra([spectra[0][i].clone()], active_partitions[i], blocks, blocksize, 'cpu')
+              for i in range(8)]
+
+    input_buffer = InputBufferMulti(blocksize, sources, 'cpu')
+    convolver = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu', lean_memory=lean_memory)
+    convolver_reference = ConvolverTorch(blocksize * blocks, blocksize, False, sources, True, 'cpu',
+                                         lean_memory=lean_memory)
+
+    rows = [0, 1, 2]
+    for i in range(4 * blocks):
+        if i % 3 == 0:
+            rows[i % sources] = (rows[i % sources] + 4) % 8
+            rows[(i + 1) % sources] = i % 8
+        for source_index, row in enumerate(rows):
+            convolver.setFilter(source_index, bank.filters[row])
+            convolver_reference.setFilter(source_index, copies[row])
+
+        spectrum = input_buffer.process(torch.randn(sources, blocksize))
+        result = convolver.process(spectrum)
+
+        assert not convolver.bank_filters
+        assert torch.equal(convolver.filters_blocked, convolver_reference.filters_blocked)
+        assert torch.allclose(result, convolver_reference.process(spectrum), atol=1e-6)
+
+
+def test_missed_tail_partition():
+    blocksize = 64
+    n_blocks = 48
+
+    partitioning = nonuniform_partitioning(FILTERSIZE, blocksize, 512, threaded=True)
+    convolver = ConvolverNonUniform(FILTERSIZE, blocksize, False, 1, False, 'cpu', partitioning,
+                                    threaded_segments=True, segment_timeout=0.01)
+    filter = Filter(np.random.randn(FILTERSIZE, 2).astype('float32'), FILTERSIZE // blocksize, blocksize, 'cpu',
+                    partitioning=partitioning)
+    filter.storeInFDomain()
+    convolver.setAllFilters([filter])
+
+    # the worker of the last segment is stuck in one partition
+    segment = convolver.segments[-1]
+    release = threading.Event()
+    convolve = segment.convolve
+
+    def stuck_convolve(input_block):
+        release.wait(5)
+        return convolve(input_block)
+
+    segment.convolve = stuck_convolve
+
+    input_Buffer = InputBufferMulti(blocksize, 1, 'cpu')
+    for i in range(n_blocks):
+        block = torch.randn(1, blocksize)
+        convolver.process(input_Buffer.process(block), block)
+
+    # the audio thread did not wait for the worker
+    assert segment.missed_partitions > 0
+    assert convolver.get_missed_partitions() == segment.missed_partitions
+
+    release.set()
+    convolver.close()
+
+
+def test_worker_thread_initializer():
+    blocksize = 64
+    n_blocks = 40
+
+    # e.g. BinSim.configure_audio_worker_thread, which gives the workers the scheduling of the audio thread
+    initialized = []
+
+    def thread_initializer():
+        initialized.append(threading.current_thread().name)
+
+    partitioning = nonuniform_partitioning(FILTERSIZE, blocksize, 512, threaded=True)
+    convolvers = [ConvolverTorch(FILTERSIZE, blocksize, False, 1, False, 'cpu', lookahead=True,
+                                 thread_initializer=thread_initializer),
+                  ConvolverNonUniform(FILTERSIZE, blocksize, False, 1, False, 'cpu', partitioning,
+                                      threaded_segments=True, thread_initializer=thread_initializer)]
+
+    ir = np.random.randn(FILTERSIZE, 2).astype('float32')
+    filters = [Filter(ir, FILTERSIZE // blocksize, blocksize, 'cpu'),
+               Filter(ir, FILTERSIZE // blocksize, blocksize, 'cpu', partitioning=partitioning)]
+    input_Buffer = InputBufferMulti(blocksize, 1, 'cpu')
+    for convolver, filter in zip(convolvers, filters):
+        filter.storeInFDomain()
+        convolver.setAllFilters([filter])
+        for i in range(n_blocks):
+            block = torch.randn(1, blocksize)
+            convolver.process(input_Buffer.process(block), block)
+        convolver.close()
+
+    # the look-ahead thread and one worker per tail segment, each initialized once
+    assert initialized.count("pybinsim-lookahead") == 1
+    segment_workers = [name for name in initialized if name.startswith("pybinsim-segment")]
+    assert len(segment_workers) == len(partitioning) - 1
+    assert threading.current_thread().name not in initialized
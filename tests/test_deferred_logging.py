@@ -0,0 +1,56 @@
+import logging
+import threading
+
+from pybinsim.deferred_logging import start_deferred_logging, stop_deferred_logging
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+        self.threads.add(threading.get_ident())
+
+
+def test_records_are_emitted_on_background_thread_and_rate_limited():
+    logger = logging.getLogger("pybinsim.test_deferred_logging")
+    logger.propagate = False
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+
+    listener = start_deferred_logging(logger, interval=60.)
+    assert handler not in logger.handlers
+
+    for i in range(100):
+        logger.warning("Clipping occurred in block %d", i)
+    logger.warning("Other message")
+
+    stop_deferred_logging(listener)
+
+    assert logger.handlers == [handler]
+    assert handler.threads == {listener.thread.ident}
+    assert handler.messages[:2] == ["Clipping occurred in block 0", "Other message"]
+    assert handler.messages[2].startswith("Clipping occurred in block 99 (99 similar messages in ")
+    assert len(handler.messages) == 3
+
+    logger.removeHandler(handler)
+
+
+def test_new_interval_emits_first_record_again():
+    logger = logging.getLogger("pybinsim.test_deferred_logging_interval")
+    logger.propagate = False
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+
+    listener = start_deferred_logging(logger, interval=0.)
+    logger.warning("Filter not found: key: %s", 1)
+    logger.warning("Filter not found: key: %s", 2)
+    stop_deferred_logging(listener)
+
+    assert handler.messages == ["Filter not found: key: 1", "Filter not found: key: 2"]
+
+    logger.removeHandler(handler)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+from pybinsim.convolver import nonuniform_partitioning
+from pybinsim.filterstorage import FilterStorage
+from pybinsim.pose import Pose
+
+BLOCKSIZE = 64
+DS_SIZE = 128
+EARLY_SIZE = 256
+LATE_SIZE = 1024
+
+
+def write_filter_list(tmp_path, count=3):
+    rng = np.random.default_rng(1)
+    lines = []
+    for filter_type, size in (("DS", DS_SIZE), ("ER", EARLY_SIZE), ("LR", LATE_SIZE)):
+        for i in range(count):
+            path = tmp_path / "{}_{}.wav".format(filter_type, i)
+            sf.write(path, rng.standard_normal((size, 2)).astype(np.float32) * 0.1, 48000, subtype='FLOAT')
+            lines.append("{} {} {} {}\n".format(filter_type, i * 90, " ".join(["0"] * 14), path))
+
+    filter_list = tmp_path / "filter_list.txt"
+    filter_list.write_text("".join(lines))
+    return filter_list
+
+
+def create_storage(filter_list, cache_directory, block_size=BLOCKSIZE, lazy_memory_budget=None):
+    late_partitioning = nonuniform_partitioning(LATE_SIZE, block_size, 256)
+    return FilterStorage(block_size, 'wav', str(filter_list), None, 'cpu', False, 0, DS_SIZE, EARLY_SIZE, LATE_SIZE,
+                         block_size, late_partitioning=late_partitioning, cache_directory=cache_directory,
+                         lazy_memory_budget=lazy_memory_budget)
+
+
+def test_cached_filters_equal_loaded_filters(tmp_path, monkeypatch):
+    filter_list = write_filter_list(tmp_path)
+    cache_directory = tmp_path / "cache"
+
+    loaded = create_storage(filter_list, cache_directory)
+    assert len(list(cache_directory.iterdir())) == 1
+
+    # the second storage must not load the wav files
+    monkeypatch.setattr(FilterStorage, "load_wav_filters", lambda self: pytest.fail("filters loaded again"))
+    cached = create_storage(filter_list, cache_directory)
+
+    for name in ("ds_filter_dict", "early_filter_dict", "late_filter_dict"):
+        loaded_filters = getattr(loaded, name)
+        cached_filters = getattr(cached, name)
+        assert loaded_filters.keys() == cached_filters.keys()
+
+        for key, loaded_filter in loaded_filters.items():
+            cached_filter = cached_filters[key]
+            assert cached_filter.filename == loaded_filter.filename
+            assert len(cached_filter.TF_segments) == len(loaded_filter.TF_segments)
+            for segment in range(len(loaded_filter.TF_segments)):
+                assert torch.equal(cached_filter.getFilterFD(segment), loaded_filter.getFilterFD(segment))
+                assert cached_filter.getActivePartitions(segment) == loaded_filter.getActivePartitions(segment)
+
+
+def test_new_cache_entry_for_changed_settings(tmp_path):
+    filter_list = write_filter_list(tmp_path, count=1)
+    cache_directory = tmp_path / "cache"
+
+    create_storage(filter_list, cache_directory)
+    create_storage(filter_list, cache_directory, block_size=BLOCKSIZE * 2)
+    assert len(list(cache_directory.iterdir())) == 2
+
+    # a changed filter file invalidates the entry
+    path = tmp_path / "DS_0.wav"
+    sf.write(path, np.zeros((DS_SIZE, 2), dtype=np.float32), 48000, subtype='FLOAT')
+    storage = create_storage(filter_list, cache_directory)
+    assert len(list(cache_directory.iterdir())) == 3
+    assert not torch.any(next(iter(storage.ds_filter_dict.values())).getFilterFD() != 0)
+
+
+def test_lazy_storage_keeps_filters_within_budget(tmp_path):
+    filter_list = write_filter_list(tmp_path)
+    cache_directory = tmp_path / "cache"
+    resident = create_storage(filter_list, cache_directory)
+
+    # spectra of two early filters
+    budget = 2 * 2 * (EARLY_SIZE // BLOCKSIZE) * (BLOCKSIZE + 1) * 8
+    # the cache entry is written by the lazy storage itself or exists already
+    for directory in (tmp_path / "new_cache", cache_directory):
+        storage = create_storage(filter_list, directory, lazy_memory_budget=budget)
+        assert storage.get_cache_statistics() == {'hits': 0, 'misses': 0, 'evictions': 0, 'resident_bytes': 0}
+
+        poses = [Pose.from_filterValueList([yaw] + [0] * 14) for yaw in (0, 90, 180)]
+        for pose in poses + poses[:1]:
+            lazy_filter = storage.get_early_filter(pose)
+            assert torch.equal(lazy_filter.getFilterFD(), resident.get_early_filter(pose).getFilterFD())
+
+        assert storage.get_early_filter(poses[0]) is lazy_filter
+        assert storage.get_cache_statistics() == {'hits': 1, 'misses': 4, 'evictions': 2, 'resident_bytes': budget}
+
+        # unknown poses still give the default filter
+        assert storage.get_early_filter(Pose.from_filterValueList([45] + [0] * 14)) is storage.default_early_filter
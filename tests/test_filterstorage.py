@@ -0,0 +1,82 @@
+import numpy as np
+import scipy.io as sio
+import torch
+
+from pybinsim.convolver import nonuniform_partitioning
+from pybinsim.filterstorage import Filter, FilterStorage, FilterType
+from pybinsim.pose import Pose
+from pybinsim.pose_index import parse_pose_weights
+
+BLOCKSIZE = 64
+DS_SIZE = 128
+EARLY_SIZE = 256
+LATE_SIZE = 1024
+
+FILTER_TYPES = {"DS": FilterType.ds_Filter, "ER": FilterType.early_Filter, "LR": FilterType.late_Filter}
+
+MAT_FIELDS = ['type', 'filter', 'listenerOrientation', 'listenerPosition', 'sourceOrientation', 'sourcePosition',
+              'custom']
+
+
+def write_mat_database(path, filters):
+    database = np.empty((1, len(filters)), dtype=[(field, 'O') for field in MAT_FIELDS])
+    for row, (filter_type, yaw, ir) in enumerate(filters):
+        database[0, row] = (filter_type, ir, np.array([[yaw, 0, 0]]), np.zeros((1, 3)), np.zeros((1, 3)),
+                            np.zeros((1, 3)), np.zeros((1, 3)))
+    sio.savemat(path, {'binsim': database})
+
+
+def test_batched_loading_equals_single_filters(tmp_path):
+    rng = np.random.default_rng(2)
+    filters = [("DS", yaw, rng.standard_normal((DS_SIZE - yaw, 2)).astype(np.float32)) for yaw in range(0, 40, 10)]
+    filters += [("ER", 0, rng.standard_normal((EARLY_SIZE, 1)).astype(np.float32)),
+                ("LR", 0, rng.standard_normal((LATE_SIZE // 2, 2)).astype(np.float32)),
+                ("LR", 90, np.zeros((LATE_SIZE, 2), dtype=np.float32))]
+    database = tmp_path / "database.mat"
+    write_mat_database(database, filters)
+
+    late_partitioning = nonuniform_partitioning(LATE_SIZE, BLOCKSIZE, 256)
+    storage = FilterStorage(BLOCKSIZE, 'mat', None, str(database), 'cpu', False, 0, DS_SIZE, EARLY_SIZE, LATE_SIZE,
+                            BLOCKSIZE, late_partitioning=late_partitioning, silence_threshold=-60., loading_threads=3)
+
+    for filter_type, yaw, ir in filters:
+        stored_dict, blocks, partitioning, silence_threshold = storage.get_filter_stage(FILTER_TYPES[filter_type])
+        stored_filter = stored_dict[Pose.from_filterValueList([yaw] + [0] * 14).create_key()]
+
+        expected_filter = Filter(storage.check_filter(FILTER_TYPES[filter_type], ir), blocks, BLOCKSIZE,
+                                 'cpu', partitioning=partitioning, silence_threshold=silence_threshold)
+        expected_filter.storeInFDomain()
+
+        for segment in range(len(expected_filter.TF_segments)):
+            assert torch.allclose(stored_filter.getFilterFD(segment), expected_filter.getFilterFD(segment), atol=1e-5)
+            assert stored_filter.getActivePartitions(segment) == expected_filter.getActivePartitions(segment)
+
+    silent_filter = storage.late_filter_dict[Pose.from_filterValueList([90] + [0] * 14).create_key()]
+    assert all(silent_filter.getActivePartitions(segment) == (0, 0) for segment in range(len(late_partitioning)))
+
+    # all filters of a stage are rows of one contiguous filter bank
+    ds_filters = list(storage.ds_filter_dict.values())
+    bank = ds_filters[0].bank
+    assert all(ds_filter.bank is bank for ds_filter in ds_filters)
+    assert sorted(ds_filter.bank_index for ds_filter in ds_filters) == list(range(len(bank)))
+    assert bank.segments[0].is_contiguous() and bank.segments[0].shape[0] == len(ds_filters)
+
+
+def test_nearest_neighbour_lookup(tmp_path):
+    rng = np.random.default_rng(3)
+    filters = [("DS", yaw, rng.standard_normal((DS_SIZE, 2)).astype(np.float32)) for yaw in range(0, 360, 90)]
+    database = tmp_path / "database.mat"
+    write_mat_database(database, filters)
+
+    storage = FilterStorage(BLOCKSIZE, 'mat', None, str(database), 'cpu', False, 0, DS_SIZE, EARLY_SIZE, LATE_SIZE,
+                            BLOCKSIZE, nearest_neighbour_weights=parse_pose_weights('1,1,1,1,1'),
+                            nearest_neighbour_distance=20.)
+
+    def get_ds_filter(yaw):
+        return storage.get_ds_filter(Pose.from_filterValueList([yaw] + [0] * 14))
+
+    assert get_ds_filter(85) is get_ds_filter(90)
+    assert get_ds_filter(355) is get_ds_filter(0)
+    # farther away than the maximum distance and no stored filters at all
+    assert get_ds_filter(45) is storage.default_ds_filter
+    assert storage.get_early_filter(Pose.from_filterValueList([0] * 15)) is storage.default_early_filter
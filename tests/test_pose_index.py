@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from pybinsim.pose import Pose, SourcePose
+from pybinsim.pose_index import PoseIndex, parse_pose_weights
+
+
+def pose_key(yaw, pitch=0, x=0, custom=0):
+    return Pose.from_filterValueList([yaw, pitch, 0, x, 0, 0] + [0] * 6 + [custom, 0, 0]).create_key()
+
+
+def test_parse_pose_weights():
+    assert np.array_equal(parse_pose_weights('1,2,0,0,3'), np.repeat([1., 2., 0., 0., 3.], 3))
+    assert len(parse_pose_weights(','.join(['1'] * 15))) == 15
+
+    with pytest.raises(ValueError):
+        parse_pose_weights('1,1')
+    with pytest.raises(ValueError):
+        parse_pose_weights('1,1,-1,1,1')
+
+
+def test_nearest_pose():
+    keys = [pose_key(yaw, pitch) for yaw in range(0, 360, 10) for pitch in (-30, 0, 30)]
+    index = PoseIndex(keys, parse_pose_weights('1,1,1,1,1'))
+
+    assert index.query(pose_key(12, 4)) == (pose_key(10, 0), pytest.approx(np.hypot(2, 4)))
+    assert index.query(pose_key(20, 0))[0] == pose_key(20, 0)
+
+    # orientations wrap around
+    assert index.query(pose_key(358, 27))[0] == pose_key(0, 30)
+    assert index.query(pose_key(-6, -28))[0] == pose_key(350, -30)
+
+
+def test_weights_and_max_distance():
+    keys = [pose_key(0, custom=0), pose_key(90, custom=1)]
+
+    assert PoseIndex(keys, parse_pose_weights('1,1,1,1,1')).query(pose_key(80, custom=0))[0] == keys[1]
+    # a large weight keeps the custom value, a weight of 0 ignores the orientation
+    assert PoseIndex(keys, parse_pose_weights('1,1,1,1,1000')).query(pose_key(80, custom=0))[0] == keys[0]
+    assert PoseIndex(keys, parse_pose_weights('0,1,1,1,1')).query(pose_key(80, custom=1))[0] == keys[1]
+
+    index = PoseIndex(keys, parse_pose_weights('1,1,1,1,1'), max_distance=5)
+    assert index.query(pose_key(93, custom=1))[0] == keys[1]
+    assert index.query(pose_key(45, custom=0)) == (None, np.inf)
+
+    assert PoseIndex([], parse_pose_weights('1,1,1,1,1')).query(keys[0]) == (None, np.inf)
+
+
+def test_source_pose_keys():
+    keys = [SourcePose.from_filterValueList([yaw] + [0] * 8).create_key() for yaw in range(0, 360, 90)]
+    index = PoseIndex(keys, parse_pose_weights('1,1,1,1,1')[6:])
+
+    assert index.query(SourcePose.from_filterValueList([300] + [0] * 8).create_key())[0] == keys[3]
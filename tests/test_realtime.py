@@ -0,0 +1,39 @@
+import os
+import threading
+
+import pytest
+
+from pybinsim.realtime import parse_cpu_list, configure_thread
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list('') == set()
+    assert parse_cpu_list('3') == {3}
+    assert parse_cpu_list('0-2,5') == {0, 1, 2, 5}
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'), reason="needs Linux scheduling functions")
+def test_configure_thread_applies_to_single_thread():
+    cpus = {min(os.sched_getaffinity(0))}
+    configured = threading.Event()
+    done = threading.Event()
+
+    thread = threading.Thread(target=lambda: (configured.wait(), done.wait()))
+    thread.start()
+    try:
+        # raising the nice level is always permitted
+        assert configure_thread(thread.native_id, nice=5, cpus=cpus)
+        configured.set()
+
+        assert os.sched_getaffinity(thread.native_id) == cpus
+        assert os.getpriority(os.PRIO_PROCESS, thread.native_id) == 5
+        assert os.getpriority(os.PRIO_PROCESS, threading.get_native_id()) != 5
+    finally:
+        configured.set()
+        done.set()
+        thread.join()
+
+
+def test_configure_thread_reports_failure():
+    # no thread has a negative id
+    assert not configure_thread(-1, nice=5)
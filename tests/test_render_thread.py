@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+
+from pybinsim.render_thread import OutputRingBuffer, RenderThread
+
+BLOCKSIZE = 64
+
+
+def test_ring_buffer_wraps_around():
+    ring = OutputRingBuffer(100)
+    frames = np.arange(140, dtype=np.float32).reshape(70, 2)
+    out = np.empty((60, 2), dtype=np.float32)
+
+    ring.write(frames)
+    assert ring.read(out) == 60
+    ring.write(frames)
+    assert ring.free() == 20
+
+    assert ring.read(out) == 60
+    np.testing.assert_array_equal(out[:10], frames[60:])
+    np.testing.assert_array_equal(out[10:], frames[:50])
+
+    # missing frames are zero
+    assert ring.read(out) == 20
+    np.testing.assert_array_equal(out[:20], frames[50:])
+    np.testing.assert_array_equal(out[20:], 0)
+
+
+def test_render_thread_serves_any_frame_count():
+    counter = [0]
+
+    def render(outdata, frame_count, time_info, status):
+        assert frame_count == BLOCKSIZE
+        outdata[:] = np.arange(counter[0], counter[0] + frame_count)[:, np.newaxis]
+        counter[0] += frame_count
+
+    ring = OutputRingBuffer(BLOCKSIZE * 4)
+    render_thread = RenderThread(render, BLOCKSIZE, ring, 48000)
+    render_thread.start()
+    assert ring.available() == ring.capacity
+
+    # the ring is refilled in blocks, so up to capacity - BLOCKSIZE + 1 frames can always be served
+    max_frames = ring.capacity - BLOCKSIZE + 1
+
+    received = []
+    try:
+        for frame_count in [1, 37, 100, max_frames, 64, 3, 150] * 10:
+            out = np.empty((frame_count, 2), dtype=np.float32)
+            # wait until the render thread caught up, like a device waits for the next period
+            deadline = time.monotonic() + 5
+            while ring.available() < frame_count:
+                assert time.monotonic() < deadline, "render thread did not refill the ring buffer"
+                time.sleep(0.0001)
+            assert ring.read(out) == frame_count
+            received.append(out)
+    finally:
+        render_thread.stop()
+
+    received = np.concatenate(received)
+    np.testing.assert_array_equal(received[:, 0], np.arange(received.shape[0]))
+    np.testing.assert_array_equal(received[:, 1], np.arange(received.shape[0]))
+
+
+def test_render_thread_reports_failure():
+    def render(outdata, frame_count, time_info, status):
+        raise RuntimeError("render failed")
+
+    render_thread = RenderThread(render, BLOCKSIZE, OutputRingBuffer(BLOCKSIZE * 2), 48000)
+    render_thread.start()
+    render_thread.thread.join(5)
+
+    assert render_thread.failed
+    assert not render_thread.thread.is_alive()
@@ -98,3 +98,11 @@ def test_add_start_channel_3ch_input_into_1ch():
     assert add_at_start_channel(zeros(), x, +3) == approx(zeros())
     assert add_at_start_channel(zeros(), x, +4) == approx(zeros())
     assert add_at_start_channel(zeros(), x, +5) == approx(zeros())
+
+
+def test_add_start_channel_volume():
+    x = np.array([[1, 1, 1], [2, 2, 2]], dtype=np.float32)
+    def zeros(): return np.zeros((2, 3), dtype=np.float32)
+    expected = np.array([[0, 0, 0], [0.5, 0.5, 0.5]])
+    assert add_at_start_channel(zeros(), x, +1, 0.5) == approx(expected)
+    assert add_at_start_channel(zeros(), x, +1, 0.5, zeros()) == approx(expected)